@@ -0,0 +1,93 @@
+"""
+The pages of the server as an ASGI application for running under uvicorn instead of Tornado (see the
+backend option of server.py): the redirect to a new game, the game page, the static assets, and the
+metrics, the same as the Tornado handlers. python-socketio's ASGI application handles the socket.io
+requests and passes everything else to this one.
+
+This requires uvicorn (add uvloop for the faster event loop, and websockets and httptools for the
+faster protocol implementations):
+
+    pip3 install uvicorn uvloop websockets httptools
+"""
+
+import re
+from urllib.parse import parse_qsl
+
+try:
+    import uvicorn
+except ImportError:
+    uvicorn = None
+
+import metrics
+from assets import IMMUTABLE, asset_headers
+
+# Path of the page of a game (three words)
+GAME_PATH = re.compile(r'/(\w+)-(\w+)-(\w+)')
+
+
+async def respond(send, status, headers=(), body=b'', include_body=True):
+    """Sends a whole HTTP response, the headers are (name, value) pairs of strings."""
+    headers = [(name.encode('latin-1'), str(value).encode('latin-1')) for name, value in headers]
+    if status != 304: headers.append((b'content-length', str(len(body)).encode('latin-1')))
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body if include_body else b''})
+
+def etag_matches(etag, if_none_match):
+    """Checks if an If-None-Match header matches an Etag (weak comparison, like Tornado)."""
+    if if_none_match.strip() == '*': return True
+    etag = etag.removeprefix('W/')
+    return any(tag.strip().removeprefix('W/') == etag for tag in if_none_match.split(','))
+
+
+class PagesApp:
+    """The ASGI application of the pages, see the module documentation."""
+    def __init__(self, assets, page, new_game_name, routes=None):
+        self.assets = assets
+        self.page = page
+        self.new_game_name = new_game_name # function that gets the name for a new game (None if all names are in use)
+        # other GET paths, each with a coroutine function that takes the dictionary of query arguments
+        # and the Authorization header and returns (status, content type, body)
+        self.routes = routes or {}
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'websocket': return await send({'type': 'websocket.close'})
+        if scope['type'] != 'http': return
+        method, path = scope['method'], scope['path']
+        if method not in ('GET', 'HEAD'): return await respond(send, 405)
+        include_body = method == 'GET'
+        if path == '/':
+            name = self.new_game_name()
+            if name is None: return await respond(send, 503, [('Content-Type', 'text/plain')], b'all game names are in use')
+            return await respond(send, 302, [('Location', f'/{name}'), ('Cache-Control', 'no-store')]) # every visit gets a new game
+        route = self.routes.get(path)
+        if route is not None:
+            headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+            arguments = dict(parse_qsl(scope.get('query_string', b'').decode('latin-1')))
+            status, content_type, body = await route(arguments, headers.get('authorization', ''))
+            return await respond(send, status, [('Content-Type', content_type), ('Cache-Control', 'no-store')], body, include_body)
+        if path == '/metrics':
+            return await respond(send, 200, [('Content-Type', metrics.CONTENT_TYPE)], metrics.render().encode('utf-8'), include_body)
+        if GAME_PATH.fullmatch(path):
+            asset, cache_control = self.page.get(), 'no-cache'
+        elif path.startswith('/static/'):
+            asset, fingerprinted = self.assets.find(path[len('/static/'):])
+            cache_control = IMMUTABLE if fingerprinted else 'no-cache'
+        else:
+            asset = None
+        if asset is None: return await respond(send, 404)
+        headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+        encoding = asset.negotiate(headers.get('accept-encoding', ''))
+        response_headers = asset_headers(asset, encoding, cache_control)
+        if etag_matches(dict(response_headers)['Etag'], headers.get('if-none-match', '')):
+            return await respond(send, 304, response_headers)
+        data = asset.data if encoding is None else asset.encodings[encoding]
+        await respond(send, 200, response_headers, data, include_body)
+
+
+async def serve(app, port, address=''):
+    """Serves an ASGI application with uvicorn on the event loop that is running until the process is stopped."""
+    if uvicorn is None: raise RuntimeError('the asgi backend needs uvicorn: pip3 install uvicorn')
+    # logging is already set up by Tornado's options, and the client addresses are handled by server.py
+    config = uvicorn.Config(app, host=address or '0.0.0.0', port=port, log_config=None,
+                            lifespan='off', proxy_headers=False, ws_ping_interval=None)
+    await uvicorn.Server(config).serve()
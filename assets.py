@@ -0,0 +1,212 @@
+"""
+Static assets served from memory: when the server starts every file in the static directory is
+loaded, fingerprinted with a hash of its content, and compressed ahead of time (gzip, and brotli
+when the brotli package is installed). The cards are also bundled into a single sprite.
+
+Fingerprinted URLs (like /static/script.1a2b3c4d5e.js, from static_url() in templates) are served
+with immutable caching since their content never changes. References to other assets in the CSS and
+JS files (like url("/static/images/back.png")) are rewritten to the fingerprinted URLs before they
+are fingerprinted themselves. Plain URLs still work but have to be revalidated with their ETag.
+Changes to the static files need a restart.
+
+Brotli is optional:
+
+    pip3 install brotli
+"""
+
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+import tornado.template
+import tornado.web
+
+# Path of the card sprite, a grid of the cards with a column for each rank and a row for each suit
+CARD_SPRITE = 'images/cards.svg'
+SPRITE_RANKS = ('2', '3', '4', '5', '6', '7', '8', '9', '10', 'J', 'Q', 'K', 'A')
+SPRITE_SUITS = 'cdhs'
+CARD_WIDTH, CARD_HEIGHT = 360, 540 # size of each card's SVG
+
+# Types that are worth compressing (everything else is already compressed, like PNGs)
+COMPRESSIBLE = ('text/', 'application/javascript', 'application/json', 'image/svg+xml', 'image/x-icon', 'image/vnd.microsoft.icon')
+# Types whose references to other assets are rewritten
+REWRITTEN = ('text/css', 'application/javascript', 'text/javascript')
+
+# Caching of fingerprinted assets (their content never changes)
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+# A reference to an asset (with an optional old-style version query)
+_REFERENCE = re.compile(r'/static/([\w.-]+(?:/[\w.-]+)*)(?:\?v=[\w.]*)?')
+
+
+class Asset:
+    """A single static file with its fingerprint and compressed versions."""
+    def __init__(self, path, data):
+        self.path = path # path relative to the static directory
+        self.data = data
+        self.type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        self.hash = hashlib.md5(data).hexdigest()[:10]
+        base, ext = os.path.splitext(path)
+        self.fingerprinted = f'{base}.{self.hash}{ext}' # path with the hash before the extension
+        self.encodings = {} # compressed data for each content encoding (only when smaller)
+        if self.type.startswith(COMPRESSIBLE):
+            gzipped = gzip.compress(data, 9, mtime=0)
+            if len(gzipped) < len(data): self.encodings['gzip'] = gzipped
+            if brotli is not None:
+                compressed = brotli.compress(data, quality=11)
+                if len(compressed) < len(data): self.encodings['br'] = compressed
+
+    def negotiate(self, accept_encoding):
+        """Gets the content encoding (or None) to send based on an Accept-Encoding header."""
+        accepted = set()
+        for part in accept_encoding.split(','):
+            name, _, params = part.partition(';')
+            params = params.replace(' ', '')
+            try: weight = float(params[2:]) if params.startswith('q=') else 1
+            except ValueError: weight = 0
+            if weight > 0: accepted.add(name.strip().lower())
+        for encoding in ('br', 'gzip'):
+            if encoding in self.encodings and (encoding in accepted or '*' in accepted): return encoding
+        return None
+
+
+def card_sprite(directory):
+    """
+    Bundles the SVG of every card into a single SVG. Each card's SVG is nested at its place in the
+    grid with its ids and classes prefixed by the name of the card so they don't clash.
+    """
+    parts = [f'<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" '
+             f'width="{CARD_WIDTH * len(SPRITE_RANKS)}" height="{CARD_HEIGHT * len(SPRITE_SUITS)}">']
+    for row, suit in enumerate(SPRITE_SUITS):
+        for col, rank in enumerate(SPRITE_RANKS):
+            with open(os.path.join(directory, f'{rank}{suit}.svg'), encoding='utf-8') as f: svg = f.read()
+            prefix = suit + rank
+            svg = re.sub(r'<\?xml[^>]*\?>|<!DOCTYPE[^>]*>', '', svg).strip()
+            svg = re.sub(r'\bid="([^"]+)"', rf'id="{prefix}-\1"', svg)
+            svg = re.sub(r'\bhref="#([^"]+)"', rf'href="#{prefix}-\1"', svg)
+            svg = re.sub(r'url\(#([^)]+)\)', rf'url(#{prefix}-\1)', svg)
+            svg = re.sub(r'\bclass="([^"]*)"',
+                         lambda m: 'class="%s"' % ' '.join(f'{prefix}-{c}' for c in m.group(1).split()), svg)
+            svg = re.sub(r'<style([^>]*)>(.*?)</style>',
+                         lambda m: '<style%s>%s</style>' % (m.group(1), re.sub(
+                             r'(?<![\w.#-])\.(-?[A-Za-z_][\w-]*)', rf'.{prefix}-\1', m.group(2))),
+                         svg, flags=re.S)
+            svg = re.sub(r'<svg\b', f'<svg x="{col * CARD_WIDTH}" y="{row * CARD_HEIGHT}"', svg, count=1)
+            parts.append(svg)
+    parts.append('</svg>')
+    return '\n'.join(parts).encode('utf-8')
+
+
+class Assets:
+    """All of the static assets, see the module documentation."""
+    def __init__(self, directory):
+        self.directory = directory
+        self.assets = {} # Asset for each path (relative to the static directory)
+        self.fingerprinted = {} # Asset for each fingerprinted path
+        files = {}
+        for root, _, names in os.walk(directory):
+            for name in names:
+                full = os.path.join(root, name)
+                with open(full, 'rb') as f:
+                    files[os.path.relpath(full, directory).replace(os.sep, '/')] = f.read()
+        files[CARD_SPRITE] = card_sprite(os.path.join(directory, 'images'))
+        # assets that reference others are done last so the references are already fingerprinted
+        rewritten = {path for path in files if (mimetypes.guess_type(path)[0] or '') in REWRITTEN}
+        for path in sorted(files, key=lambda path: path in rewritten):
+            data = files[path]
+            if path in rewritten: data = self.rewrite(data.decode('utf-8')).encode('utf-8')
+            self._add(Asset(path, data))
+
+    def _add(self, asset):
+        self.assets[asset.path] = asset
+        self.fingerprinted[asset.fingerprinted] = asset
+
+    def url(self, path):
+        """Gets the URL of an asset (fingerprinted if it is known)."""
+        asset = self.assets.get(path)
+        return '/static/' + (path if asset is None else asset.fingerprinted)
+
+    def rewrite(self, text):
+        """Rewrites the references to assets in some text to the fingerprinted URLs."""
+        return _REFERENCE.sub(lambda m: self.url(m.group(1)) if m.group(1) in self.assets else m.group(0), text)
+
+    def find(self, path):
+        """Gets the Asset for a path (either fingerprinted or plain) and if it is fingerprinted."""
+        asset = self.fingerprinted.get(path)
+        if asset is not None: return asset, True
+        return self.assets.get(path), False
+
+
+def asset_headers(asset, encoding, cache_control):
+    """Gets the headers of a response with an Asset in an encoding (see Asset.negotiate()) as a list of (name, value)."""
+    headers = [('Content-Type', asset.type), ('Cache-Control', cache_control),
+               ('Etag', f'"{asset.hash}"' if encoding is None else f'"{asset.hash}-{encoding}"')]
+    if asset.encodings: headers.append(('Vary', 'Accept-Encoding'))
+    if encoding is not None: headers.append(('Content-Encoding', encoding))
+    return headers
+
+def write_asset(handler, asset, cache_control, include_body=True):
+    """
+    Writes an Asset as the response of a request handler: the compressed data the client accepts,
+    the caching headers, and a 304 if the client has it already.
+    """
+    encoding = asset.negotiate(handler.request.headers.get('Accept-Encoding', ''))
+    data = asset.data if encoding is None else asset.encodings[encoding]
+    for name, value in asset_headers(asset, encoding, cache_control): handler.set_header(name, value)
+    if handler.check_etag_header():
+        handler.set_status(304)
+    elif include_body:
+        handler.write(data)
+    else:
+        handler.set_header('Content-Length', len(data))
+
+
+class Page:
+    """
+    A template that is rendered once when it is created (it is the same for everyone, and this way
+    the first visitor doesn't wait for it) and served like an Asset. When checking, it is rendered
+    again whenever the file is modified.
+    """
+    def __init__(self, path, check=False, **namespace):
+        self.path = path
+        self.check = check
+        self.namespace = namespace # the arguments to render the template with
+        self.mtime = None # modification time of the file when it was rendered
+        self.asset = None # Asset of the rendered page
+        self.get()
+
+    def get(self):
+        """Gets the Asset of the rendered page."""
+        if self.asset is None or self.check and os.stat(self.path).st_mtime != self.mtime:
+            self.mtime = os.stat(self.path).st_mtime
+            with open(self.path, 'rb') as f: template = tornado.template.Template(f.read(), name=self.path)
+            self.asset = Asset(os.path.basename(self.path), template.generate(**self.namespace))
+        return self.asset
+
+
+class AssetHandler(tornado.web.RequestHandler):
+    """
+    Serves the assets from memory, use as the static_handler_class setting with the Assets in the
+    static_handler_args setting.
+    """
+    def initialize(self, path, assets):
+        self.assets = assets
+
+    @classmethod
+    def make_static_url(cls, settings, path, include_version=True):
+        return settings['static_handler_args']['assets'].url(path)
+
+    def head(self, path):
+        return self.get(path, include_body=False)
+
+    def get(self, path, include_body=True):
+        asset, fingerprinted = self.assets.find(path)
+        if asset is None: raise tornado.web.HTTPError(404)
+        write_asset(self, asset, IMMUTABLE if fingerprinted else 'no-cache', include_body)
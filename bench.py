@@ -0,0 +1,338 @@
+"""
+Micro-benchmarks of the hot paths of the game engine: Game.play_card(), Game.trade(),
+Game.end_trick(), Game.refresh(), dealing a hand with Game.start_hand(), sorting hands with
+cards.card_sort_key(), and encoding the messages and refresh data they produce as JSON (the way
+socket.io does) and with wire.py.
+
+The methods are called directly on games with a SyncSink, so sending messages does nothing and the
+delayed calls run right away without any event loop. Every game is dealt from a fixed seed and
+played with fixed choices (the lowest cards), so every run times exactly the same work. The games
+each call starts from are restored from snapshots taken while recording the hands (see
+Game.snapshot()) before the timing starts, with all players connected. Each benchmark is timed over
+a number of rounds (after a warm-up round) with garbage collection off, and the mean operations per
+second is reported with its 95% confidence interval.
+
+The results are appended to a history file (JSON lines, with the commit they were run on) and
+compared with a baseline from the history, by default the previous run. A benchmark that got slower
+than the baseline by more than the threshold (and by more than the confidence intervals of both runs
+together, so it isn't just noise) is a regression and makes the exit status 1. For example:
+
+    python3 bench.py
+    python3 bench.py --only play_card,trade --rounds 20
+    python3 bench.py --label before-change
+    python3 bench.py --baseline before-change --threshold 3
+"""
+
+import argparse
+import collections
+import datetime
+import gc
+import json
+import math
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+from cards import DECK, card_sort_key, mask_cards
+from hearts import Game, SyncSink
+import wire
+
+# Two-sided 95% critical values of Student's t-distribution for 1 to 30 degrees of freedom (1.96 after)
+T_95 = (12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228, 2.201, 2.179, 2.160, 2.145,
+        2.131, 2.120, 2.110, 2.101, 2.093, 2.086, 2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048,
+        2.045, 2.042)
+
+# A recorded hand: the seed it was dealt from, the snapshot of the game before trading, the trades as
+# (player number, cards), the plays as (snapshot before the play, player number, card), the cards
+# dealt to each player, and the batches of messages sent to each player for each call
+Hand = collections.namedtuple('Hand', 'seed trading trades plays dealt batches')
+
+
+class SeededGame(Game):
+    """A Game dealt from its own random number generator so the deals are the same every run."""
+    def __init__(self, name, sink=None, seed=0):
+        super().__init__(name, sink)
+        self.rng = random.Random(seed)
+
+    def deal(self):
+        deck = self.rng.sample(DECK, k=52)
+        return [deck[i*13:(i+1)*13] for i in range(4)]
+
+
+def restore(snapshot):
+    """Restores a game with a SyncSink and all of its players connected (like they rejoined)."""
+    game = SeededGame.restore(snapshot, SyncSink())
+    for p in game.players: p.disconnected = False
+    return game
+
+def record(seed):
+    """Deals a hand from a seed and plays it (trading and playing the lowest cards), recording it as a Hand."""
+    batch = collections.defaultdict(list) # messages sent to each player by the current call
+    batches = []
+    def flush():
+        batches.extend(batch.values())
+        batch.clear()
+    sink = SyncSink(on_message=lambda game, sid, event, args, seq: batch[sid].append([event, list(args), seq]))
+    game = SeededGame(f'bench-{seed}', sink, seed)
+    for i in range(4): game.join(f'uid{i}', f'sid{i}', f'Player {i}')
+    game.partner_selected(2)
+    sink.run()
+    flush()
+    trading = game.snapshot()
+    dealt = [mask_cards(p.hand) for p in game.players]
+    trades = [(p.num, mask_cards(p.hand)[:3]) for p in game.players]
+    for num, cards in trades:
+        game.trade(game.players[num].sid, cards)
+        sink.run()
+        flush()
+    plays = []
+    while game.hand_num == 1:
+        p = next(p for p in game.players if p.turn)
+        card = mask_cards(game.playable(p))[0]
+        plays.append((game.snapshot(), p.num, card))
+        game.play_card(p.sid, card)
+        sink.run()
+        flush()
+    return Hand(seed, trading, trades, plays, dealt, batches)
+
+
+##### Benchmarks #####
+# Each prepares the calls it times from the recorded hands and the number of copies of them to make
+# and returns (function that makes all of the calls, number of calls). Only the function is timed.
+
+def bench_play_card(hands, copies):
+    """Playing the first three cards of each trick (the fourth also ends the trick, see end_trick)."""
+    calls = []
+    for _ in range(copies):
+        for hand in hands:
+            for i, (snapshot, num, card) in enumerate(hand.plays):
+                if i % 4 != 3:
+                    game = restore(snapshot)
+                    calls.append((game.play_card, game.players[num].sid, card))
+    def run():
+        for play_card, sid, card in calls: play_card(sid, card)
+    return run, len(calls)
+
+def bench_end_trick(hands, copies):
+    """Ending a trick after its fourth card is played, including the delayed part that starts the next trick (except the last trick)."""
+    games = []
+    for _ in range(copies):
+        for hand in hands:
+            for snapshot, num, card in hand.plays[3:-4:4]:
+                game = restore(snapshot)
+                game.end_trick = lambda: None # play the fourth card without ending the trick
+                game.play_card(game.players[num].sid, card)
+                del game.end_trick
+                games.append(game)
+    def run():
+        for game in games:
+            game.end_trick()
+            game.sink.run()
+    return run, len(games)
+
+def bench_trade(hands, copies):
+    """Trading, the fourth trade of each hand also swaps the cards and starts the first trick."""
+    calls = []
+    for _ in range(copies):
+        for hand in hands:
+            game = restore(hand.trading)
+            calls += [(game.trade, game.players[num].sid, cards) for num, cards in hand.trades]
+    def run():
+        for trade, sid, cards in calls: trade(sid, cards)
+    return run, len(calls)
+
+def bench_start_hand(hands, copies):
+    """Dealing and starting the second hand of each game."""
+    games = []
+    for i in range(copies):
+        for hand in hands:
+            game = restore(hand.trading)
+            game.rng = random.Random(hand.seed * copies + i)
+            games.append(game)
+    def run():
+        for game in games: game.start_hand()
+    return run, len(games)
+
+def bench_refresh(hands, copies):
+    """Getting the complete state of a game in the middle of playing for each player and for spectators."""
+    calls = []
+    for hand in hands:
+        for snapshot, _, _ in hand.plays[::5]:
+            game = restore(snapshot)
+            calls += [(game.refresh, p.sid) for p in game.players] + [(game.refresh, None)]
+    def run():
+        for _ in range(copies):
+            for refresh, sid in calls: refresh(sid)
+    return run, copies * len(calls)
+
+def bench_card_sort_key(hands, copies):
+    """Sorting the cards of each hand dealt."""
+    dealt = [cards for hand in hands for cards in hand.dealt]
+    def run():
+        for _ in range(copies):
+            for cards in dealt: sorted(cards, key=card_sort_key)
+    return run, copies * len(dealt)
+
+def bench_json_batches(hands, copies):
+    """Encoding the batches of messages sent to each player as JSON (like socket.io, which adds the 'batch' event)."""
+    batches = [['batch', batch] for hand in hands for batch in hand.batches]
+    def run():
+        for _ in range(copies):
+            for batch in batches: json.dumps(batch, separators=(',', ':'))
+    return run, copies * len(batches)
+
+def bench_json_refresh(hands, copies):
+    """Encoding the complete state of a game (from refresh()) as JSON."""
+    states = []
+    for hand in hands:
+        for snapshot, _, _ in hand.plays[::5]:
+            game = restore(snapshot)
+            states += [list(game.refresh(p.sid)) for p in game.players]
+    def run():
+        for _ in range(copies):
+            for state in states: json.dumps(state, separators=(',', ':'))
+    return run, copies * len(states)
+
+def bench_wire_batches(hands, copies):
+    """Encoding the batches of messages sent to each player with the binary encoding of wire.py."""
+    batches = [batch for hand in hands for batch in hand.batches]
+    def run():
+        for _ in range(copies):
+            for batch in batches: wire.encode_batch(batch)
+    return run, copies * len(batches)
+
+# The benchmarks with the number of copies of the calls made for each hand recorded in each round
+BENCHMARKS = {
+    'play_card': (bench_play_card, 10),
+    'end_trick': (bench_end_trick, 25),
+    'trade': (bench_trade, 75),
+    'start_hand': (bench_start_hand, 40),
+    'refresh': (bench_refresh, 10),
+    'card_sort_key': (bench_card_sort_key, 150),
+    'json_batches': (bench_json_batches, 2),
+    'json_refresh': (bench_json_refresh, 5),
+    'wire_batches': (bench_wire_batches, 2),
+}
+
+
+def time_rounds(prepare, hands, copies, rounds):
+    """Times a benchmark, returning the operations per second of each round (after a warm-up round)."""
+    results = []
+    for _ in range(rounds + 1):
+        run, ops = prepare(hands, copies)
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - start
+        finally:
+            gc.enable()
+        results.append(ops / elapsed)
+    return results[1:]
+
+def summarize(rates):
+    """Gets the mean of the rates and the half-width of its 95% confidence interval."""
+    mean = statistics.fmean(rates)
+    if len(rates) < 2: return mean, math.inf
+    t = T_95[len(rates) - 2] if len(rates) - 1 <= len(T_95) else 1.96
+    return mean, t * statistics.stdev(rates) / math.sqrt(len(rates))
+
+def git_commit():
+    """Gets the commit the code is at (with a + if there are uncommitted changes), or None if it isn't known."""
+    directory = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=directory,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=directory,
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('+' if dirty else '')
+
+def read_history(path):
+    """Reads the runs in a history file (an empty list if it doesn't exist)."""
+    if not os.path.exists(path): return []
+    with open(path) as f: return [json.loads(line) for line in f if line.strip()]
+
+# Shortest commit prefix accepted as a baseline (so a short label can't match a commit by accident)
+MIN_COMMIT_PREFIX = 7
+
+def find_baseline(history, baseline):
+    """
+    Gets the latest run in the history with a label, or if none has that label with a commit that
+    starts with it (at least MIN_COMMIT_PREFIX characters), or the latest run of all if None.
+    """
+    if baseline is None: return history[-1] if history else None
+    for run in reversed(history):
+        if run.get('label') == baseline: return run
+    if len(baseline) < MIN_COMMIT_PREFIX: return None
+    for run in reversed(history):
+        if (run.get('commit') or '').startswith(baseline): return run
+    return None
+
+def compare(results, base, threshold):
+    """Prints the changes from the baseline run and returns the names of the benchmarks that regressed."""
+    print(f"\ncompared with {base.get('label') or base.get('commit') or 'the previous run'} ({base['time']}):")
+    regressions = []
+    for name, result in results.items():
+        before = base['results'].get(name)
+        if before is None: continue
+        change = result['ops_per_sec'] / before['ops_per_sec'] - 1
+        # the confidence intervals overlapping means the change could just be noise
+        noise = abs(result['ops_per_sec'] - before['ops_per_sec']) <= result['ci'] + before['ci']
+        regressed = change < -threshold / 100 and not noise
+        if regressed: regressions.append(name)
+        print(f"  {name:<14} {change:+7.1%}" + (' REGRESSION' if regressed else '') + (' (within noise)' if noise else ''))
+    return regressions
+
+def main(args):
+    names = args.only.split(',') if args.only else list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown: sys.exit(f"unknown benchmarks: {', '.join(unknown)} (choose from {', '.join(BENCHMARKS)})")
+    hands = [record(args.seed + i) for i in range(args.deals)]
+
+    results = {}
+    print(f"{'benchmark':<14} {'ops/sec':>12} {'95% CI':>10} {'us/op':>8}")
+    for name in names:
+        prepare, copies = BENCHMARKS[name]
+        rates = time_rounds(prepare, hands, max(1, round(copies * args.scale)), args.rounds)
+        mean, ci = summarize(rates)
+        results[name] = {'ops_per_sec': mean, 'ci': ci, 'rounds': rates}
+        print(f"{name:<14} {mean:>12,.0f} {ci / mean:>9.1%} {1e6 / mean:>8.2f}")
+
+    history = read_history(args.history) if args.history else []
+    base = find_baseline(history, args.baseline)
+    regressions = []
+    if base is not None:
+        regressions = compare(results, base, args.threshold)
+    elif args.baseline:
+        print(f'\nno run {args.baseline!r} in the history to compare with')
+    if args.history and not args.no_save:
+        run = {'time': datetime.datetime.now().isoformat(timespec='seconds'), 'label': args.label,
+               'commit': git_commit(), 'python': platform.python_version(), 'seed': args.seed,
+               'deals': args.deals, 'scale': args.scale, 'results': results}
+        with open(args.history, 'a') as f: f.write(json.dumps(run) + '\n')
+    return 1 if regressions else 0
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--only', help='comma separated benchmarks to run (default is all of them: ' + ', '.join(BENCHMARKS) + ')')
+    parser.add_argument('--deals', type=int, default=20, help='number of hands dealt (from consecutive seeds)')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the first hand dealt')
+    parser.add_argument('--rounds', type=int, default=10, help='number of times each benchmark is timed')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiplier for the number of calls timed in each round')
+    parser.add_argument('--history', default='bench-history.jsonl', help='file the results are added to and the baseline is taken from (empty for none)')
+    parser.add_argument('--no_save', action='store_true', help="don't add the results to the history")
+    parser.add_argument('--label', help='label saved with the results (to use them as the baseline later)')
+    parser.add_argument('--baseline', help='label or commit of the run to compare with (default is the previous run)')
+    parser.add_argument('--threshold', type=float, default=5.0, help='percent slower than the baseline that is a regression')
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    sys.exit(main(parse_args()))
@@ -0,0 +1,174 @@
+"""
+Computer players: choosing the trades and cards for computer players and for players that have been
+disconnected for too long.
+
+Cards are chosen with a determinized Monte Carlo search. The cards that the player can't see are
+randomly dealt to the other players (respecting how many cards each has and the suits they are
+known to be out of) and then the rest of the hand is played out with random legal cards for each of
+the cards the player could play. This is repeated until the time is up and the card that gave the
+best average points for the player's team (shooting the moon included) is played. The search only
+uses what the player could know (their own hand, the cards that have been played, and the current
+trick).
+
+The searches run in a process pool so they never block the event loop and each one has a hard
+deadline. Trades use a quick heuristic instead (getting rid of the high spades, high hearts, and
+high cards in general) which is done in-process.
+"""
+
+import asyncio
+import collections
+import multiprocessing
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import eventloop
+from cards import DECK, CARD_BITS, SUIT_MASKS, POINT_CARDS, mask_cards, count_points, legal_plays
+
+# Mask of the suit of each card bit
+_SUIT_OF = {1 << i: SUIT_MASKS[card[0]] for i, card in enumerate(DECK)}
+
+# Everything a player can know when choosing a card
+View = collections.namedtuple('View', (
+    'num', # the player's number (0-3)
+    'hand', # mask of the player's cards
+    'unseen', # mask of the cards that are held by the other players
+    'counts', # number of cards held by each player
+    'voids', # mask of the suits that each player is known to be out of
+    'trick', # bits of the cards played in the current trick so far
+    'trick_start', # number of the player who started the current trick
+    'hearts_broken', # if hearts have been broken in this hand
+    'scores', # points taken by the 0/2 and 1/3 teams in this hand so far
+))
+
+def view(game, p):
+    """Gets the View of the game for a player in the playing state."""
+    unseen = 0
+    for q in game.players:
+        if q is not p: unseen |= q.hand
+    trick = [CARD_BITS[card] for card in game.trick_cards]
+    voids = [0] * 4
+    if trick:
+        led = _SUIT_OF[trick[0]]
+        for i, bit in enumerate(trick):
+            if not bit & led: voids[(game.trick_start_player.num + i) % 4] |= led
+    return View(p.num, p.hand, unseen, tuple(q.hand.bit_count() for q in game.players), tuple(voids),
+                tuple(trick), game.trick_start_player.num, game.hearts_broken,
+                (game.hand_score0, game.hand_score1))
+
+def _bits(mask):
+    """Gets the list of the bits in a mask."""
+    bits = []
+    while mask:
+        low = mask & -mask
+        bits.append(low)
+        mask ^= low
+    return bits
+
+def _deal(view, rng):
+    """Randomly deals the unseen cards to the other players, giving the hands of all players."""
+    others = sorted((q for q in range(4) if q != view.num), key=lambda q: -view.voids[q].bit_count())
+    for attempt in range(10):
+        hands = [0] * 4
+        hands[view.num] = view.hand
+        remaining = view.unseen
+        for q in others: # players with the most known voids are dealt to first
+            available = _bits(remaining & ~view.voids[q] if attempt < 9 else remaining)
+            if len(available) < view.counts[q]: break
+            for bit in rng.sample(available, view.counts[q]): hands[q] |= bit
+            remaining &= ~hands[q]
+        else:
+            return hands
+    raise ValueError('unable to deal the unseen cards')
+
+def _rollout(view, hands, bit, rng):
+    """
+    Plays the rest of the hand with random legal cards after the player plays the given card.
+    Returns the points for the player's team minus the points for the other team.
+    """
+    hands = list(hands)
+    scores = list(view.scores)
+    hearts_broken = view.hearts_broken
+    trick = [(b, (view.trick_start + i) % 4) for i, b in enumerate(view.trick)]
+    num = view.num
+    while True:
+        if bit is None:
+            led = _SUIT_OF[trick[0][0]] if trick else 0
+            bit = rng.choice(_bits(legal_plays(hands[num], led, hearts_broken)))
+        hands[num] &= ~bit
+        trick.append((bit, num))
+        if bit & POINT_CARDS: hearts_broken = True
+        bit = None
+        if len(trick) < 4:
+            num = (num + 1) % 4
+            continue
+        # highest card in the led suit (a higher bit is a higher rank in a suit) takes the trick
+        led = _SUIT_OF[trick[0][0]]
+        num = max(t for t in trick if t[0] & led)[1]
+        scores[num % 2] += count_points(sum(b for b, _ in trick))
+        trick = []
+        if not hands[num]: break
+    team = view.num % 2
+    if scores[team] == 26: return -36
+    if scores[1 - team] == 26: return 36
+    return scores[team] - scores[1 - team]
+
+def choose_card(view, deadline, seed=None):
+    """
+    Chooses the card (as a string like 'c5') for a player with a determinized Monte Carlo search
+    that runs until the deadline (a time.time() value), at least one deal is always tried.
+    """
+    led = _SUIT_OF[view.trick[0]] if view.trick else 0
+    choices = _bits(legal_plays(view.hand, led, view.hearts_broken))
+    totals = [0] * len(choices)
+    if len(choices) > 1:
+        rng = random.Random(seed)
+        while True:
+            hands = _deal(view, rng)
+            for i, bit in enumerate(choices): totals[i] += _rollout(view, hands, bit, rng)
+            if time.time() >= deadline: break
+    best = min(range(len(choices)), key=totals.__getitem__)
+    return DECK[choices[best].bit_length() - 1]
+
+def choose_trade(hand):
+    """Chooses the 3 cards for a player to trade from their hand (a mask)."""
+    spades = SUIT_MASKS['s']
+    low_spades = (hand & spades & ~CARD_BITS['sQ'] & ~CARD_BITS['sK'] & ~CARD_BITS['sA']).bit_count()
+    def danger(card):
+        rank = DECK.index(card) // 4 + 2
+        if card in ('sQ', 'sK', 'sA') and low_spades < 4: return 100 + rank # not enough low spades to protect it
+        if card[0] == 'h': return 20 + rank
+        return rank
+    return sorted(mask_cards(hand), key=danger)[-3:]
+
+
+class BotPlayers:
+    """Makes the moves for computer players, running the searches in a process pool."""
+    def __init__(self, budget=1.0, processes=0):
+        self.budget = budget # seconds each search is given
+        self.executor = ProcessPoolExecutor(processes or None,
+                                            mp_context=multiprocessing.get_context('spawn'))
+        self.thinking = set() # games with a search running
+
+    def trade(self, game, p):
+        """Chooses the cards to trade for a player."""
+        return choose_trade(p.hand)
+
+    async def play(self, game, p):
+        """
+        Chooses the card to play for a player whose turn it is. If the search doesn't finish in time
+        (the pool is busy) a random legal card is chosen instead.
+        """
+        fallback = random.choice(mask_cards(game.playable(p)))
+        self.thinking.add(game)
+        try:
+            future = eventloop.run_in_executor(self.executor, choose_card, view(game, p),
+                                                      time.time() + self.budget)
+            return await asyncio.wait_for(future, self.budget + 1)
+        except asyncio.TimeoutError:
+            return fallback
+        finally:
+            self.thinking.discard(game)
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,88 @@
+"""
+Compact card model used by the rules engine.
+
+Every card is a single bit in a 52-bit integer and a hand (or trick, or set of traded cards) is just
+the bitwise-or of its cards. The bit index of a card is its index in DECK, which is ordered by rank
+first and then by suit, so within a single suit a higher bit is always a higher ranked card. This
+makes checking suits, finding the winner of a trick, and counting points just a few bitwise
+operations. The cards are still strings like 'c5' everywhere outside of the engine.
+"""
+
+# A complete deck of cards
+DECK = (
+    'c2', 'd2', 'h2', 's2', 'c3', 'd3', 'h3', 's3', 'c4', 'd4', 'h4', 's4', 'c5', 'd5', 'h5', 's5',
+    'c6', 'd6', 'h6', 's6', 'c7', 'd7', 'h7', 's7', 'c8', 'd8', 'h8', 's8', 'c9', 'd9', 'h9', 's9', 'c10', 'd10', 'h10', 's10',
+    'cJ', 'dJ', 'hJ', 'sJ', 'cQ', 'dQ', 'hQ', 'sQ', 'cK', 'dK', 'hK', 'sK', 'cA', 'dA', 'hA', 'sA',
+)
+
+SUITS = 'cdhs' # suits in the same order as they are in DECK
+
+# The bit for each card (key is a card string like 'c5')
+CARD_BITS = {card: 1 << i for i, card in enumerate(DECK)}
+
+# The index of each card in DECK (key is a card string like 'c5')
+CARD_INDICES = {card: i for i, card in enumerate(DECK)}
+
+# Mask of all cards in each suit (key is the suit letter)
+SUIT_MASKS = {suit: sum(1 << i for i in range(SUITS.index(suit), 52, 4)) for suit in SUITS}
+
+ALL_CARDS = (1 << 52) - 1
+TWO_OF_CLUBS = CARD_BITS['c2']
+QUEEN_OF_SPADES = CARD_BITS['sQ']
+HEARTS = SUIT_MASKS['h']
+POINT_CARDS = HEARTS | QUEEN_OF_SPADES
+
+# Sort key of each card, (suit, number) with J, Q, K, and A being 11 to 14
+CARD_SORT_KEYS = {card: (card[0], i // 4 + 2) for i, card in enumerate(DECK)}
+
+
+def card_sort_key(card):
+    """Key function for sorting cards. Usable as key argument of list.sort(), max(), and min()."""
+    return CARD_SORT_KEYS[card]
+
+def card_bit(card):
+    """Gets the bit for a card string like 'c5'. Anything that is not a card gives 0."""
+    return CARD_BITS.get(card, 0) if isinstance(card, str) else 0
+
+def cards_mask(cards):
+    """Gets the mask for an iterable of card strings. Anything that is not a card is ignored."""
+    mask = 0
+    for card in cards: mask |= card_bit(card)
+    return mask
+
+def mask_cards(mask):
+    """Gets the list of card strings in a mask, in the same order as DECK."""
+    cards = []
+    while mask:
+        low = mask & -mask
+        cards.append(DECK[low.bit_length() - 1])
+        mask ^= low
+    return cards
+
+def highest_card(mask):
+    """Gets the highest ranked card string in a mask (which should only contain a single suit)."""
+    return DECK[mask.bit_length() - 1]
+
+def count_points(mask):
+    """Counts the number of points in a mask of cards."""
+    return (mask & HEARTS).bit_count() + (13 if mask & QUEEN_OF_SPADES else 0)
+
+def legal_plays(hand, led, hearts_broken):
+    """
+    Gets the mask of the cards in a hand that can be played. The led argument is the mask of the
+    suit of the first card in the trick (or 0 if the card is being led). A full hand means it is the
+    first trick of the hand.
+    """
+    first_trick = hand.bit_count() == 13
+    no_points = hand & ~POINT_CARDS # only point cards are forced when there are no others
+    if not led:
+        # First card:
+        #  * first trick must be 'c2'
+        #  * cannot start with a point card if hearts not broken and not forced
+        playable = hand & TWO_OF_CLUBS if first_trick else hand
+        return playable & ~POINT_CARDS if not hearts_broken and no_points else playable
+    # Other cards:
+    #  * must follow suit if possible
+    #  * cannot play a point card on first trick if possible
+    playable = hand & led or hand
+    return playable & ~POINT_CARDS if first_trick and no_points else playable
@@ -0,0 +1,241 @@
+"""
+Sharded mode: several server.py worker processes behind a single router process.
+
+Each game is owned by exactly one worker, chosen by consistent hashing of the game name. The
+router serves the pages and static files itself and forwards the socket.io traffic (both long
+polling and websockets) to the worker that owns the game given in the 'game' query argument, so
+every socket for a game lands on the same process. Requests for a new game are forwarded to each
+worker in turn since each worker only hands out the names of games that it owns.
+
+Cross-process messages (emits to rooms, closing rooms, ...) go through python-socketio's pub/sub
+client manager. Instead of requiring Redis, the router runs a tiny pub/sub hub that relays every
+published message to all of the workers.
+"""
+
+import asyncio
+import bisect
+import hashlib
+import itertools
+import json
+import struct
+import subprocess
+import sys
+
+from socketio.async_pubsub_manager import AsyncPubSubManager
+
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.iostream import StreamClosedError
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.tcpclient import TCPClient
+from tornado.tcpserver import TCPServer
+import tornado.netutil
+import tornado.web
+import tornado.websocket
+
+
+def _hash(key):
+    """Stable 64-bit hash of a string (Python's hash() is randomized per process)."""
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+class HashRing:
+    """Consistent hashing of game names onto a set of nodes (worker numbers)."""
+    def __init__(self, nodes, replicas=160):
+        points = sorted((_hash(f'{node}:{i}'), node) for node in nodes for i in range(replicas))
+        self.keys = [key for key, _ in points] # sorted hashes of the points on the ring
+        self.nodes = [node for _, node in points] # node for each point on the ring
+
+    def node(self, name):
+        """Gets the node that owns the given name."""
+        i = bisect.bisect(self.keys, _hash(name))
+        return self.nodes[i % len(self.nodes)]
+
+
+##### Pub/Sub #####
+
+# Messages between the hub and the workers are a 4-byte big-endian length followed by JSON
+_LENGTH = struct.Struct('>I')
+
+class Hub(TCPServer):
+    """Relays every message received from a worker to all workers (including the sender)."""
+    def __init__(self):
+        super().__init__()
+        self.streams = set() # all connected worker streams
+
+    async def handle_stream(self, stream, address):
+        self.streams.add(stream)
+        try:
+            while True:
+                header = await stream.read_bytes(_LENGTH.size)
+                payload = await stream.read_bytes(_LENGTH.unpack(header)[0])
+                for s in list(self.streams):
+                    try: s.write(header + payload)
+                    except StreamClosedError: self.streams.discard(s)
+        except StreamClosedError:
+            pass
+        finally:
+            self.streams.discard(stream)
+
+class HubManager(AsyncPubSubManager):
+    """socket.io client manager that publishes through the Hub of the router process."""
+    name = 'hub'
+
+    def __init__(self, address, channel='socketio', write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.host, port = address.rsplit(':', 1)
+        self.port = int(port)
+        self.stream = None
+
+    async def _connect(self):
+        if self.stream is None or self.stream.closed():
+            self.stream = await TCPClient().connect(self.host, self.port)
+        return self.stream
+
+    async def _publish(self, data):
+        payload = json.dumps(data).encode()
+        stream = await self._connect()
+        await stream.write(_LENGTH.pack(len(payload)) + payload)
+
+    async def _listen(self):
+        while True:
+            try:
+                stream = await self._connect()
+                header = await stream.read_bytes(_LENGTH.size)
+                yield json.loads(await stream.read_bytes(_LENGTH.unpack(header)[0]))
+            except (StreamClosedError, OSError):
+                self.stream = None
+                await asyncio.sleep(1) # wait a moment before reconnecting
+
+def use_hub(sio, address):
+    """Makes the socket.io server use the hub at the given address ('host:port') as its manager."""
+    sio.manager = HubManager(address)
+    sio.manager.set_server(sio)
+
+
+##### Router #####
+
+# Headers that only apply to a single connection and are not forwarded
+_HOP_HEADERS = frozenset(('Connection', 'Upgrade', 'Keep-Alive', 'Transfer-Encoding', 'Content-Length'))
+
+class SocketIOProxyHandler(tornado.websocket.WebSocketHandler):
+    """
+    Forwards socket.io requests to the worker that owns the game given by the 'game' query
+    argument. Websocket upgrades are piped in both directions, everything else is forwarded as a
+    plain HTTP request (long polling).
+    """
+    def initialize(self, ring, ports):
+        self.ring = ring
+        self.ports = ports
+        self.upstream = None
+
+    def _worker_url(self, scheme):
+        worker = self.ring.node(self.get_query_argument('game', ''))
+        return f'{scheme}://127.0.0.1:{self.ports[worker]}{self.request.uri}'
+
+    def _upstream_headers(self):
+        headers = self.request.headers.copy()
+        for name in list(headers):
+            if name in _HOP_HEADERS or name.startswith('Sec-Websocket-'): del headers[name]
+        headers['X-Forwarded-For'] = self.request.remote_ip
+        return headers
+
+    def check_origin(self, origin):
+        return True # the worker checks the forwarded Origin header itself
+
+    async def get(self, *args, **kwargs):
+        if self.request.headers.get('Upgrade', '').lower() != 'websocket':
+            return await self._forward()
+        request = HTTPRequest(self._worker_url('ws'), headers=self._upstream_headers())
+        try:
+            self.upstream = await tornado.websocket.websocket_connect(request)
+        except (OSError, tornado.websocket.WebSocketError):
+            raise tornado.web.HTTPError(502)
+        await super().get(*args, **kwargs)
+
+    async def post(self, *args, **kwargs):
+        await self._forward()
+
+    async def _forward(self):
+        response = await AsyncHTTPClient().fetch(HTTPRequest(
+            self._worker_url('http'), method=self.request.method, headers=self._upstream_headers(),
+            body=self.request.body if self.request.method == 'POST' else None,
+            follow_redirects=False, decompress_response=False, request_timeout=120),
+            raise_error=False)
+        if response.code == 599: raise tornado.web.HTTPError(502)
+        self.set_status(response.code, response.reason)
+        self.clear_header('Content-Type')
+        for name, value in response.headers.get_all():
+            if name not in _HOP_HEADERS and name not in ('Server', 'Date'):
+                self.add_header(name, value)
+        self.finish(response.body)
+
+    def open(self, *args, **kwargs):
+        IOLoop.current().add_callback(self._pipe_upstream)
+
+    async def _pipe_upstream(self):
+        while True:
+            message = await self.upstream.read_message()
+            if message is None: return self.close()
+            try: await self.write_message(message, binary=isinstance(message, bytes))
+            except tornado.websocket.WebSocketClosedError: return self.upstream.close()
+
+    async def on_message(self, message):
+        try: await self.upstream.write_message(message, binary=isinstance(message, bytes))
+        except tornado.websocket.WebSocketClosedError: self.close()
+
+    def on_close(self):
+        if self.upstream is not None: self.upstream.close()
+
+class NewGameProxyHandler(SocketIOProxyHandler):
+    """
+    Forwards the requests for a new game to each worker in turn. A worker only hands out the names
+    of games it owns, so the names can't collide with games on the other workers.
+    """
+    def initialize(self, ports, turns):
+        super().initialize(None, ports)
+        self.turns = turns # itertools.count() shared by all requests
+
+    def _worker_url(self, scheme):
+        port = self.ports[next(self.turns) % len(self.ports)]
+        return f'{scheme}://127.0.0.1:{port}{self.request.uri}'
+
+def run_router(app, script, workers, port, address, worker_port=0):
+    """
+    Runs the router: starts the pub/sub hub, spawns the worker processes (restarting any that
+    exit), and listens with the given application on the public port. The application must route
+    socket.io requests to SocketIOProxyHandler, see router_handler(), and requests for a new game to
+    NewGameProxyHandler, see new_game_handler().
+    """
+    hub_socket, = tornado.netutil.bind_sockets(0, '127.0.0.1')
+    hub = Hub()
+    hub.add_sockets([hub_socket])
+    hub_address = '127.0.0.1:%d' % hub_socket.getsockname()[1]
+
+    worker_port = worker_port or port + 1
+    procs = [None] * workers
+    def spawn(i):
+        procs[i] = subprocess.Popen([sys.executable, script] + sys.argv[1:] + [
+            f'--port={worker_port + i}', '--address=127.0.0.1',
+            f'--workers={workers}', f'--worker={i}', f'--hub={hub_address}'])
+    def check():
+        for i, proc in enumerate(procs):
+            if proc.poll() is not None: spawn(i)
+    for i in range(workers): spawn(i)
+    PeriodicCallback(check, 1000).start()
+
+    app.listen(port, address=address)
+    try:
+        IOLoop.current().start()
+    finally:
+        for proc in procs: proc.terminate()
+
+def router_handler(workers, port, worker_port=0):
+    """The URL spec that routes socket.io requests to the workers."""
+    worker_port = worker_port or port + 1
+    ports = [worker_port + i for i in range(workers)]
+    return (r"/game-io/", SocketIOProxyHandler, dict(ring=HashRing(range(workers)), ports=ports))
+
+def new_game_handler(workers, port, worker_port=0):
+    """The URL spec that forwards requests for a new game to the workers."""
+    worker_port = worker_port or port + 1
+    ports = [worker_port + i for i in range(workers)]
+    return (r"/", NewGameProxyHandler, dict(ports=ports, turns=itertools.count()))
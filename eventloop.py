@@ -0,0 +1,80 @@
+"""
+The event loop operations used by the server (callbacks, timers, the time, periodic calls, and
+running blocking functions in threads) on top of asyncio instead of Tornado's IOLoop.
+
+Tornado's IOLoop runs on asyncio too, so the same code works with either server backend (Tornado or
+uvicorn, see server.py) and with uvloop's implementation of the asyncio event loop. All of these
+must be called while the event loop is running (from a handler, a callback, or a coroutine running
+on the loop).
+"""
+
+import asyncio
+import inspect
+import math
+
+# The tasks of the coroutines started by add_callback() (asyncio only keeps weak references to tasks)
+_tasks = set()
+
+
+def time():
+    """Gets the current time of the event loop (like time.monotonic())."""
+    return asyncio.get_running_loop().time()
+
+def _report(loop, task):
+    _tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        loop.call_exception_handler({'message': 'Exception in callback', 'exception': task.exception(), 'future': task})
+
+def _run(callback, args):
+    result = callback(*args)
+    if inspect.isawaitable(result):
+        loop = asyncio.get_running_loop()
+        task = asyncio.ensure_future(result)
+        _tasks.add(task)
+        task.add_done_callback(lambda task: _report(loop, task))
+
+def add_callback(callback, *args):
+    """
+    Calls the callback with the arguments on the next iteration of the event loop. If the callback
+    is a coroutine function, the coroutine is run as a task.
+    """
+    asyncio.get_running_loop().call_soon(_run, callback, args)
+
+def call_at(when, callback, *args):
+    """Calls the callback with the arguments at a time of the event loop (see time()), returning a handle that can be cancelled."""
+    return asyncio.get_running_loop().call_at(when, _run, callback, args)
+
+def run_in_executor(executor, func, *args):
+    """Runs a function in a concurrent.futures executor, returning an asyncio future of its result."""
+    return asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+
+class PeriodicCallback:
+    """
+    Calls a callback every interval seconds once started (like Tornado's PeriodicCallback, but in
+    seconds). If the callback is a coroutine function the next call waits for it to finish, and calls
+    that would have happened while a call ran too long are skipped.
+    """
+    def __init__(self, callback, interval):
+        self.callback = callback
+        self.interval = interval
+        self.next_time = None # event loop time of the next call
+        self.handle = None # handle of the next call, None when stopped
+
+    def start(self):
+        self.next_time = time() + self.interval
+        self.handle = call_at(self.next_time, self._call)
+
+    def stop(self):
+        if self.handle is not None: self.handle.cancel()
+        self.handle = None
+
+    async def _call(self):
+        try:
+            result = self.callback()
+            if inspect.isawaitable(result): await result
+        finally:
+            if self.handle is not None:
+                now = time()
+                self.next_time += self.interval * max(1, math.ceil((now - self.next_time) / self.interval))
+                self.handle = call_at(self.next_time, self._call)
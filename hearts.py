@@ -0,0 +1,781 @@
+"""
+The rules engine of the game: the Game and Player classes.
+
+The engine does not depend on socket.io or Tornado. Everything a game does outside of its own state
+(sending messages to players, tracking which connections receive the game's messages, and the
+delayed calls at the end of tricks and hands) goes through an EventSink. The server connects games
+to socket.io with its own sink while SyncSink runs whole games synchronously in-process for
+simulations, AI opponents, replays, and benchmarks (see play_game()).
+"""
+
+import collections
+import random
+import struct
+import time
+
+from cards import (DECK, CARD_INDICES, SUIT_MASKS, TWO_OF_CLUBS, POINT_CARDS, card_bit,
+                   cards_mask, mask_cards, highest_card, count_points, legal_plays)
+
+# How cards are traded during different hands
+#   The outer list is indexed by the hand number mod 4
+#   The inner list is indexed by player number (0-4)
+#   The value given is a player number to trade with
+TRADING = [
+    [0,1,2,3], # keep
+    [3,0,1,2], # left
+    [1,2,3,0], # right
+    [2,3,0,1], # across
+]
+
+# Total score to win
+SCORE_TO_WIN = 100
+
+# All of the states of a game, in order
+STATES = ('waiting', 'trading', 'playing', 'ended')
+
+# Number of recent messages kept by each game so that a reconnecting player only gets what they missed
+HISTORY_SIZE = 128
+
+# Binary snapshot format of a game (see Game.snapshot()), the version is the first byte
+SNAPSHOT_VERSION = 3
+_GAME_STRUCT = struct.Struct('>BBHHH?bbbbbbbB') # version, state, hand_num, score0, score1,
+    # hearts_broken, num_tricks0, num_tricks1, hand_score0, hand_score1, trick start player num,
+    # delayed callback (0 for none, 1 for _end_trick_delayed, 2 for _end_hand_delayed), delayed
+    # player num, number of players
+_SEQ_STRUCT = struct.Struct('>I') # version of the game's state (since snapshot version 2)
+_PLAYER_STRUCT = struct.Struct('>BBQ') # num, flags (1 for turn, 2 for pending trade, 4 for computer player), hand
+_LENGTH_STRUCT = struct.Struct('>I') # length of a string
+_HAND_STRUCT = struct.Struct('>4Q4Q') # cards dealt to and passed by each player (since snapshot version 3, all 0 if unknown)
+
+def _pack_str(string):
+    data = string.encode()
+    return _LENGTH_STRUCT.pack(len(data)) + data
+
+def _unpack_str(data, pos):
+    length, = _LENGTH_STRUCT.unpack_from(data, pos)
+    pos += _LENGTH_STRUCT.size
+    return data[pos:pos+length].decode(), pos + length
+
+def _pack_cards(cards):
+    return bytes([len(cards)] + [CARD_INDICES[card] for card in cards])
+
+def _unpack_cards(data, pos):
+    return [DECK[i] for i in data[pos+1:pos+1+data[pos]]], pos + 1 + data[pos]
+
+
+class EventSink:
+    """
+    Receives everything a Game does outside of its own state. This base class ignores everything
+    (including delayed calls, so the game stops at the end of the first trick).
+    """
+    def send(self, game, sid, event, args, seq):
+        """
+        Sends a message (an event name and tuple of arguments) to a single player. The seq is the
+        sequence number of the message in the game (see Game.version).
+        """
+
+    def publish(self, game, event, args, seq):
+        """
+        Sends a message with only public information (everything sent to all players, and a few
+        messages just for spectators, see Game.publish()) to the spectators of the game. Called once
+        per message no matter how many players or spectators there are.
+        """
+
+    def enter(self, game, sid):
+        """Called when a player's connection starts receiving the game's messages."""
+
+    def leave(self, game, sid):
+        """Called when a player's connection stops receiving the game's messages."""
+
+    def call_later(self, game, callback, pause):
+        """
+        Calls the callback (with no arguments) after the pause at the end of a trick or hand (pause
+        is 'trick' or 'hand').
+        """
+
+    def record_hand(self, game):
+        """
+        Called at the end of each hand, once the scores are updated, so that the hand can be logged
+        (see Game.dealt, Game.passed, Game.plays, and Game.trick_winners, and replay.py).
+        """
+
+class SyncSink(EventSink):
+    """
+    Sink for running games synchronously in-process. Messages and hands are ignored (or given to
+    the on_message and on_hand callbacks) and delayed calls are queued until run() is called.
+    """
+    def __init__(self, on_message=None, on_hand=None):
+        self.on_message = on_message # called with the same arguments as send() if not None
+        self.on_hand = on_hand # called with the same arguments as record_hand() if not None
+        self.pending = collections.deque() # delayed calls waiting to be run
+
+    def send(self, game, sid, event, args, seq):
+        if self.on_message is not None: self.on_message(game, sid, event, args, seq)
+
+    def record_hand(self, game):
+        if self.on_hand is not None: self.on_hand(game)
+
+    def call_later(self, game, callback, pause):
+        self.pending.append(callback)
+
+    def run(self):
+        """Runs all delayed calls (including any delayed calls they make) without pausing."""
+        while self.pending: self.pending.popleft()()
+
+
+class Player:
+    """A single player in the game."""
+    def __init__(self, game, num, uid, sid, name):
+        self.game = game # the Game this player is in
+        self.num = num # player number (0-4)
+        self.uid = uid # user identifier for this player
+        self.sid = sid # socket.io identifier for this player
+        self.disconnected = False # True if the player has disconnected
+        self.disconnected_time = 0 # time.monotonic() when the player last disconnected
+        self.bot = False # True if this is a computer player (see bots.py), they never receive messages
+        self.name = name # name displayed for this player
+        self.hand = 0 # current hand of cards for this player (a mask of card bits, see cards.py)
+        self.pending_trade = None # list of cards being traded (each a string like 'c5')
+        self.turn = False # True if this player is currently playing a card
+
+    def emit(self, event, *args):
+        """
+        Sends a message to this player (and only this player) through the game's sink. Messages to
+        a disconnected player are only kept in the history for when they rejoin.
+        """
+        if self.bot: return
+        game = self.game
+        game.version += 1
+        game.history.append((game.version, self, event, args))
+        if not self.disconnected: game.sink.send(game, self.sid, event, args, game.version)
+
+
+class Game:
+    """A single game being player by 4 people."""
+    def __init__(self, name, sink=None):
+        self.name = name # unique name for this game
+        self.sink = sink or EventSink() # where messages and delayed calls go (see EventSink)
+        self.state = 'waiting' # state of the game, one of waiting, trading, playing, or ended
+        self.players = [] # list of players in this game (each Player object)
+        self.sid2player = {} # dictionary of socket.io identifiers to their Player object
+        self.hand_num = 0 # number of hands played or currently being played in this game
+        self.score0 = 0 # number of points 0/2 team has overall
+        self.score1 = 0 # number of points 1/3 team has overall
+        self.version = 0 # sequence number of the last message sent, increases with every message
+        self.history = collections.deque(maxlen=HISTORY_SIZE) # recent messages as (seq, Player or None for everyone, event, args)
+
+        # current hand info
+        self.hearts_broken = False # if hearts have been broken in this hand so far
+        self.num_tricks0 = -1 # number of tricks taken by the 0/2 team this hand
+        self.num_tricks1 = -1 # number of tricks taken by the 1/3 team this hand
+        self.hand_score0 = -1 # number of points taken by the 0/2 team this hand
+        self.hand_score1 = -1 # number of points taken by the 1/3 team this hand
+        self.dealt = None # mask of the cards dealt to each player this hand (None if not known, like after restoring an old snapshot)
+        self.passed = [0, 0, 0, 0] # mask of the cards traded away by each player this hand
+        self.plays = bytearray() # index in DECK of each card played this hand, in order
+        self.trick_winners = bytearray() # player number that took each trick this hand
+
+        # current trick info
+        self.trick_start_player = None # player who started the current trick (Player object)
+        self.trick_cards = [] # cards played in this trick so far (each a string like 'c5')
+        self.trick_mask = 0 # mask of the cards played in this trick so far
+        self.last_trick = [] # last trick of cards played
+        self.delayed = None # delayed callback waiting to be called as (method, args) or None
+        self.last_active = time.monotonic() # time of the last activity in this game (kept up to date by the server)
+
+    def emit(self, event, *args):
+        """
+        Sends a message to all (connected) players in this game through the game's sink. Since
+        everyone gets it, it is public and also goes to the spectators.
+        """
+        self.version += 1
+        self.history.append((self.version, None, event, args))
+        for p in self.players:
+            if not p.disconnected and not p.bot: self.sink.send(self, p.sid, event, args, self.version)
+        self.sink.publish(self, event, args, self.version)
+
+    def publish(self, event, *args):
+        """
+        Sends a message to just the spectators, for the public parts of the messages that are
+        different for each player. These are 'start_game' with the player names, 'start_hand' with
+        the hand number, and 'finish_trade' with nothing.
+        """
+        self.sink.publish(self, event, args, self.version)
+
+    def missed(self, p, last_seq):
+        """
+        Gets the messages sent to a player after the given sequence number as a list of (seq, event,
+        args). Returns None if they are not all in the history anymore (or last_seq is invalid).
+        """
+        if type(last_seq) is not int or not 0 <= last_seq <= self.version: return None
+        if last_seq < self.version and (not self.history or self.history[0][0] > last_seq + 1): return None
+        return [(seq, event, args) for seq, to, event, args in self.history
+                if seq > last_seq and (to is None or to is p)]
+
+    def call_later(self, method, *args):
+        """
+        Calls one of this game's methods after a short delay. Only one call can be delayed at a time
+        and it is saved as part of the game (see snapshot() and resume()).
+        """
+        self.delayed = (method, args)
+        self._schedule_delayed()
+
+    def _schedule_delayed(self):
+        pause = 'trick' if self.delayed[0] == self._end_trick_delayed else 'hand'
+        self.sink.call_later(self, self._call_delayed, pause)
+
+    def _call_delayed(self):
+        method, args = self.delayed
+        self.delayed = None
+        method(*args)
+
+    def resume(self):
+        """Schedules the delayed call of a game that was just restored (if there is one)."""
+        if self.delayed is not None: self._schedule_delayed()
+
+    def snapshot(self):
+        """
+        Gets the complete state of the game in a compact binary form. The game can be recreated
+        with Game.restore(). See the _GAME_STRUCT and _PLAYER_STRUCT for the layout, after the game
+        struct are the version (_SEQ_STRUCT), the cards in the trick, the cards in the last trick,
+        and the name of the game then for each player the player struct, the cards pending trade (if there are any), the uid
+        and the name. At the end is the history of the hand: the _HAND_STRUCT, the cards played,
+        and the player number that took each trick (both as lists of bytes). Lists of cards are a
+        byte with the number of cards followed by a byte with the index of each card in the DECK.
+        Strings are a 4-byte length followed by UTF-8.
+        """
+        delayed, delayed_num = 0, -1
+        if self.delayed is not None:
+            method, args = self.delayed
+            if method == self._end_trick_delayed: delayed, delayed_num = 1, args[0].num
+            elif method == self._end_hand_delayed: delayed = 2
+        trick_start = -1 if self.trick_start_player is None else self.trick_start_player.num
+        data = [_GAME_STRUCT.pack(SNAPSHOT_VERSION, STATES.index(self.state), self.hand_num,
+                                  self.score0, self.score1, self.hearts_broken,
+                                  self.num_tricks0, self.num_tricks1, self.hand_score0,
+                                  self.hand_score1, trick_start, delayed, delayed_num,
+                                  len(self.players)),
+                _SEQ_STRUCT.pack(self.version), _pack_cards(self.trick_cards), _pack_cards(self.last_trick), _pack_str(self.name)]
+        for p in self.players:
+            flags = (1 if p.turn else 0) | (2 if p.pending_trade is not None else 0) | (4 if p.bot else 0)
+            data.append(_PLAYER_STRUCT.pack(p.num, flags, p.hand))
+            if p.pending_trade is not None: data.append(_pack_cards(p.pending_trade))
+            data += (_pack_str(p.uid), _pack_str(p.name))
+        data += (_HAND_STRUCT.pack(*(self.dealt or (0, 0, 0, 0)), *self.passed),
+                 bytes((len(self.plays),)), self.plays, bytes((len(self.trick_winners),)), self.trick_winners)
+        return b''.join(data)
+
+    @classmethod
+    def restore(cls, data, sink=None):
+        """
+        Recreates a game from the data returned by snapshot(). Since none of the players can still
+        be connected, all of them (except computer players) are marked as disconnected so that they
+        rejoin the game. Call resume() to continue a delayed call.
+        """
+        (version, state, hand_num, score0, score1, hearts_broken, num_tricks0, num_tricks1,
+         hand_score0, hand_score1, trick_start, delayed, delayed_num,
+         num_players) = _GAME_STRUCT.unpack_from(data)
+        if not 1 <= version <= SNAPSHOT_VERSION: raise ValueError(f'unknown snapshot version {version}')
+        pos, seq = _GAME_STRUCT.size, 0
+        if version >= 2:
+            seq, = _SEQ_STRUCT.unpack_from(data, pos)
+            pos += _SEQ_STRUCT.size
+        trick_cards, pos = _unpack_cards(data, pos)
+        last_trick, pos = _unpack_cards(data, pos)
+        name, pos = _unpack_str(data, pos)
+
+        game = cls(name, sink)
+        game.state = STATES[state]
+        game.hand_num, game.score0, game.score1 = hand_num, score0, score1
+        game.version = seq # the history is empty so players that rejoin get the complete state
+        game.hearts_broken = hearts_broken
+        game.num_tricks0, game.num_tricks1 = num_tricks0, num_tricks1
+        game.hand_score0, game.hand_score1 = hand_score0, hand_score1
+        game.trick_cards, game.trick_mask = trick_cards, cards_mask(trick_cards)
+        game.last_trick = last_trick
+        for _ in range(num_players):
+            num, flags, hand = _PLAYER_STRUCT.unpack_from(data, pos)
+            pos += _PLAYER_STRUCT.size
+            pending_trade = None
+            if flags & 2: pending_trade, pos = _unpack_cards(data, pos)
+            uid, pos = _unpack_str(data, pos)
+            player_name, pos = _unpack_str(data, pos)
+            sid = f'{name}#{num}' # placeholder until the player rejoins
+            p = game.sid2player[sid] = Player(game, num, uid, sid, player_name)
+            p.bot = bool(flags & 4)
+            p.disconnected, p.disconnected_time = not p.bot, time.monotonic()
+            p.hand, p.pending_trade, p.turn = hand, pending_trade, bool(flags & 1)
+            game.players.append(p)
+        if trick_start >= 0: game.trick_start_player = game.players[trick_start]
+        if delayed == 1: game.delayed = (game._end_trick_delayed, (game.players[delayed_num],))
+        elif delayed == 2: game.delayed = (game._end_hand_delayed, ())
+        if version >= 3:
+            hand = _HAND_STRUCT.unpack_from(data, pos)
+            pos += _HAND_STRUCT.size
+            if any(hand[:4]): game.dealt = list(hand[:4])
+            game.passed = list(hand[4:])
+            game.plays = bytearray(data[pos+1:pos+1+data[pos]])
+            pos += 1 + data[pos]
+            game.trick_winners = bytearray(data[pos+1:pos+1+data[pos]])
+        return game
+
+    def player(self, sid):
+        """Gets a player object from the socket.io identifier for the user."""
+        return self.sid2player[sid]
+
+    def join(self, uid, sid, name, bot=False):
+        """
+        Called when a player initially joins the game. If this is the fourth player to join, then
+        this emits special messages to get the game going.
+
+        Arguments:
+          sid  - socket.io identifier for the user joining the game
+          uid  - user identifier for this user
+          name - the player's display name
+          bot  - True if this is a computer player (see add_bot())
+        
+        Returns:
+          'full' if the user cannot join the game. Tuple of 'joined' and list of other player names
+          when successfully joining.
+
+        Messages emitted:
+          On success, this emits the 'joined' message with the new player name. If this causes the
+          game to start, this will emit 'select_partner' to player number 0 (with a list of all
+          player names except player number 0) and 'pause' to all other players.
+        """
+        num_players = len(self.players)
+        if sid in self.sid2player or (num_players >= 4 or self.state != 'waiting'): return 'full'
+        others = [p.name for p in self.players]
+        player = self.sid2player[sid] = Player(self, num_players, uid, sid, name)
+        player.bot = bot
+        self.players.append(player)
+        if not bot: self.sink.enter(self, sid)
+        self.emit('joined', name)
+        if player.num == 3:
+            options = self.players[1:]
+            self.players[0].emit('select_partner', [p.name for p in options])
+            for p in options: p.emit('pause')
+        return 'joined', others
+
+    def add_bot(self):
+        """
+        Called to add a computer player to the game. Computer players join just like other players
+        (see join()) except that they never receive messages, their moves are made by the server
+        (see bots.py) calling trade() and play_card() with their sid.
+
+        Returns:
+          The same as join().
+        """
+        num = sum(p.bot for p in self.players) + 1
+        sid = f'{self.name}#bot{num}'
+        return self.join(sid, sid, f'Computer {num}', bot=True)
+
+    def rename(self, sid, name):
+        """
+        Called to rename a player.
+
+        Arguments:
+          sid  - socket.io identifier for the user being renamed
+          name - the player's display name
+        
+        Messages emitted:
+          If the name changed this emits 'renamed' with the name and player's number (0-4).
+        """
+        p = self.player(sid)
+        if p.name != name:
+            p.name = name
+            self.emit('renamed', name, p.num)
+
+    def rejoin(self, old_sid, new_sid, last_seq=None):
+        """
+        Called to have a player rejoin the game (after disconnect/refresh).
+
+        Arguments:
+          old_sid  - old socket.io identifier for the user
+          new_sid  - new socket.io identifier for the user
+          last_seq - sequence number of the last message the user received (None if they have no
+                     state, like after a refresh)
+
+        Returns:
+          If all of the messages the user missed since last_seq are still in the history, they are
+          sent again (with their original sequence numbers) and this returns 'resumed' and the
+          current version. Otherwise this returns the complete state of the game: see refresh() but
+          this return value has the additional string 'rejoined' and the current version at the
+          beginning.
+        
+        Messages emitted:
+          The missed messages (if resuming) followed by the 'rejoined' message with the player's
+          number (0-4).
+        """
+        p = self.player(old_sid)
+        missed = self.missed(p, last_seq)
+        del self.sid2player[old_sid]
+        self.sid2player[new_sid] = p
+        p.sid = new_sid
+        p.disconnected = False # p.disconnected should be False before this
+        self.sink.leave(self, old_sid)
+        self.sink.enter(self, new_sid)
+        if missed is not None:
+            for seq, event, args in missed: self.sink.send(self, new_sid, event, args, seq)
+        self.emit('rejoined', p.num)
+        if missed is not None: return 'resumed', self.version
+        return ('rejoined', self.version) + self.refresh(new_sid)
+
+    def refresh(self, sid=None):
+        """
+        Called to have a player refresh their data about the game. Without a sid this gets the
+        public view of the game for spectators: the player number and pending trade are None and
+        instead of the list of cards in hand it has the number of cards in each player's hand.
+
+        Arguments:
+          sid - socket.io identifier for the user (or None)
+
+        Returns:
+          Depending on the current state, this returns one of the following sets of data:
+            'waiting', player names (length 1-4)
+            'trading', ", ", player number (0-4), list of disconnected players, hand # (1+), 0/2
+                team score, 1/3 team score, list of cards in hand, list of pending trade cards (or
+                None), list of players who have traded
+            'playing', ", ", ", ", ", ", if hearts broken, 0/2 team # tricks, 1/3 team # tricks,
+                trick start player num, list of cards in trick so far, list of cards in last trick
+            'ended', ", ", ", score for 0/2, score for 1/3
+        """
+        names = [p.name for p in self.players]
+        me = None if sid is None else self.player(sid)
+        data = (self.state, names)
+        if self.state != 'waiting':
+            data += (None if me is None else me.num, [p.disconnected for p in self.players], self.hand_num,
+                     self.score0, self.score1,
+                     [p.hand.bit_count() for p in self.players] if me is None else mask_cards(me.hand))
+        if self.state == 'trading':
+            data += (None if me is None else me.pending_trade, [p.pending_trade is not None for p in self.players])
+        elif self.state == 'playing':
+            data += (self.hearts_broken, self.num_tricks0, self.num_tricks1,
+                     self.trick_start_player.num, self.trick_cards, self.last_trick)
+        elif self.state == 'ended':
+            data += (self.score0, self.score1)
+        return data
+
+    def disconnected(self, sid):
+        """
+        Called when a player disconnects form the game.
+
+        Arguments:
+          sid - socket.io identifier for the user
+
+        Returns:
+          True if there are no longer any connected players (other than computer players) in this
+          game, False otherwise.
+
+        Messages emitted:
+          Emits the 'disconnected' message with the player number (0-4) to the remaining players.
+        """
+        p = self.player(sid)
+        self.sink.leave(self, sid)
+        if self.state == 'waiting':
+            self.players.remove(p)
+            del self.sid2player[sid]
+            self.emit('disconnected', p.name)
+            return all(p.bot for p in self.players)
+        else:
+            p.disconnected, p.disconnected_time = True, time.monotonic()
+            self.emit('disconnected', p.num)
+            return all(p.disconnected or p.bot for p in self.players)
+
+    def partner_selected(self, partner_num):
+        other_partner_nums = sorted({1,2,3}-{partner_num})
+        new_player_order = [0, other_partner_nums[0], partner_num, other_partner_nums[1]]
+        self.players = [self.players[i] for i in new_player_order]
+        names = [p.name for p in self.players]
+        for i, p in enumerate(self.players):
+            p.num = i
+            p.emit('start_game', i, names)
+        self.publish('start_game', names)
+        self.start_hand()
+
+    def start_hand(self):
+        """
+        Starts a hand. This shuffles the deck, deals 13 cards to each player, and then either
+        leads into trading or playing the first time (if the hand number is a multiple of 4).
+
+        The game's state after this method is called is either 'trading' or 'playing' depending on
+        the hand number.
+
+        Messages emitted:
+          Emits a unique 'start_hand' message to each player that contains the a list of the cards
+          (as strings like 'c5') dealt to that player and the number of the hand (with the first
+          hand being #1).
+
+          If the hand number is a multiple of 4 then there is no trading and this emits the
+          'finish_trading' message with two empty lists (see trade() for more details). This also
+          calls start_hand_after_trade() in this case which emits more messages.
+        """
+        hands = self.deal()
+        self.hand_num += 1
+        self.hearts_broken = False
+        self.num_tricks0 = self.num_tricks1 = 0
+        self.hand_score0 = self.hand_score1 = 0
+        self.trick_cards = []
+        self.trick_mask = 0
+        self.last_trick = []
+        self.dealt = [cards_mask(cards) for cards in hands]
+        self.passed = [0, 0, 0, 0]
+        self.plays = bytearray()
+        self.trick_winners = bytearray()
+        for p, cards in zip(self.players, hands):
+            p.hand = cards_mask(cards)
+            p.emit('start_hand', cards, self.hand_num)
+        self.publish('start_hand', self.hand_num)
+        if self.hand_num % 4 == 0:
+            # every fourth hand there is no trading
+            self.emit('finish_trade', [], [])
+            self.start_hand_after_trade()
+        else:
+            self.state = 'trading'
+    
+    def deal(self):
+        """
+        Shuffles the deck and gets the list of 13 cards dealt to each player (in player number
+        order). Replays override this to deal the recorded cards.
+        """
+        deck = random.sample(DECK, k=52)
+        return [deck[i*13:(i+1)*13] for i in range(4)]
+
+    def trade(self, sid, cards):
+        """
+        Called to indicate that a player has decided to trade the given list of cards.
+
+        Arguments:
+          sid   - socket.io identifier for the user trading the cards
+          cards - the list of cards being traded by the player (each card is a string like 'c5')
+
+        Returns:
+          'invalid' if the trade is invalid and 'pending' if the trade will be success once all
+          players have submitted their trades.
+
+        Messages emitted:
+          On a non-invalid (pending) trade this emits the 'traded' message with the player number
+          (0-4) to all players in the game.
+
+          If this is the fourth and final trade for the hand then this emits a unique
+          'finish_trade' message to each player with a list of cards that they gave and a list of
+          cards they received (each card is a string like 'c5'). This also calls
+          start_hand_after_trade() in this case which emits more messages.
+        """
+        p = self.player(sid)
+        if self.state != 'trading' or p.pending_trade is not None or type(cards) is not list or len(cards) != 3:
+            return 'invalid'
+        mask = cards_mask(cards) # anything that isn't a card is left out so it has to be 3 different cards
+        if mask.bit_count() != 3 or mask & ~p.hand: return 'invalid'
+        p.pending_trade = mask_cards(mask) # not the caller's list
+        self.emit('traded', p.num)
+        if all(p.pending_trade is not None for p in self.players):
+            # done trading - actually execute them
+            trading = [self.players[i].pending_trade for i in TRADING[self.hand_num % 4]]
+            for p, trade in zip(self.players, trading):
+                p.emit('finish_trade', p.pending_trade, trade)
+                self.passed[p.num] = cards_mask(p.pending_trade)
+                p.hand = p.hand & ~self.passed[p.num] | cards_mask(trade)
+                p.pending_trade = None
+            self.publish('finish_trade')
+            self.start_hand_after_trade()
+        return 'pending'
+
+    def start_hand_after_trade(self):
+        """
+        Starts a hand after the trading has been completed for the hand. This calls start_trick()
+        with the player who has the 2 of clubs.
+
+        The game's state after this method is called is always 'playing'.
+
+        Messages emitted:
+          Emits no messages on its own, but calls start_trick() which indirectly does as well.
+        """
+        p = next(p for p in self.players if p.hand & TWO_OF_CLUBS)
+        self.start_trick(p)
+        self.state = 'playing'
+
+    def start_trick(self, p):
+        """
+        Starts a trick with the given player as the player who will play the first card.
+
+        Arguments:
+          p - Player object for player who is playing the first card of the trick
+
+        Messages emitted:
+          Emits no messages on its own, but calls start_turn() which does.
+        """
+        self.trick_start_player = p
+        self.trick_cards = []
+        self.trick_mask = 0
+        self.start_turn(p)
+
+    def start_turn(self, p):
+        """
+        Starts a player's turn during a trick.
+
+        Arguments:
+          p - Player object for player whose turn it is
+
+        Messages emitted:
+          Emits the 'start_turn' message with the player's number (0-4) whose turn it is to
+          everyone in the game.
+        """
+        p.turn = True
+        self.emit('start_turn', p.num)
+
+    def playable(self, p):
+        """Gets the mask of the cards the given player could play in the current trick."""
+        led = SUIT_MASKS[self.trick_cards[0][0]] if self.trick_cards else 0
+        return legal_plays(p.hand, led, self.hearts_broken)
+
+    def play_card(self, sid, card):
+        """
+        Called when a player plays a card. Checks the card for validity and then moves the game
+        along by calling either start_turn() or end_trick().
+
+        Arguments:
+          sid  - socket.io identifier for the user playing the card
+          card - the card to play as a string like 'c5'
+
+        Returns:
+          'invalid' if the card is invali and 'played' if the card can be played
+
+        Messages emitted:
+          If the played card is valid this emits the 'card_played' message with the card played
+          (as a string like 'c5') and the player's number (0-4) who played the card.
+
+          This also indirectly causes messsages to be emitted through the start_turn() or
+          end_trick() calls.
+        """
+        p = self.player(sid)
+        bit = card_bit(card)
+        if self.state != 'playing' or not p.turn or not bit & self.playable(p): return 'invalid'
+
+        p.turn = False
+        p.hand &= ~bit
+        self.trick_cards.append(card)
+        self.trick_mask |= bit
+        self.plays.append(CARD_INDICES[card])
+        if bit & POINT_CARDS: self.hearts_broken = True
+        self.emit('card_played', card, p.num)
+
+        if len(self.trick_cards) == 4:
+            self.end_trick()
+        else:
+            self.start_turn(self.players[(p.num + 1) % 4])
+        return 'played'
+
+    def end_trick(self):
+        """
+        Ends a trick and adds the appropriate amount of points to one of the teams. This ends up
+        calling either end_hand() or start_trick() based on where in the hand it is.
+
+        Messages emitted:
+          Emits the 'end_trick' message (after a short delay) with the player number (0-4) for the
+          player who took the trick.
+
+          This also indirectly causes messsages to be emitted through the start_trick() or
+          end_hand() calls (both of which are only called after a delay).
+        """
+        led = SUIT_MASKS[self.trick_cards[0][0]]
+        self.last_trick = self.trick_cards[:]
+        high_card = highest_card(self.trick_mask & led)
+        index = self.trick_cards.index(high_card)
+        p = self.players[(index + self.trick_start_player.num) % 4]
+        points = count_points(self.trick_mask)
+        self.trick_winners.append(p.num)
+        if p.num in (0, 2):
+            self.num_tricks0 += 1
+            self.hand_score0 += points
+        else:
+            self.num_tricks1 += 1
+            self.hand_score1 += points
+        self.call_later(self._end_trick_delayed, p)
+    
+    def _end_trick_delayed(self, p):
+        """
+        The last portion of end_trick() that is delayed a few seconds before running.
+        """
+        self.emit('end_trick', p.num)
+        if not p.hand:
+            self.end_hand()
+        else:
+            self.start_trick(p)
+
+    def end_hand(self):
+        """
+        Ends a hand, tallies up the scores, and starts a new hand (if the game is still going)
+        or ends the game.
+
+        Messages emitted:
+          Emits the 'end_hand' message (after a delay) with the total scores for the 0/2 and 1/3
+          teams.
+
+          This also indirectly causes messsages to be emitted through the start_hand() or
+          end_game() calls (both of which are only called after a delay).
+
+        The finished hand is given to the sink's record_hand() right away (unless the game was
+        restored from an old snapshot in the middle of the hand).
+        """
+        score0, score1 = self.hand_score0, self.hand_score1
+        if score0 == 26:
+            score0, score1 = 0, 36
+        elif score1 == 26:
+            score0, score1 = 36, 0
+        self.score0 += score0
+        self.score1 += score1
+        if self.dealt is not None: self.sink.record_hand(self)
+        self.call_later(self._end_hand_delayed)
+    
+    def _end_hand_delayed(self):
+        """
+        The last portion of end_hand() that is delayed a few seconds before running.
+        """
+        self.emit('end_hand', self.score0, self.score1)
+        if (self.score0 > SCORE_TO_WIN or self.score1 > SCORE_TO_WIN) and self.score0 != self.score1:
+            self.end_game()
+        else:
+            self.start_hand()
+
+    def end_game(self):
+        """
+        Ends a game. Sets the state to "ended" and sends out the final messages.
+
+        Messages emitted:
+          Emits the 'end_game' message with the total scores for the 0/2 and 1/3 teams.
+        """
+        self.state = 'ended'
+        self.emit('end_game', self.score0, self.score1)
+
+
+def random_trade(game, p):
+    """Trading policy for play_game() that picks three random cards."""
+    return random.sample(mask_cards(p.hand), 3)
+
+def random_card(game, p):
+    """Playing policy for play_game() that picks a random legal card."""
+    return random.choice(mask_cards(game.playable(p)))
+
+def play_game(choose_trade=random_trade, choose_card=random_card, partner_num=2, sink=None):
+    """
+    Plays an entire game synchronously and returns the ended Game. The policies are called with the
+    game and the Player whose choice it is and return the list of 3 cards to trade or the card to
+    play (as strings like 'c5'). Player i has the sid i.
+    """
+    sink = sink or SyncSink()
+    game = Game('simulated-game', sink)
+    for i in range(4): game.join(f'player{i}', i, f'Player {i}')
+    game.partner_selected(partner_num)
+    sink.run()
+    while game.state != 'ended':
+        if game.state == 'trading':
+            for p in game.players:
+                if game.trade(p.sid, choose_trade(game, p)) == 'invalid':
+                    raise ValueError(f'invalid trade by player {p.num}')
+        else:
+            p = next(p for p in game.players if p.turn)
+            if game.play_card(p.sid, choose_card(game, p)) == 'invalid':
+                raise ValueError(f'invalid card played by player {p.num}')
+        sink.run()
+    return game
@@ -0,0 +1,48 @@
+"""
+Token buckets for rate limiting the socket.io events of each connection and each client address.
+
+Each key (like a socket.io identifier or an IP address) has a bucket that holds up to burst tokens
+and is refilled at rate tokens per second. Every event takes some tokens (more for expensive events)
+and is rejected when there aren't enough. Buckets only store the tokens and the time they were last
+updated and are refilled when they are next used, so checking an event is a dictionary lookup and a
+little arithmetic. Buckets that have refilled completely are the same as no bucket and are dropped
+by prune().
+"""
+
+import time
+
+
+class TokenBuckets:
+    """A token bucket for each key, see the module documentation. A rate of 0 allows everything."""
+    def __init__(self, rate, burst):
+        self.rate = rate # tokens added to each bucket per second
+        self.burst = burst # maximum number of tokens in each bucket
+        self.buckets = {} # [tokens, time.monotonic() of the last update] for each key
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def take(self, key, cost=1):
+        """Takes tokens from the bucket of a key, returns False if there aren't enough."""
+        if self.rate <= 0: return True
+        now = time.monotonic()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [self.burst, now]
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] < cost: return False
+        bucket[0] -= cost
+        return True
+
+    def remove(self, key):
+        """Removes the bucket of a key (like when a connection closes)."""
+        self.buckets.pop(key, None)
+
+    def prune(self):
+        """Removes the buckets that have refilled completely."""
+        now = time.monotonic()
+        full = [key for key, (tokens, last) in self.buckets.items()
+                if tokens + (now - last) * self.rate >= self.burst]
+        for key in full: del self.buckets[key]
@@ -0,0 +1,310 @@
+"""
+Load generator for the server: simulated players that drive real socket.io connections.
+
+Starts the given number of clients (in tables of four) that each join a game, pick a partner,
+trade, and play legal cards (using the same rules as the server) as fast as the server lets them.
+At the end it reports the events per second, the latency of the acknowledgements for each kind of
+request, and (if the server's process id is given) the server's CPU and memory use. Each game can
+also have simulated spectators (--spectators) that just count what they are sent.
+
+The server should be started with --time_scale=0 so that there is no pause after every trick and
+hand and without the limits for each client address (all of the clients come from the same address).
+For example:
+
+    python3 server.py --time_scale=0 --address_rate=0 --max_games_per_address=0 &
+    python3 loadtest.py --clients 400 --duration 60 --pid $!
+
+To compare the server backends (see the backend and uvloop options of server.py) with the same
+load, --compare starts the server with each of the given backends in turn (on the port of --url),
+runs the load against it, and prints the results side by side:
+
+    python3 loadtest.py --clients 400 --duration 60 --compare tornado,asgi,asgi+uvloop
+
+This requires the socket.io client with asyncio support:
+
+    pip3 install "python-socketio[asyncio_client]"
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import time
+from urllib.parse import urlsplit
+
+import socketio
+from socketio.exceptions import SocketIOError
+
+from cards import SUIT_MASKS, POINT_CARDS, card_bit, cards_mask, mask_cards, legal_plays
+import wire
+
+
+# The server.py arguments for each backend that --compare can start
+BACKENDS = {
+    'tornado': ['--backend=tornado'],
+    'tornado+uvloop': ['--backend=tornado', '--uvloop'],
+    'asgi': ['--backend=asgi'],
+    'asgi+uvloop': ['--backend=asgi', '--uvloop'],
+}
+
+
+class Stats:
+    """Statistics collected by all of the simulated players."""
+    def __init__(self):
+        self.events = 0 # number of events received from the server
+        self.requests = 0 # number of requests sent to the server
+        self.latencies = {} # the latencies of the acknowledgements, key is the event name
+        self.invalid = 0 # number of requests the server said were invalid
+        self.errors = 0 # number of clients that failed (connection errors, timeouts, ...)
+        self.games = 0 # number of games played to the end
+        self.watched = 0 # number of public events (or public views of games) received by spectators
+
+    def ack(self, event, latency):
+        self.requests += 1
+        self.latencies.setdefault(event, []).append(latency)
+
+def percentile(values, p):
+    """Gets a percentile of a sorted list of values."""
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class Bot:
+    """A single simulated player connected with its own socket."""
+    def __init__(self, stats, url, game, name):
+        self.stats = stats
+        self.url = url
+        self.game = game # name of the game
+        self.uid = f'{game}-{name}'
+        self.name = name
+        self.num = -1 # player number (0-3) once the game starts
+        self.hand = 0 # mask of the cards in the hand
+        self.trick = [] # cards played in the current trick
+        self.hearts_broken = False
+        self.done = asyncio.Event() # set when the game is over
+        self.sio = socketio.AsyncClient(reconnection=False)
+        self.sio.on('batch', self.on_batch)
+
+    async def connect(self):
+        await self.sio.connect(f'{self.url}?game={self.game}', socketio_path='/game-io/',
+                               transports=['websocket'])
+
+    async def call(self, event, *args):
+        """Sends a request to the server, recording how long the acknowledgement takes."""
+        start = time.perf_counter()
+        result = await self.sio.call(event, args, timeout=60)
+        self.stats.ack(event, time.perf_counter() - start)
+        if result == 'invalid': self.stats.invalid += 1
+        return result
+
+    def act(self, coro):
+        """Runs an action after the current batch of events is handled."""
+        task = asyncio.ensure_future(coro)
+        task.add_done_callback(self.check_error)
+
+    def check_error(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            self.stats.errors += 1
+            self.done.set()
+
+    def on_batch(self, batch):
+        if isinstance(batch, bytes): batch = wire.decode_batch(batch)
+        for event, args, _ in batch:
+            self.stats.events += 1
+            handler = getattr(self, 'on_' + event, None)
+            if handler is not None: handler(*args)
+
+    def on_select_partner(self, names):
+        self.act(self.sio.emit('partner_selected', random.randint(1, 3)))
+
+    def on_start_game(self, num, names):
+        self.num = num
+
+    def on_start_hand(self, cards, hand_num):
+        self.hand = cards_mask(cards)
+        self.hearts_broken = False
+        if hand_num % 4 != 0:
+            self.act(self.call('trade', random.sample(mask_cards(self.hand), 3)))
+
+    def on_finish_trade(self, given, received):
+        self.hand = self.hand & ~cards_mask(given) | cards_mask(received)
+
+    def on_start_turn(self, num):
+        if num == self.num:
+            led = SUIT_MASKS[self.trick[0][0]] if self.trick else 0
+            card = random.choice(mask_cards(legal_plays(self.hand, led, self.hearts_broken)))
+            self.hand &= ~card_bit(card)
+            self.act(self.call('play_card', card))
+
+    def on_card_played(self, card, num):
+        self.trick.append(card)
+        if card_bit(card) & POINT_CARDS: self.hearts_broken = True
+
+    def on_end_trick(self, winner):
+        self.trick = []
+
+    def on_end_game(self, score0, score1):
+        if self.num == 0: self.stats.games += 1
+        self.done.set()
+
+
+class Spectator:
+    """A single simulated spectator watching a game with its own socket."""
+    def __init__(self, stats, url, game):
+        self.stats = stats
+        self.url = url
+        self.game = game # name of the game
+        self.sio = socketio.AsyncClient(reconnection=False)
+        self.sio.on('watch', self.on_watch)
+        self.sio.on('watch_state', self.on_watch_state)
+
+    async def watch(self, protocol):
+        await self.sio.connect(f'{self.url}?game={self.game}', socketio_path='/game-io/',
+                               transports=['websocket'])
+        start = time.perf_counter()
+        await self.sio.call('watch', (self.game, protocol), timeout=60)
+        self.stats.ack('watch', time.perf_counter() - start)
+
+    def on_watch(self, batch):
+        if isinstance(batch, bytes): batch = wire.decode_batch(batch)
+        self.stats.watched += len(batch)
+
+    def on_watch_state(self, *state):
+        self.stats.watched += 1
+
+
+async def table(stats, args, name, deadline):
+    """Plays games with four bots until the deadline (at least one game)."""
+    game_num = 0
+    while True:
+        bots = [Bot(stats, args.url, f'{name}-g{game_num}', f'p{i}') for i in range(4)]
+        spectators = [Spectator(stats, args.url, f'{name}-g{game_num}') for _ in range(args.spectators)]
+        try:
+            for bot in bots: # join one at a time so the seats are in order
+                await bot.connect()
+                await bot.call('join', bot.uid, bot.game, bot.name, None, args.protocol)
+            await asyncio.gather(*(spectator.watch(args.protocol) for spectator in spectators))
+            await asyncio.wait_for(asyncio.gather(*(bot.done.wait() for bot in bots)), args.timeout)
+        except (SocketIOError, asyncio.TimeoutError, OSError):
+            stats.errors += 1
+        finally:
+            for client in bots + spectators: await client.sio.disconnect()
+        game_num += 1
+        if time.monotonic() >= deadline: break
+
+def process_usage(pid):
+    """Gets the CPU time (in seconds), the current RSS, and peak RSS (in kB) of a process."""
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    with open(f'/proc/{pid}/status') as f:
+        status = dict(line.split(':', 1) for line in f)
+    return cpu, int(status['VmRSS'].split()[0]), int(status['VmHWM'].split()[0])
+
+async def main(args):
+    stats = Stats()
+    run_id = '%06x' % random.getrandbits(24)
+    usage_start = process_usage(args.pid) if args.pid else None
+    start = time.monotonic()
+    deadline = start + args.duration
+    tables = []
+    for t in range(args.clients // 4):
+        tables.append(asyncio.ensure_future(table(stats, args, f'load{run_id}-t{t}', deadline)))
+        if args.ramp: await asyncio.sleep(args.ramp / (args.clients // 4))
+    await asyncio.gather(*tables)
+    elapsed = time.monotonic() - start
+
+    results = {
+        'clients': args.clients, 'spectators': args.spectators, 'seconds': elapsed, 'games': stats.games,
+        'events': stats.events, 'watched': stats.watched, 'requests': stats.requests, 'invalid': stats.invalid,
+        'errors': stats.errors, 'events_per_sec': (stats.events + stats.requests) / elapsed,
+        'latency_ms': {},
+    }
+    for event, latencies in sorted(stats.latencies.items()):
+        latencies.sort()
+        results['latency_ms'][event] = {
+            p: 1000 * percentile(latencies, int(p[1:])) for p in ('p50', 'p90', 'p99')}
+        results['latency_ms'][event]['max'] = 1000 * latencies[-1]
+    if usage_start is not None:
+        cpu, rss, peak_rss = process_usage(args.pid)
+        results['server'] = {'cpu_percent': 100 * (cpu - usage_start[0]) / elapsed,
+                             'rss_kb': rss, 'peak_rss_kb': peak_rss}
+
+    print(f"{args.clients} clients played {stats.games} games in {elapsed:.1f} seconds")
+    print(f"{results['events_per_sec']:.0f} events/sec ({stats.events} received, "
+          f"{stats.requests} requests, {stats.invalid} invalid, {stats.errors} errors)")
+    if args.spectators:
+        print(f"{args.spectators * (args.clients // 4)} spectators received {stats.watched} public events")
+    for event, latency in results['latency_ms'].items():
+        print(f"  {event:12} " + '  '.join(f'{p} {ms:7.2f}ms' for p, ms in latency.items()))
+    if 'server' in results:
+        server = results['server']
+        print(f"server: {server['cpu_percent']:.0f}% CPU, {server['rss_kb']} kB RSS "
+              f"({server['peak_rss_kb']} kB peak)")
+    if args.json:
+        with open(args.json, 'w') as f: json.dump(results, f, indent=2)
+    return results
+
+async def wait_for_server(port, timeout=30):
+    """Waits until a server is accepting connections on a local port."""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() >= deadline: raise
+            await asyncio.sleep(0.1)
+
+async def compare(args):
+    """Runs the same load against the server started with each backend in turn (see the module documentation)."""
+    port = urlsplit(args.url).port or 80
+    server_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+    results = {}
+    for backend in args.compare.split(','):
+        print(f'== {backend}')
+        server = subprocess.Popen([sys.executable, server_py, f'--port={port}', '--time_scale=0', '--address_rate=0',
+                                   '--max_games_per_address=0', '--logging=warning'] + BACKENDS[backend])
+        try:
+            await wait_for_server(port)
+            results[backend] = await main(argparse.Namespace(**dict(vars(args), pid=server.pid, json=None)))
+        finally:
+            server.send_signal(signal.SIGTERM)
+            server.wait()
+        print()
+
+    print(f"{'backend':<16} {'events/sec':>10} {'server CPU':>10} {'CPU us/event':>12} "
+          f"{'play p50':>9} {'play p99':>9} {'peak RSS':>10}")
+    for backend, result in results.items():
+        server = result['server']
+        events = result['events'] + result['requests']
+        play = result['latency_ms'].get('play_card', {'p50': 0, 'p99': 0})
+        print(f"{backend:<16} {result['events_per_sec']:>10.0f} {server['cpu_percent']:>9.0f}% "
+              f"{1e4 * server['cpu_percent'] * result['seconds'] / events:>12.1f} "
+              f"{play['p50']:>7.2f}ms {play['p99']:>7.2f}ms {server['peak_rss_kb']:>7} kB")
+    if args.json:
+        with open(args.json, 'w') as f: json.dump(results, f, indent=2)
+    return results
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://localhost:8000', help='URL of the server')
+    parser.add_argument('--clients', type=int, default=100, help='number of simulated players (multiple of 4)')
+    parser.add_argument('--duration', type=float, default=0, help='keep starting new games for this many seconds')
+    parser.add_argument('--ramp', type=float, default=0, help='seconds over which to start the tables')
+    parser.add_argument('--timeout', type=float, default=600, help='seconds before giving up on a game')
+    parser.add_argument('--spectators', type=int, default=0, help='number of simulated spectators watching each game')
+    parser.add_argument('--protocol', choices=('json', 'binary'), default='json', help='encoding of the batches sent by the server')
+    parser.add_argument('--pid', type=int, help='process id of the server to report CPU and memory use of')
+    parser.add_argument('--json', help='also write the results to this JSON file')
+    parser.add_argument('--compare', help='start server.py with each of these backends in turn and compare them (comma separated, from ' + ', '.join(BACKENDS) + ')')
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+    asyncio.run(compare(args) if args.compare else main(args))
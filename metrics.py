@@ -0,0 +1,215 @@
+"""
+Metrics of the server in the Prometheus text format, served on /metrics.
+
+Counters and histograms are created once when the module is imported and each set of label values
+gets its own child (with its own preallocated bucket counts) the first time it is used, so that
+recording a value is just a dictionary lookup (or none when the child is kept, like timed() does)
+and a few additions. Gauges are functions that are only called when the metrics are scraped.
+"""
+
+import bisect
+import functools
+import inspect
+import time
+
+import tornado.web
+
+import eventloop
+
+# Content type of the Prometheus text format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Buckets (in seconds) for timing handlers and methods, from 10us to 10s
+TIME_BUCKETS = (.00001, .000025, .00005, .0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1,
+                .25, .5, 1, 2.5, 5, 10)
+
+
+def _format_labels(names, values):
+    if not names: return ''
+    return '{' + ','.join(f'{n}="{v}"' for n, v in zip(names, values)) + '}'
+
+class Metric:
+    """Base of all metrics, each metric has a name, help text, and the names of its labels."""
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.children = {} # child for each tuple of label values
+        REGISTRY.append(self)
+
+    def labels(self, *values):
+        """Gets the child for the given label values (keep it to record values without a lookup)."""
+        child = self.children.get(values)
+        if child is None: child = self.children[values] = self._child()
+        return child
+
+    def label_map(self):
+        """
+        Gets a dictionary of the value of the only label to its child (created when missing). Looking
+        up a child in it doesn't allocate anything.
+        """
+        return _LabelMap(self)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for values, child in sorted(self.children.items()):
+            lines += child.render(self.name, _format_labels(self.label_names, values))
+        return lines
+
+class _LabelMap(dict):
+    def __init__(self, metric):
+        self.metric = metric
+
+    def __missing__(self, value):
+        child = self[value] = self.metric.labels(value)
+        return child
+
+class _CounterChild:
+    __slots__ = ('value',)
+    def __init__(self): self.value = 0
+    def inc(self, amount=1): self.value += amount
+    def render(self, name, labels): return [f'{name}{labels} {self.value}']
+
+class Counter(Metric):
+    """A value that only goes up, like the number of messages sent."""
+    kind = 'counter'
+    _child = _CounterChild
+
+    def inc(self, amount=1):
+        """Increments a counter without labels."""
+        self.labels().inc(amount)
+
+class _HistogramChild:
+    __slots__ = ('buckets', 'counts', 'sum')
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # the last one is for values above all buckets
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def render(self, name, labels):
+        sep = labels[:-1] + ',' if labels else '{'
+        lines, total = [], 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append(f'{name}_bucket{sep}le="{le}"}} {total}')
+        lines += [f'{name}_sum{labels} {self.sum}', f'{name}_count{labels} {total}']
+        return lines
+
+class Histogram(Metric):
+    """Counts of values (like durations) in buckets plus their sum."""
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=TIME_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def _child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        """Records a value in a histogram without labels."""
+        self.labels().observe(value)
+
+    def totals(self):
+        """Gets the (count, sum) of the values recorded for each tuple of label values."""
+        return {values: (sum(child.counts), child.sum) for values, child in self.children.items()}
+
+class Gauge(Metric):
+    """
+    A value that can go up and down, given by a function that is called when the metrics are
+    scraped. The function returns a number, or a dictionary of label value tuples to numbers when
+    the gauge has labels.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, help, func, labels=()):
+        super().__init__(name, help, labels)
+        self.func = func
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        values = self.func()
+        if not self.label_names: values = {(): values}
+        for labels, value in sorted(values.items()):
+            lines.append(f'{self.name}{_format_labels(self.label_names, labels)} {value}')
+        return lines
+
+class CounterFunction(Gauge):
+    """A counter whose value is given by a function (for counts that are kept elsewhere)."""
+    kind = 'counter'
+
+# All metrics, in the order they were created
+REGISTRY = []
+
+def render():
+    """Gets all of the metrics in the Prometheus text format."""
+    lines = []
+    for metric in REGISTRY: lines += metric.render()
+    return '\n'.join(lines) + '\n'
+
+
+def timed(histogram, *labels):
+    """
+    Decorator that records the time a function (or coroutine function) takes in a histogram with
+    the given label values.
+    """
+    def decorator(func):
+        child = histogram.labels(*labels)
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try: return await func(*args, **kwargs)
+                finally: child.observe(time.perf_counter() - start)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try: return func(*args, **kwargs)
+                finally: child.observe(time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+def timed_methods(cls, names, histogram):
+    """
+    Makes a subclass of a class where each of the named methods is timed in the histogram (with the
+    method name as the label).
+    """
+    return type(cls.__name__, (cls,), {name: timed(histogram, name)(getattr(cls, name)) for name in names})
+
+
+class LoopLagMonitor:
+    """
+    Measures the event loop lag: how late a callback scheduled at a regular interval actually runs.
+    A busy or blocked loop delays every message, so this is the first thing to look at.
+    """
+    def __init__(self, histogram, interval=0.5):
+        self.histogram = histogram
+        self.interval = interval # seconds between measurements
+        self.last = 0.0 # last lag measured in seconds
+        self.expected = None # event loop time the next measurement should run at
+
+    def start(self):
+        self.expected = eventloop.time() + self.interval
+        eventloop.call_at(self.expected, self.check)
+
+    def check(self):
+        now = eventloop.time()
+        self.last = max(0.0, now - self.expected)
+        self.histogram.observe(self.last)
+        self.expected = now + self.interval
+        eventloop.call_at(self.expected, self.check)
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """Serves all of the metrics in the Prometheus text format."""
+    def get(self):
+        self.set_header('Content-Type', CONTENT_TYPE)
+        self.write(render())
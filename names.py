@@ -0,0 +1,125 @@
+"""
+Allocation of the names of new games (three different words) so that a new game never lands on a
+game that already exists.
+
+Every name is a number below the size of the namespace (the number of ordered triples of different
+words). New names are taken in the order of a random permutation of all of the numbers (an affine
+map with a step coprime to the size) so no name is ever handed out twice in a pass. Each candidate
+is still checked against the games that exist (people can make up their own names) and, in sharded
+mode, only names of games owned by this worker are used. Names of games that are removed are
+released into a fixed-size ring of free names that are reused first (oldest first), which keeps
+allocation O(1) and the permutation for names that were never used. If both run out, another pass
+is started with a new permutation.
+
+A name is reserved from when it is handed out until its game is created (or the reservation expires
+and the name is released).
+"""
+
+import array
+import collections
+import math
+import random
+import time
+
+
+class NameAllocator:
+    """Hands out the names of new games, see the module documentation."""
+    def __init__(self, words, in_use, owns=None, reserve_time=600, max_free=1 << 18, seed=None):
+        self.words = list(words)
+        self.indices = {word: i for i, word in enumerate(self.words)}
+        n = len(self.words)
+        self.size = n * (n - 1) * (n - 2) # number of names
+        self.in_use = in_use # function that checks if a game with a name exists
+        self.owns = owns # function that checks if this process owns a name (None for all of them)
+        self.reserve_time = reserve_time # seconds a name is reserved for after being handed out
+        self.reserved = {} # names handed out whose games haven't been created yet with their expiration times
+        self.expirations = collections.deque() # (expiration time, name) for each reservation in order
+        self.free = array.array('Q', bytes(8 * min(max_free, self.size))) # ring of released name numbers
+        self.free_start = 0 # position of the oldest free name in the ring
+        self.free_count = 0 # number of free names in the ring
+        self.rng = random.Random(seed)
+        self.passes = 0 # number of times the permutation has been started
+        self.allocated = 0 # number of names handed out
+        self.collisions = 0 # number of candidate names skipped because they were in use
+        self._new_pass()
+
+    def _new_pass(self):
+        self.passes += 1
+        self.step = self.rng.randrange(1, self.size)
+        while math.gcd(self.step, self.size) != 1: self.step = self.rng.randrange(1, self.size)
+        self.offset = self.rng.randrange(self.size)
+        self.cursor = 0 # number of names taken from the permutation in this pass
+
+    def name(self, num):
+        """Gets the name for a number."""
+        n = len(self.words)
+        a, rest = divmod(num, (n - 1) * (n - 2))
+        b, c = divmod(rest, n - 2)
+        b += b >= a # the second word skips the first word and the third skips both
+        for skipped in sorted((a, b)): c += c >= skipped
+        return f'{self.words[a]}-{self.words[b]}-{self.words[c]}'
+
+    def number(self, name):
+        """Gets the number of a name, or None if it isn't in the namespace."""
+        parts = name.split('-')
+        if len(parts) != 3 or len(set(parts)) != 3 or any(p not in self.indices for p in parts): return None
+        a, b, c = (self.indices[p] for p in parts)
+        n = len(self.words)
+        return a * (n - 1) * (n - 2) + (b - (b > a)) * (n - 2) + c - (c > a) - (c > b)
+
+    def _available(self, name):
+        if self.owns is not None and not self.owns(name): return False
+        if name in self.reserved or self.in_use(name):
+            self.collisions += 1
+            return False
+        return True
+
+    def allocate(self):
+        """Gets a name for a new game and reserves it. Returns None if all names are in use."""
+        self._expire()
+        for _ in range(2):
+            while self.free_count:
+                num = self.free[self.free_start]
+                self.free_start = (self.free_start + 1) % len(self.free)
+                self.free_count -= 1
+                name = self.name(num)
+                if self._available(name): return self._reserve(name)
+            while self.cursor < self.size:
+                name = self.name((self.offset + self.step * self.cursor) % self.size)
+                self.cursor += 1
+                if self._available(name): return self._reserve(name)
+            self._new_pass() # free names may have been dropped from the ring, check them all again
+        return None
+
+    def _reserve(self, name):
+        self.allocated += 1
+        expires = time.monotonic() + self.reserve_time
+        self.reserved[name] = expires
+        self.expirations.append((expires, name))
+        return name
+
+    def _expire(self):
+        now = time.monotonic()
+        while self.expirations and self.expirations[0][0] <= now:
+            expires, name = self.expirations.popleft()
+            if self.reserved.get(name) == expires: # not claimed (or handed out again) since
+                del self.reserved[name]
+                self.release(name)
+
+    def claim(self, name):
+        """Marks the game of a name as created (ending its reservation)."""
+        self.reserved.pop(name, None)
+
+    def release(self, name):
+        """Makes a name available again after its game is removed (ignored for names not in the namespace)."""
+        num = self.number(name)
+        if num is None or name in self.reserved: return
+        if self.free_count == len(self.free): # full, drop the oldest
+            self.free_start = (self.free_start + 1) % len(self.free)
+            self.free_count -= 1
+        self.free[(self.free_start + self.free_count) % len(self.free)] = num
+        self.free_count += 1
+
+    def occupancy(self):
+        """Gets the fraction of the namespace that has been handed out in the current pass."""
+        return self.cursor / self.size
@@ -0,0 +1,146 @@
+"""
+Profiling of the live server without restarting it: a sampling profiler that can be turned on for a
+few seconds and a detector of callbacks that block the event loop.
+
+The SamplingProfiler runs a thread that looks at the stack of the event loop's thread every few
+milliseconds (with sys._current_frames()) and counts each distinct stack. The event loop itself does
+nothing extra, so the overhead is only the sampling thread taking the GIL briefly. The stacks are
+given in the collapsed format used by flamegraph.pl and speedscope (one line per stack with the
+frames separated by semicolons and the number of samples), time spent waiting for events shows up
+as stacks ending in the selector.
+
+The StallDetector has a callback on the event loop update a heartbeat and a thread that checks it.
+Whenever the heartbeat is older than the threshold, some callback has been running for that long and
+the thread logs the event loop thread's stack while it is still blocked (and how long it was blocked
+for once it isn't).
+
+Along with the samples, profile() gives the number of calls and time spent in each socket.io handler
+and Game method during the profile (from the timing histograms in metrics.py).
+"""
+
+import asyncio
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+import eventloop
+
+log = logging.getLogger('profiler')
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f'{os.path.basename(code.co_filename)}:{code.co_name}'
+
+def collapse(frame):
+    """Gets the collapsed stack of a frame: the names of its frames from the outermost, separated by semicolons."""
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class SamplingProfiler:
+    """Samples the stack of a thread (by default the current one) every interval seconds, see the module documentation."""
+    def __init__(self, interval=0.005, thread_id=None):
+        self.interval = interval
+        self.thread_id = threading.get_ident() if thread_id is None else thread_id
+        self.stacks = collections.Counter() # number of samples of each collapsed stack
+        self.samples = 0
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._sample, name='profiler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None: self.thread.join()
+        self.thread = None
+
+    def _sample(self):
+        while self.running:
+            time.sleep(self.interval)
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None: break # the thread is gone
+            self.stacks[collapse(frame)] += 1
+            self.samples += 1
+            del frame
+
+    def collapsed(self):
+        """Gets the samples in the collapsed stack format (most common stacks first)."""
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+
+class StallDetector:
+    """Logs the stack of the event loop whenever it is blocked for longer than threshold seconds, see the module documentation."""
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.heartbeat = None # time.monotonic() of the last heartbeat of the event loop
+        self.stalls = 0 # number of times the event loop was blocked for longer than the threshold
+        self.thread_id = None # the event loop's thread
+
+    def start(self):
+        """Starts the heartbeat and the thread that checks it (call from the event loop)."""
+        self.thread_id = threading.get_ident()
+        self._beat()
+        threading.Thread(target=self._watch, name='stall-detector', daemon=True).start()
+
+    def _beat(self):
+        self.heartbeat = time.monotonic()
+        eventloop.call_at(eventloop.time() + self.threshold / 4, self._beat)
+
+    def _watch(self):
+        reported = None # heartbeat of the stall logged that hasn't ended yet, so each stall is only logged once
+        while True:
+            time.sleep(self.threshold / 4)
+            heartbeat = self.heartbeat
+            if reported is not None and heartbeat != reported:
+                log.warning('event loop was blocked for %.3f seconds', heartbeat - reported)
+                reported = None
+            blocked = time.monotonic() - heartbeat
+            if blocked > self.threshold and reported is None:
+                reported = heartbeat
+                self.stalls += 1
+                frame = sys._current_frames().get(self.thread_id)
+                if frame is None: return
+                log.warning('event loop blocked for %.3f seconds by:\n%s', blocked, ''.join(traceback.format_stack(frame)))
+                del frame
+
+
+def _breakdown(before, after):
+    breakdown = {}
+    for labels, (count, total) in after.items():
+        count0, total0 = before.get(labels, (0, 0.0))
+        if count > count0:
+            breakdown[labels[0]] = {'calls': count - count0, 'seconds': total - total0,
+                                    'mean_ms': 1000 * (total - total0) / (count - count0)}
+    return dict(sorted(breakdown.items(), key=lambda item: -item[1]['seconds']))
+
+async def profile(seconds, histograms, interval=0.005):
+    """
+    Profiles the event loop for some seconds (call from the event loop). Returns a dictionary with
+    the collapsed stacks ('collapsed', see SamplingProfiler.collapsed()), the number of samples, and
+    for each name in histograms (a dictionary of names to metrics.Histogram with a single label) the
+    calls, total seconds, and mean milliseconds for each label value during the profile, most time
+    first.
+    """
+    profiler = SamplingProfiler(interval)
+    before = {name: histogram.totals() for name, histogram in histograms.items()}
+    start = time.monotonic()
+    profiler.start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.stop()
+    result = {'seconds': time.monotonic() - start, 'interval': interval, 'samples': profiler.samples,
+              'collapsed': profiler.collapsed()}
+    for name, histogram in histograms.items(): result[name] = _breakdown(before[name], histogram.totals())
+    return result
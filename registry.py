@@ -0,0 +1,66 @@
+"""
+Registry of the connections of this process: which game and player each socket.io connection is,
+the games each user (uid) has a seat in, and the game each spectator is watching.
+
+Every socket.io event looks up its game with a single dictionary lookup instead of loading the
+socket.io session, and joining looks up the user's seat without going through the players of the
+game. The registry is only changed synchronously right next to the Game calls that change the
+players (join, rejoin, disconnect, and removing a game), so with the single-threaded event loop the
+registry and the games are never out of step. With several worker processes each worker only knows
+about the games it owns.
+"""
+
+
+class ConnectionRegistry:
+    """Indexes of the connections, see the module documentation."""
+    def __init__(self):
+        self.sids = {} # (Game, Player) for each socket.io identifier of a connected player
+        self.uids = {} # the Player in each game for each uid (dictionary of Game to Player)
+        self.watching = {} # name of the game each spectator's socket.io identifier is watching
+
+    def lookup(self, sid):
+        """Gets the (Game, Player) of a connected player's socket.io identifier (or None)."""
+        return self.sids.get(sid)
+
+    def seat(self, game, uid):
+        """Gets the Player of a user in a game (or None if they don't have a seat in it)."""
+        players = self.uids.get(uid)
+        return None if players is None else players.get(game)
+
+    def games(self, uid):
+        """Gets the list of games a user has a seat in."""
+        return list(self.uids.get(uid, ()))
+
+    def add(self, game, p):
+        """Adds a player that is in a game. Computer players are ignored."""
+        if p.bot: return
+        self.uids.setdefault(p.uid, {})[game] = p
+        if not p.disconnected: self.sids[p.sid] = (game, p)
+
+    def connect(self, game, p, old_sid):
+        """Updates a player that rejoined a game with a new socket.io identifier."""
+        self.sids.pop(old_sid, None)
+        self.add(game, p)
+
+    def disconnect(self, sid):
+        """
+        Removes a player's socket.io identifier when it disconnects and gets the (Game, Player) it
+        was for (or None). The player keeps their seat, see remove() for when they don't.
+        """
+        return self.sids.pop(sid, None)
+
+    def remove(self, game, p):
+        """Removes a player from a game (along with their socket.io identifier)."""
+        if self.sids.get(p.sid, (None,))[0] is game: del self.sids[p.sid]
+        players = self.uids.get(p.uid)
+        if players is not None and players.get(game) is p:
+            del players[game]
+            if not players: del self.uids[p.uid]
+
+    def remove_game(self, game):
+        """Removes all of the players of a game."""
+        for p in game.players: self.remove(game, p)
+
+    def sizes(self):
+        """Gets the number of entries in each index."""
+        return {'sids': len(self.sids), 'uids': len(self.uids), 'watching': len(self.watching)}
@@ -0,0 +1,390 @@
+"""
+Log of every hand played, for settling disputes, analytics, and checking changes to the rules.
+
+When the server is run with --replay_dir, each finished hand (the cards dealt, traded, and played in
+order, who took each trick, and the scores) is added to a buffer that a single background thread
+appends to the log files in batches, so recording a hand costs the event loop a few microseconds.
+Each process writes its own log files and starts a new one once they reach a maximum size.
+
+The logs can then be read with this module as a command line tool that memory-maps them:
+
+    python3 replay.py stats replays/              # point averages by seat and player, moon rate
+    python3 replay.py show tiger-apple-river replays/  # every trick of the hands of a game
+    python3 replay.py verify replays/             # plays every hand again with the rules in Game
+
+Log file format (version 1):
+  header: the 4 bytes b'BHRL' and the version as a single byte
+  records: 4-byte big-endian length of the record, 4-byte big-endian CRC32 of the record, and the
+    record itself, the first byte of which is its type; a truncated or corrupt record at the end
+    (from a crash) ends the log
+  game records (type 1): the id of the game in the log file (4 bytes), the name of the game, and
+    then for each player a byte of flags (1 for computer player), the uid, and the name; strings are
+    a 2-byte length followed by UTF-8. This comes before the first hand of a game in each file and
+    again whenever the players of the game change.
+  hand records (type 2): see _HAND, the cards dealt and passed are masks (see cards.py), the cards
+    played are their indices in DECK in the order they were played, the scores are the totals after
+    the hand, and the points are the points taken by each player during the hand
+"""
+
+import argparse
+import collections
+import logging
+import mmap
+import multiprocessing
+import os
+import struct
+import sys
+import time
+import weakref
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import eventloop
+from cards import DECK, card_sort_key, count_points, mask_cards
+from hearts import Game, SyncSink
+
+log = logging.getLogger('replay')
+
+LOG_MAGIC = b'BHRL'
+LOG_VERSION = 1
+LOG_EXTENSION = '.hands'
+_HEADER = LOG_MAGIC + bytes((LOG_VERSION,))
+_RECORD = struct.Struct('>II')
+
+GAME_RECORD, HAND_RECORD = 1, 2
+_GAME = struct.Struct('>BI') # type, game id
+_HAND = struct.Struct('>BIIHHH4B4Q4Q52s13s') # type, game id, time (seconds since the epoch), hand
+    # number, score of the 0/2 team, score of the 1/3 team, points taken by each player, cards dealt
+    # to each player, cards passed by each player, cards played, player number that took each trick
+_UINT16 = struct.Struct('>H')
+
+# A hand read from a log (points, dealt, and passed are tuples with a value for each player)
+Hand = collections.namedtuple('Hand', 'game_id time hand_num score0 score1 points dealt passed plays trick_winners')
+
+
+def hand_points(plays, trick_winners):
+    """Gets the points taken by each player from the cards played and who took each trick."""
+    points = [0, 0, 0, 0]
+    for i, p in enumerate(trick_winners):
+        points[p] += count_points(sum(1 << card for card in plays[i*4:i*4+4]))
+    return tuple(points)
+
+def hand_scores(points):
+    """Gets the scores of the 0/2 and 1/3 teams for a hand from the points of each player (see Game.end_hand())."""
+    score0, score1 = points[0] + points[2], points[1] + points[3]
+    if score0 == 26: return 0, 36
+    if score1 == 26: return 36, 0
+    return score0, score1
+
+def hand_of(game, game_id=0, when=0):
+    """Gets the Hand for the hand a game just finished."""
+    return Hand(game_id, when, game.hand_num, game.score0, game.score1,
+                hand_points(game.plays, game.trick_winners), tuple(game.dealt), tuple(game.passed),
+                bytes(game.plays), bytes(game.trick_winners))
+
+
+def _pack_str(string):
+    data = str(string).encode()[:0xFFFF] # the server limits names, but a long one must not stop the log
+    return _UINT16.pack(len(data)) + data
+
+def _unpack_str(data, pos):
+    length, = _UINT16.unpack_from(data, pos)
+    return bytes(data[pos+2:pos+2+length]).decode(errors='replace'), pos + 2 + length
+
+def _add_record(buffer, record):
+    buffer += _RECORD.pack(len(record), zlib.crc32(record))
+    buffer += record
+
+
+class ReplayLog:
+    """Writes the hands of games to log files in a directory, see the module documentation."""
+    def __init__(self, path, interval=1.0, max_size=64 << 20, prefix=None):
+        self.path = path # directory that the logs are written in
+        self.interval = interval # seconds between writing batches of records
+        self.max_size = max_size # size in bytes that causes a new log file to be started
+        self.prefix = prefix or f'hands-{os.getpid()}' # start of the names of the log files
+        self.filename = None # log file currently being written
+        self.batches = [] # records waiting to be written as (file name, bytearray)
+        self.size = self.max_size # size of the current log file (including records waiting to be written)
+        self.game_ids = weakref.WeakKeyDictionary() # (game id, players) of the games with a game record in the current log file
+        self.next_id = 0 # next game id in the current log file
+        self.hands = 0 # number of hands recorded
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix='replay')
+        self.callback = None
+        os.makedirs(path, exist_ok=True)
+
+    def start(self):
+        """Starts writing batches of records periodically."""
+        self.callback = eventloop.PeriodicCallback(self.write, self.interval)
+        self.callback.start()
+
+    def _new_file(self):
+        self.filename = os.path.join(self.path, f'{self.prefix}-{time.time_ns()}{LOG_EXTENSION}')
+        self.batches.append((self.filename, bytearray(_HEADER)))
+        self.size = len(_HEADER)
+        self.game_ids.clear()
+        self.next_id = 0
+
+    def record(self, game):
+        """
+        Adds the hand a game just finished to the log (use as EventSink.record_hand()). A hand that
+        can't be recorded is logged and left out instead of raising into the game.
+        """
+        if self.size >= self.max_size: self._new_file()
+        elif not self.batches: self.batches.append((self.filename, bytearray()))
+        buffer = self.batches[-1][1]
+        start = len(buffer)
+        try:
+            self._record(game, buffer)
+        except Exception:
+            log.exception('error recording a hand of game %s', game.name)
+            del buffer[start:]
+            self.game_ids.pop(game, None) # its game record may have been left out too
+            return
+        self.size += len(buffer) - start
+        self.hands += 1
+
+    def _record(self, game, buffer):
+        players = tuple((p.bot, p.uid, p.name) for p in game.players)
+        known = self.game_ids.get(game)
+        if known is None or known[1] != players:
+            game_id = self.next_id if known is None else known[0]
+            if known is None: self.next_id += 1
+            self.game_ids[game] = (game_id, players)
+            _add_record(buffer, _GAME.pack(GAME_RECORD, game_id) + _pack_str(game.name) + b''.join(
+                bytes((bot,)) + _pack_str(uid) + _pack_str(name) for bot, uid, name in players))
+        hand = hand_of(game, self.game_ids[game][0], int(time.time()))
+        _add_record(buffer, _HAND.pack(HAND_RECORD, hand.game_id, hand.time, hand.hand_num, hand.score0,
+                                       hand.score1, *hand.points, *hand.dealt, *hand.passed,
+                                       hand.plays, hand.trick_winners))
+
+    def write(self):
+        """
+        Writes all waiting records in the background. Returns a future that completes once written
+        (or None if there was nothing to write).
+        """
+        if not self.batches: return None
+        batches, self.batches = self.batches, []
+        return eventloop.run_in_executor(self.executor, self._write_batches, batches)
+
+    def _write_batches(self, batches):
+        """Appends the records to the log files, run on the writer thread."""
+        for filename, data in batches:
+            with open(filename, 'ab') as f: f.write(data)
+
+    def close(self):
+        """Writes all remaining records and waits for them to be on disk."""
+        if self.callback is not None: self.callback.stop()
+        if self.batches: self.executor.submit(self._write_batches, self.batches)
+        self.batches = []
+        self.executor.shutdown(wait=True)
+
+
+##### Reading #####
+
+def log_files(paths):
+    """Gets the log files in a list of files and directories (in the order they were written)."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted((os.path.join(path, name) for name in os.listdir(path) if name.endswith(LOG_EXTENSION)),
+                            key=os.path.getmtime)
+        else:
+            files.append(path)
+    return files
+
+def read_log(filename):
+    """
+    Memory-maps a log file and yields each of its records, either ('game', game id, name, players)
+    with players a list of (computer player, uid, name) for each player, or ('hand', Hand).
+    """
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < len(_HEADER): return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if data[:len(_HEADER)] != _HEADER: raise ValueError(f'{filename} is not a replay log')
+            view = memoryview(data)
+            try:
+                pos = len(_HEADER)
+                while pos + _RECORD.size <= len(data):
+                    length, crc = _RECORD.unpack_from(data, pos)
+                    pos += _RECORD.size
+                    if pos + length > len(data) or zlib.crc32(view[pos:pos+length]) != crc: break
+                    if data[pos] == HAND_RECORD:
+                        f = _HAND.unpack_from(data, pos)
+                        yield 'hand', Hand(f[1], f[2], f[3], f[4], f[5], f[6:10], f[10:14], f[14:18], f[18], f[19])
+                    elif data[pos] == GAME_RECORD:
+                        _, game_id = _GAME.unpack_from(data, pos)
+                        name, end = _unpack_str(data, pos + _GAME.size)
+                        players = []
+                        while end < pos + length:
+                            bot = bool(data[end])
+                            uid, end = _unpack_str(data, end + 1)
+                            player_name, end = _unpack_str(data, end)
+                            players.append((bot, uid, player_name))
+                        yield 'game', game_id, name, players
+                    pos += length
+            finally:
+                view.release()
+
+
+##### Replaying #####
+
+class _ReplayGame(Game):
+    """Game that deals the recorded cards."""
+    def __init__(self, dealt):
+        super().__init__('replay', SyncSink(on_hand=self._record))
+        self.recorded = dealt
+        self.replayed = None # Hand the game recorded
+
+    def deal(self):
+        return [mask_cards(mask) for mask in self.recorded]
+
+    def _record(self, game):
+        self.replayed = hand_of(self)
+
+def replay_hand(hand):
+    """
+    Plays a recorded Hand again with the rules in Game and gets the Hand that the game records for
+    it (the same as the recorded hand except for the game id and time, unless the rules changed).
+    Raises ValueError if one of the recorded trades or cards is not allowed.
+    """
+    game = _ReplayGame(hand.dealt)
+    for i in range(4): game.join(f'player{i}', i, f'Player {i}')
+    score0, score1 = hand_scores(hand.points)
+    game.hand_num, game.score0, game.score1 = hand.hand_num - 1, hand.score0 - score0, hand.score1 - score1
+    game.start_hand()
+    if game.state == 'trading':
+        for p in game.players:
+            if game.trade(p.sid, mask_cards(hand.passed[p.num])) == 'invalid':
+                raise ValueError(f'player {p.num} cannot trade {" ".join(mask_cards(hand.passed[p.num]))}')
+    for card in hand.plays:
+        game.sink.run()
+        p = next((p for p in game.players if p.turn), None)
+        if p is None or game.play_card(p.sid, DECK[card]) == 'invalid':
+            raise ValueError(f'{DECK[card]} cannot be played ({len(game.plays)} cards into the hand)')
+    game.sink.run()
+    if game.replayed is None: raise ValueError('the hand did not end')
+    return game.replayed._replace(game_id=hand.game_id, time=hand.time)
+
+
+##### Command line #####
+
+def _file_stats(filename):
+    """Aggregates the hands in a single log file (run in the process pool)."""
+    stats = {'hands': 0, 'moons': 0, 'games': set(), 'seats': [0, 0, 0, 0], 'players': {}}
+    players = {} # players of each game id
+    for record in read_log(filename):
+        if record[0] == 'game':
+            _, game_id, name, game_players = record
+            stats['games'].add(name)
+            players[game_id] = [('', 'Computer players') if bot else (uid, name) for bot, uid, name in game_players]
+            continue
+        hand = record[1]
+        moon = 26 in (hand.points[0] + hand.points[2], hand.points[1] + hand.points[3])
+        stats['hands'] += 1
+        stats['moons'] += moon
+        for i, (key, name) in enumerate(players.get(hand.game_id, ())):
+            stats['seats'][i] += hand.points[i]
+            player = stats['players'].setdefault(key, [name, 0, 0, 0]) # name, hands, points, moons shot by their team
+            player[0] = name
+            player[1] += 1
+            player[2] += hand.points[i]
+            player[3] += moon and hand.points[i] + hand.points[(i + 2) % 4] == 26
+    return stats
+
+def stats(files, processes, top):
+    total = {'hands': 0, 'moons': 0, 'games': set(), 'seats': [0, 0, 0, 0], 'players': {}}
+    with multiprocessing.Pool(processes) as pool:
+        for result in pool.imap_unordered(_file_stats, files):
+            total['hands'] += result['hands']
+            total['moons'] += result['moons']
+            total['games'] |= result['games']
+            total['seats'] = [a + b for a, b in zip(total['seats'], result['seats'])]
+            for key, (name, hands, points, moons) in result['players'].items():
+                player = total['players'].setdefault(key, [name, 0, 0, 0])
+                player[1] += hands
+                player[2] += points
+                player[3] += moons
+    hands = total['hands']
+    print(f'{hands} hands in {len(total["games"])} games')
+    if not hands: return
+    print(f'moon shot in {total["moons"] / hands:.2%} of hands')
+    print('average points by seat: ' + ', '.join(f'{i}: {points / hands:.2f}' for i, points in enumerate(total['seats'])))
+    print()
+    print(f'{"player":<30} {"hands":>10} {"avg points":>10} {"moon shots":>10}')
+    for name, hands, points, moons in sorted(total['players'].values(), key=lambda player: -player[1])[:top]:
+        print(f'{name[:30]:<30} {hands:>10} {points / hands:>10.2f} {moons / hands:>10.2%}')
+
+def show(files, name):
+    found = False
+    for filename in files:
+        players = None
+        ids = set() # ids of the game in this file
+        for record in read_log(filename):
+            if record[0] == 'game':
+                if record[2] == name:
+                    ids.add(record[1])
+                    players = [player_name for _, _, player_name in record[3]]
+                continue
+            hand = record[1]
+            if hand.game_id not in ids: continue
+            found = True
+            print(f'Hand {hand.hand_num} ({time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(hand.time))})')
+            for i, player in enumerate(players):
+                dealt = sorted(mask_cards(hand.dealt[i]), key=card_sort_key)
+                passed = f', passed {" ".join(mask_cards(hand.passed[i]))}' if hand.passed[i] else ''
+                print(f'  {i} {player}: {" ".join(dealt)}{passed}')
+            for t, winner in enumerate(hand.trick_winners):
+                cards = ' '.join(DECK[card] for card in hand.plays[t*4:t*4+4])
+                print(f'  trick {t + 1:>2}: {cards:<16} taken by {players[winner]}')
+            print(f'  points: {", ".join(f"{players[i]} {points}" for i, points in enumerate(hand.points))}'
+                  f' - scores {hand.score0} to {hand.score1}')
+    if not found: print(f'no hands of {name}')
+
+def _file_verify(filename):
+    """Replays the hands in a single log file (run in the process pool), gets the problems found."""
+    hands, problems = 0, []
+    for record in read_log(filename):
+        if record[0] != 'hand': continue
+        hand = record[1]
+        hands += 1
+        try:
+            replayed = replay_hand(hand)
+        except ValueError as e:
+            problems.append(f'{filename}: game {hand.game_id} hand {hand.hand_num}: {e}')
+            continue
+        if replayed != hand:
+            fields = [field for field in Hand._fields if getattr(replayed, field) != getattr(hand, field)]
+            problems.append(f'{filename}: game {hand.game_id} hand {hand.hand_num}: different {", ".join(fields)}')
+    return hands, problems
+
+def verify(files, processes):
+    total, failed = 0, 0
+    with multiprocessing.Pool(processes) as pool:
+        for hands, problems in pool.imap_unordered(_file_verify, files):
+            total += hands
+            failed += len(problems)
+            for problem in problems: print(problem)
+    print(f'{total - failed} of {total} hands replayed the same')
+    return failed == 0
+
+def main():
+    parser = argparse.ArgumentParser(description='Reads the logs of hands written with server.py --replay_dir')
+    commands = parser.add_subparsers(dest='command', required=True)
+    stats_parser = commands.add_parser('stats', help='point averages by seat and player and how often the moon is shot')
+    stats_parser.add_argument('--top', type=int, default=20, help='number of players to list (most hands first)')
+    show_parser = commands.add_parser('show', help='the deal, trades, and tricks of every hand of a game')
+    show_parser.add_argument('game', help='name of the game')
+    verify_parser = commands.add_parser('verify', help='play every hand again with the current rules and report differences')
+    for command in (stats_parser, show_parser, verify_parser):
+        command.add_argument('paths', nargs='+', help='log files or directories of log files')
+    for command in (stats_parser, verify_parser):
+        command.add_argument('--processes', type=int, default=os.cpu_count(), help='number of processes to read the logs with')
+    args = parser.parse_args()
+    files = log_files(args.paths)
+    if args.command == 'stats': stats(files, args.processes, args.top)
+    elif args.command == 'show': show(files, args.game)
+    elif not verify(files, args.processes): sys.exit(1)
+
+if __name__ == '__main__':
+    main()
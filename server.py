@@ -1,605 +1,948 @@
+import collections
+import functools
+import hmac
+import json
+import logging
 import os.path
 import random
+import time
 
 import asyncio
 
 import socketio
 
-from tornado.ioloop import IOLoop
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 import tornado.web
-from tornado.options import define, options
-
-# A complete deck of cards
-DECK = (
-    'c2', 'd2', 'h2', 's2', 'c3', 'd3', 'h3', 's3', 'c4', 'd4', 'h4', 's4', 'c5', 'd5', 'h5', 's5',
-    'c6', 'd6', 'h6', 's6', 'c7', 'd7', 'h7', 's7', 'c8', 'd8', 'h8', 's8', 'c9', 'd9', 'h9', 's9', 'c10', 'd10', 'h10', 's10',
-    'cJ', 'dJ', 'hJ', 'sJ', 'cQ', 'dQ', 'hQ', 'sQ', 'cK', 'dK', 'hK', 'sK', 'cA', 'dA', 'hA', 'sA',
-)
-
-# How cards are traded during different hands
-#   The outer list is indexed by the hand number mod 4
-#   The inner list is indexed by player number (0-4)
-#   The value given is a player number to trade with
-TRADING = [
-    [0,1,2,3], # keep
-    [3,0,1,2], # left
-    [1,2,3,0], # right
-    [2,3,0,1], # across
-]
-
-# Total score to win
-SCORE_TO_WIN = 100
-
-
-def card_sort_key(card):
-    """Key function for sorting cards. Usable as key argument of list.sort(), max(), and min()."""
-    num = card[1:]
-    num = int(num) if num.isdigit() else {'J':11, 'Q':12, 'K':13, 'A':14}[num]
-    return card[0], num
-
-def is_point_card(card):
-    """Returns True if the card is a point card"""
-    return card[0] == 'h' or card == 'sQ'
-
-class Player:
-    """A single player in the game."""
-    def __init__(self, num, uid, sid, name):
-        self.num = num # player number (0-4)
-        self.uid = uid # user identifier for this player
-        self.sid = sid # socket.io identifier for this player
-        self.disconnected = False # True if the player has disconnected
-        self.name = name # name displayed for this player
-        self.hand = [] # current hand of cards for this player (each a string like 'c5')
-        self.pending_trade = None # list of cards being traded (each a string like 'c5')
-        self.turn = False # True if this player is currently playing a card
-
-    def emit(self, event, *args):
-        """
-        Sends a message to this player (and only this player). The message will be sent AFTER the
-        current message is done being handled and the order of messages will be kept.
-        """
-        IOLoop.current().add_callback(sio.emit, event, args, to=self.sid)
-
-    def has_suit(self, suit):
-        """Returns true if any card in the hand has the given suit."""
-        return any(c[0] == suit for c in self.hand)
-
-    def has_nonpoint_card(self):
-        """Returns true if any card in the hand is not a point card."""
-        return any(not is_point_card(c) for c in self.hand)
-
-    def cannot_play_point_card(self, card):
-        """Returns true if the player has any non-point card and the card given is a point card."""
-        return is_point_card(card) and self.has_nonpoint_card()
-
-
-class Game:
-    """A single game being player by 4 people."""
-    def __init__(self, name):
-        self.name = name # unique name for this game
-        self.state = 'waiting' # state of the game, one of waiting, trading, playing, or ended
-        self.players = [] # list of players in this game (each Player object)
-        self.sid2player = {} # dictionary of socket.io identifiers to their Player object
-        self.hand_num = 0 # number of hands played or currently being played in this game
-        self.score0 = 0 # number of points 0/2 team has overall
-        self.score1 = 0 # number of points 1/3 team has overall
-
-        # current hand info
-        self.hearts_broken = False # if hearts have been broken in this hand so far
-        self.num_tricks0 = -1 # number of tricks taken by the 0/2 team this hand
-        self.num_tricks1 = -1 # number of tricks taken by the 1/3 team this hand
-        self.hand_score0 = -1 # number of points taken by the 0/2 team this hand
-        self.hand_score1 = -1 # number of points taken by the 1/3 team this hand
-
-        # current trick info
-        self.trick_start_player = None # player who started the current trick (Player object)
-        self.trick_cards = [] # cards played in this trick so far (each a string like 'c5')
-        self.last_trick = [] # last trick of cards played
-
-    def emit(self, event, *args):
-        """
-        Sends a message to all players in this game. The message will be sent AFTER the
-        current message is done being handled and the order of messages will be kept.
-        """
-        IOLoop.current().add_callback(sio.emit, event, args, room=self.name)
-
-    def player(self, sid):
-        """Gets a player object from the socket.io identifier for the user."""
-        return self.sid2player[sid]
-
-    def join(self, uid, sid, name):
-        """
-        Called when a player initially joins the game. If this is the fourth player to join, then
-        this emits special messages to get the game going.
-
-        Arguments:
-          sid  - socket.io identifier for the user joining the game
-          uid  - user identifier for this user
-          name - the player's display name
-        
-        Returns:
-          'full' if the user cannot join the game. Tuple of 'joined' and list of other player names
-          when successfully joining.
-
-        Messages emitted:
-          On success, this emits the 'joined' message with the new player name. If this causes the
-          game to start, this will emit 'select_partner' to player number 0 (with a list of all
-          player names except player number 0) and 'pause' to all other players.
-        """
-        num_players = len(self.players)
-        if sid in self.sid2player or (num_players >= 4 or self.state != 'waiting'): return 'full'
-        others = [p.name for p in self.players]
-        player = self.sid2player[sid] = Player(num_players, uid, sid, name)
-        self.players.append(player)
-        sio.enter_room(sid, self.name)
-        self.emit('joined', name)
-        if player.num == 3:
-            options = self.players[1:]
-            self.players[0].emit('select_partner', [p.name for p in options])
-            for p in options: p.emit('pause')
-        return 'joined', others
-
-    def rename(self, sid, name):
-        """
-        Called to rename a player.
-
-        Arguments:
-          sid  - socket.io identifier for the user being renamed
-          name - the player's display name
-        
-        Messages emitted:
-          If the name changed this emits 'renamed' with the name and player's number (0-4).
-        """
-        p = self.player(sid)
-        if p.name != name:
-            p.name = name
-            self.emit('renamed', name, p.num)
-
-    def rejoin(self, old_sid, new_sid):
-        """
-        Called to have a player rejoin the game (after disconnect/refresh).
-
-        Arguments:
-          old_sid - old socket.io identifier for the user
-          new_sid - new socket.io identifier for the user
-
-        Returns:
-          The complete state of the game. See refresh() but this return value has the additional
-          string 'rejoined' at the beginning.
-        
-        Messages emitted:
-          This emits the 'rejoined' message with the player's number (0-4).
-        """
-        p = self.player(old_sid)
-        del self.sid2player[old_sid]
-        self.sid2player[new_sid] = p
-        p.sid = new_sid
-        p.disconnected = False # p.disconnected should be False before this
-        sio.leave_room(old_sid, self.name)
-        sio.enter_room(new_sid, self.name)
-        self.emit('rejoined', p.num)
-        return ('rejoined',) + self.refresh(new_sid)
-
-    def refresh(self, sid):
-        """
-        Called to have a player refresh their data about the game.
-
-        Arguments:
-          sid - socket.io identifier for the user
-
-        Returns:
-          Depending on the current state, this returns one of the following sets of data:
-            'waiting', player names (length 1-4)
-            'trading', ", ", player number (0-4), list of disconnected players, hand # (1+), 0/2
-                team score, 1/3 team score, list of cards in hand, list of pending trade cards (or
-                None), list of players who have traded
-            'playing', ", ", ", ", ", ", if hearts broken, 0/2 team # tricks, 1/3 team # tricks,
-                trick start player num, list of cards in trick so far, list of cards in last trick
-            'ended', ", ", ", score for 0/2, score for 1/3
-        """
-        names = [p.name for p in self.players]
-        p = self.player(sid)
-        data = (self.state, names)
-        if self.state != 'waiting':
-            data += (p.num, [p.disconnected for p in self.players], self.hand_num,
-                     self.score0, self.score1, p.hand)
-        if self.state == 'trading':
-            data += (p.pending_trade, [p.pending_trade is not None for p in self.players])
-        elif self.state == 'playing':
-            data += (self.hearts_broken, self.num_tricks0, self.num_tricks1,
-                     self.trick_start_player.num, self.trick_cards, self.last_trick)
-        elif self.state == 'ended':
-            data += (self.score0, self.score1)
-        return data
-
-    def disconnected(self, sid):
-        """
-        Called when a player disconnects form the game.
-
-        Arguments:
-          sid - socket.io identifier for the user
-
-        Returns:
-          True if there are no longer any connected players in this game, False otherwise.
-
-        Messages emitted:
-          Emits the 'disconnected' message with the player number (0-4) to the remaining players.
-        """
-        p = self.player(sid)
-        sio.leave_room(sid, self.name)
-        if self.state == 'waiting':
-            self.emit('disconnected', p.name)
-            self.players.remove(p)
-            del self.sid2player[sid]
-            return len(self.players) == 0
-        else:
-            self.emit('disconnected', p.num)
-            p.disconnected = True
-            return all(p.disconnected for p in self.players)
-
-    def partner_selected(self, partner_num):
-        other_partner_nums = sorted({1,2,3}-{partner_num})
-        new_player_order = [0, other_partner_nums[0], partner_num, other_partner_nums[1]]
-        self.players = [self.players[i] for i in new_player_order]
-        names = [p.name for p in self.players]
-        for i, p in enumerate(self.players):
-            p.num = i
-            p.emit('start_game', i, names)
-        self.start_hand()
-
-    def start_hand(self):
-        """
-        Starts a hand. This shuffles the deck, deals 13 cards to each player, and then either
-        leads into trading or playing the first time (if the hand number is a multiple of 4).
+from tornado.options import define, options, parse_command_line
+
+import asgi
+import cluster
+import eventloop
+import metrics
+import profiler
+import wire
+from assets import Assets, AssetHandler, Page, write_asset
+from bots import BotPlayers
+from cards import CARD_BITS
+from hearts import Game, EventSink, STATES
+from limits import TokenBuckets
+from names import NameAllocator
+from registry import ConnectionRegistry
+from replay import ReplayLog
+from storage import GameStore
+from timers import TimerWheel
 
-        The game's state after this method is called is either 'trading' or 'playing' depending on
-        the hand number.
 
-        Messages emitted:
-          Emits a unique 'start_hand' message to each player that contains the a list of the cards
-          (as strings like 'c5') dealt to that player and the number of the hand (with the first
-          hand being #1).
+##### Tornado Server #####
 
-          If the hand number is a multiple of 4 then there is no trading and this emits the
-          'finish_trading' message with two empty lists (see trade() for more details). This also
-          calls start_hand_after_trade() in this case which emits more messages.
-        """
-        deck = random.sample(DECK, k=52)
-        self.hand_num += 1
-        self.hearts_broken = False
-        self.num_tricks0 = self.num_tricks1 = 0
-        self.hand_score0 = self.hand_score1 = 0
-        self.trick_cards = []
-        self.last_trick = []
-        for i, p in enumerate(self.players):
-            p.hand = deck[i*13:(i+1)*13]
-            p.emit('start_hand', p.hand, self.hand_num)
-        if self.hand_num % 4 == 0:
-            # every fourth hand there is no trading
-            self.emit('finish_trade', [], [])
-            self.start_hand_after_trade()
-        else:
-            self.state = 'trading'
-    
-    def trade(self, sid, cards):
-        """
-        Called to indicate that a player has decided to trade the given list of cards.
+# List of words to create games with
+WORDS = [word.strip() for word in open('words.txt').readlines()]
 
-        Arguments:
-          sid   - socket.io identifier for the user trading the cards
-          cards - the list of cards being traded by the player (each card is a string like 'c5')
+define("address", default='', help="listen on the given address")
+define("backend", default='tornado', help="web server for the pages and socket.io: tornado or asgi (uvicorn, see asgi.py)")
+define("uvloop", default=False, help="run on uvloop's faster event loop (pip3 install uvloop)", type=bool)
+define("debug", default=False, help="render the game page again whenever game.html changes", type=bool)
+define("port", default=8000, help="run on the given port", type=int)
+define("workers", default=1, help="number of worker processes to shard the games across", type=int)
+define("worker_port", default=0, help="port of the first worker process (default is port+1)", type=int)
+define("worker", default=-1, help="(internal) shard number of this worker process", type=int)
+define("hub", default='', help="(internal) host:port of the pub/sub hub of the router process")
+define("data_dir", default='', help="directory to save games in so they survive restarts (default is to not save them)")
+define("replay_dir", default='', help="directory to log every hand played in for replay.py (default is to not log them)")
+define("spill", default=True, help="keep evicted games in progress in the data directory so they can be rejoined", type=bool)
+define("max_games", default=10000, help="maximum number of games kept in memory (0 for no limit)", type=int)
+define("ttl_waiting", default=3600, help="seconds a waiting game can be idle before it is evicted", type=int)
+define("ttl_trading", default=7200, help="seconds a trading game can be idle before it is evicted", type=int)
+define("ttl_playing", default=7200, help="seconds a playing game can be idle before it is evicted", type=int)
+define("ttl_ended", default=600, help="seconds an ended game can be idle before it is evicted", type=int)
+define("reap_interval", default=60, help="seconds between checks for idle games", type=int)
+define("hibernate_after", default=300, help="seconds a game with nothing going on can be idle before it is hibernated: only its snapshot is kept and its connections are closed until someone comes back (0 for never)", type=int)
+define("hibernate_check", default=30, help="seconds between the checks of the clients of a hibernated game for whether it woke up", type=int)
+define("bot_budget", default=1.0, help="seconds a computer player has to choose each card", type=float)
+define("bot_processes", default=0, help="number of processes for the computer players (default is one per core)", type=int)
+define("bot_takeover", default=60, help="seconds before a computer player plays for a disconnected player (0 for never)", type=float)
+define("bot_fill", default=0, help="seconds before the empty seats of a waiting game are given to computer players (0 for never)", type=float)
+define("trick_delay", default=2.0, help="seconds to pause at the end of each trick", type=float)
+define("hand_delay", default=2.0, help="seconds to pause at the end of each hand", type=float)
+define("time_scale", default=1.0, help="multiplier for the pauses after tricks and hands (0 for no pauses)", type=float)
+define("spectator_throttle", default=100, help="number of spectators of a game at which they only get the public view of the game every spectator_interval seconds instead of every message", type=int)
+define("spectator_interval", default=1.0, help="seconds between the updates of the spectators of a game with spectator_throttle or more spectators", type=float)
+define("event_rate", default=20, help="socket.io events per second allowed for each connection, with bursts up to event_burst (0 for no limit)", type=float)
+define("event_burst", default=60, help="socket.io events allowed at once for each connection", type=float)
+define("address_rate", default=100, help="socket.io events per second allowed for each client address, with bursts up to address_burst (0 for no limit)", type=float)
+define("address_burst", default=300, help="socket.io events allowed at once for each client address", type=float)
+define("max_games_per_address", default=20, help="maximum number of games in memory created by each client address (0 for no limit)", type=int)
+define("forwarded", default=False, help="take the client address from the X-Forwarded-For header (only when behind a proxy, workers always do)", type=bool)
+define("admin_token", default='', help="token for the /admin/ endpoints, sent as 'Authorization: Bearer <token>' (they are off without one)")
+define("stall_threshold", default=0.5, help="seconds a callback can block the event loop before its stack is logged (0 for never)", type=float)
+define("turn_timeout", default=0, help="seconds a player has to trade or play a card before the computer does it for them (0 for never)", type=float)
 
-        Returns:
-          'invalid' if the trade is invalid and 'pending' if the trade will be success once all
-          players have submitted their trades.
+class RedirectToGameHandler(tornado.web.RequestHandler):
+    """Redirects to a new game (three random words that aren't the name of an existing game)"""
+    def get(self):
+        name = names.allocate()
+        if name is None: raise tornado.web.HTTPError(503, 'all game names are in use')
+        self.set_header('Cache-Control', 'no-store') # every visit gets a new game
+        self.redirect(f'/{name}')
 
-        Messages emitted:
-          On a non-invalid (pending) trade this emits the 'traded' message with the player number
-          (0-4) to all players in the game.
+class PlayGameHandler(tornado.web.RequestHandler):
+    """Serves the game page (game.html is the same for every game so it is only rendered once)"""
+    def initialize(self, page):
+        self.page = page
 
-          If this is the fourth and final trade for the hand then this emits a unique
-          'finish_trade' message to each player with a list of cards that they gave and a list of
-          cards they received (each card is a string like 'c5'). This also calls
-          start_hand_after_trade() in this case which emits more messages.
-        """
-        p = self.player(sid)
-        if (self.state != 'trading' or p.pending_trade is not None or
-            len(cards) != 3 or any(card not in p.hand for card in cards)): return 'invalid'
-        p.pending_trade = cards
-        self.emit('traded', p.num)
-        if all(p.pending_trade is not None for p in self.players):
-            # done trading - actually execute them
-            trading = [self.players[i].pending_trade for i in TRADING[self.hand_num % 4]]
-            for p, trade in zip(self.players, trading):
-                p.emit('finish_trade', p.pending_trade, trade)
-                for card in p.pending_trade: p.hand.remove(card)
-                p.hand.extend(trade)
-                p.pending_trade = None
-            self.start_hand_after_trade()
-        return 'pending'
-
-    def start_hand_after_trade(self):
-        """
-        Starts a hand after the trading has been completed for the hand. This calls start_trick()
-        with the player who has the 2 of clubs.
+    def get(self, *name_parts):
+        write_asset(self, self.page.get(), 'no-cache')
 
-        The game's state after this method is called is always 'playing'.
+class ProfileHandler(tornado.web.RequestHandler):
+    """Profiles the server for a number of seconds, see admin_profile()"""
+    async def get(self):
+        arguments = {name: self.get_argument(name) for name in self.request.arguments}
+        status, content_type, body = await admin_profile(arguments, self.request.headers.get('Authorization', ''))
+        self.set_status(status)
+        self.set_header('Content-Type', content_type)
+        self.set_header('Cache-Control', 'no-store')
+        self.write(body)
+
+def load_pages():
+    """Loads the static assets and the game page as (Assets, Page)."""
+    assets = Assets(os.path.join(os.path.dirname(__file__), "static"))
+    return assets, Page(os.path.join(os.path.dirname(__file__), "game.html"), options.debug, static_url=assets.url)
+
+def make_app(socketio_handler=None, new_game_handler=None):
+    assets, page = load_pages()
+    return tornado.web.Application([
+            new_game_handler or (r"/", RedirectToGameHandler),
+            (r"/(\w+)-(\w+)-(\w+)", PlayGameHandler, dict(page=page)),
+            (r"/metrics", metrics.MetricsHandler),
+            (r"/admin/profile", ProfileHandler),
+            socketio_handler or (r"/game-io/", socketio.get_tornado_handler(sio)),
+        ],
+        static_path=assets.directory,
+        static_handler_class=AssetHandler,
+        static_handler_args=dict(assets=assets),
+        cookie_secret="boombas-cookies-123456")
 
-        Messages emitted:
-          Emits no messages on its own, but calls start_trick() which indirectly does as well.
-        """
-        p = next(p for p in self.players if 'c2' in p.hand)
-        self.start_trick(p)
-        self.state = 'playing'
+def make_asgi_app():
+    """Makes the ASGI application with the same pages as make_app() (see asgi.py)."""
+    assets, page = load_pages()
+    pages = asgi.PagesApp(assets, page, lambda: names.allocate(), {'/admin/profile': admin_profile})
+    return socketio.ASGIApp(sio, pages, socketio_path='game-io')
+
+
+##### Metrics #####
+
+handler_seconds = metrics.Histogram('hearts_handler_seconds', 'Time spent handling socket.io events', ['event'])
+game_seconds = metrics.Histogram('hearts_game_method_seconds', 'Time spent in Game methods (including the methods they call)', ['method'])
+bot_seconds = metrics.Histogram('hearts_bot_move_seconds', 'Time taken by computer players to choose a card')
+loop_lag_seconds = metrics.Histogram('hearts_loop_lag_seconds', 'How late callbacks run on the event loop',
+                                     buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10))
+events_sent = metrics.Counter('hearts_events_sent_total', 'Game events sent to players', ['event'])
+watch_batches_sent = metrics.Counter('hearts_watch_batches_sent_total', 'Batches of public game events sent to the spectators of a game (one socket.io emit to a room each)')
+watch_states_sent = metrics.Counter('hearts_watch_states_sent_total', 'Public views of games sent to throttled spectators (one socket.io emit to the rooms each)')
+batches_sent = metrics.Counter('hearts_batches_sent_total', 'Batches of game events sent to players (one socket.io emit each)')
+packets_sent = metrics.Counter('hearts_socketio_packets_sent_total', 'socket.io packets sent (emits and acknowledgements)')
+bytes_sent = metrics.Counter('hearts_socketio_sent_bytes_total', 'Size of the socket.io packets sent (text packets are counted in characters)')
+events_dropped = metrics.Counter('hearts_events_dropped_total', 'socket.io events rejected before being handled (rate limited or not valid for the game)', ['event', 'reason'])
+hibernations = metrics.Counter('hearts_hibernations_total', 'Idle games hibernated (see hibernate())')
+wakeups = metrics.Counter('hearts_wakeups_total', 'Hibernated games woken up by a player or spectator')
+rejoins = metrics.Counter('hearts_rejoins_total', 'Players rejoining games, resumed from the missed messages or with the complete state', ['kind']).label_map()
+loop_lag = metrics.LoopLagMonitor(loop_lag_seconds)
+
+# All Games are created from this subclass so that their methods are timed
+Game = metrics.timed_methods(Game, ('join', 'add_bot', 'rejoin', 'rename', 'refresh', 'disconnected',
+                                    'partner_selected', 'trade', 'play_card', 'start_hand',
+                                    '_end_trick_delayed', '_end_hand_delayed', 'snapshot'), game_seconds)
+
+def timed_event(handler):
+    """Decorator for socket.io event handlers that times them (use below @sio.event)."""
+    return metrics.timed(handler_seconds, handler.__name__)(handler)
+
+def limited(cost=1):
+    """
+    Decorator for socket.io event handlers that rate limits them for each connection and each client
+    address (use between @sio.event and @timed_event). Events over the limits return 'limited'
+    without being handled. The cost is the number of tokens the event takes (see limits.py).
+    """
+    def decorator(handler):
+        event = handler.__name__
+        @functools.wraps(handler)
+        async def limited_handler(sid, *args):
+            if not event_limits.take(sid, cost): return drop(event, 'connection_rate', 'limited')
+            address = addresses.get(sid)
+            if address is not None and not address_limits.take(address, cost):
+                return drop(event, 'address_rate', 'limited')
+            return await handler(sid, *args)
+        return limited_handler
+    return decorator
+
+def drop(event, reason, retval='invalid'):
+    """Counts an event rejected before being handled and gets the value to return for it."""
+    events_dropped.labels(event, reason).inc()
+    return retval
 
-    def start_trick(self, p):
-        """
-        Starts a trick with the given player as the player who will play the first card.
+# Longest uid, game name, and player name accepted from clients (the page limits names to 64 too),
+# this keeps them within the length prefixes of the snapshots, replay logs, and binary batches
+MAX_TEXT_LENGTH = 64
 
-        Arguments:
-          p - Player object for player who is playing the first card of the trick
+def valid_text(*values):
+    """Checks that strings sent by a client are strings that aren't empty or too long."""
+    return all(type(value) is str and 0 < len(value) <= MAX_TEXT_LENGTH for value in values)
 
-        Messages emitted:
-          Emits no messages on its own, but calls start_turn() which does.
-        """
-        self.trick_start_player = p
-        self.trick_cards = []
-        self.start_turn(p)
+def valid_cards(cards, count):
+    """Checks that cards sent by a client are a list of count card strings (like 'c5')."""
+    return type(cards) is list and len(cards) == count and all(type(card) is str and card in CARD_BITS for card in cards)
 
-    def start_turn(self, p):
-        """
-        Starts a player's turn during a trick.
+log = logging.getLogger('server')
 
-        Arguments:
-          p - Player object for player whose turn it is
+def encode_batch(messages, binary):
+    """
+    Gets a batch to send in the binary encoding (see wire.py) or as is for JSON. A batch that can't
+    be encoded is logged and sent as JSON instead (clients take either) so it doesn't stop the
+    batches of everyone else.
+    """
+    if not binary: return messages
+    try:
+        return wire.encode_batch(messages)
+    except Exception:
+        log.exception('error encoding a batch')
+        return messages
+
+def count_sent(eio):
+    """Counts the packets and bytes sent by an engine.io server (everything socket.io sends goes through send_packet())."""
+    send_packet = eio.send_packet
+    packets, size = packets_sent.labels(), bytes_sent.labels()
+    async def counted_send_packet(sid, pkt):
+        packets.value += 1
+        if isinstance(pkt.data, (str, bytes)): size.value += len(pkt.data)
+        return await send_packet(sid, pkt)
+    eio.send_packet = counted_send_packet
+
+def _count_games():
+    counts = dict.fromkeys(((state,) for state in STATES), 0)
+    for game in games.values(): counts[(game.state,)] += 1
+    return counts
+
+def _count_players():
+    counts = {('connected',): 0, ('disconnected',): 0, ('bot',): 0}
+    for game in games.values():
+        for p in game.players:
+            counts[('bot',) if p.bot else ('disconnected',) if p.disconnected else ('connected',)] += 1
+    return counts
+
+metrics.Gauge('hearts_games', 'Games in memory', _count_games, ['state'])
+metrics.Gauge('hearts_hibernated_games', 'Hibernated games (kept only as snapshots)', lambda: len(hibernated))
+metrics.Gauge('hearts_hibernated_bytes', 'Total size of the snapshots of the hibernated games', lambda: sum(len(sleeping.snapshot) for sleeping in hibernated.values()))
+metrics.Gauge('hearts_players', 'Players in the games in memory', _count_players, ['status'])
+metrics.Gauge('hearts_registry_entries', 'Entries in each index of the connection registry', lambda: {(index,): size for index, size in connections.sizes().items()}, ['index'])
+metrics.Gauge('hearts_spectators', 'Spectators watching games', lambda: sink.spectators)
+metrics.Gauge('hearts_timers_pending', 'Timers (end of tricks and hands, turn timeouts, ...) waiting to run', lambda: len(timers))
+metrics.Gauge('hearts_outboxes_pending', 'Games with events waiting to be sent', lambda: len(sink.outboxes))
+metrics.Gauge('hearts_bot_searches', 'Computer players currently choosing a card', lambda: len(bots.thinking) if bots else 0)
+metrics.Gauge('hearts_store_dirty_games', 'Games waiting to be saved', lambda: len(store.dirty) if store else 0)
+metrics.CounterFunction('hearts_hands_logged_total', 'Hands added to the replay logs', lambda: replays.hands if replays else 0)
+metrics.Gauge('hearts_name_space_size', 'Number of possible game names', lambda: names.size if names else 0)
+metrics.Gauge('hearts_name_space_used_ratio', 'Fraction of the game names handed out in the current pass over the names', lambda: names.occupancy() if names else 0)
+metrics.Gauge('hearts_names_reserved', 'Game names handed out whose games have not been created yet', lambda: len(names.reserved) if names else 0)
+metrics.Gauge('hearts_names_free', 'Released game names waiting to be reused', lambda: names.free_count if names else 0)
+metrics.CounterFunction('hearts_names_allocated_total', 'Game names handed out for new games', lambda: names.allocated if names else 0)
+metrics.CounterFunction('hearts_name_collisions_total', 'Candidate game names skipped because a game with the name exists', lambda: names.collisions if names else 0)
+metrics.CounterFunction('hearts_loop_stalls_total', 'Times a callback blocked the event loop for longer than the stall_threshold option', lambda: stall_detector.stalls if stall_detector else 0)
+metrics.Gauge('hearts_loop_lag_last_seconds', 'Last measurement of how late callbacks run on the event loop', lambda: loop_lag.last)
 
-        Messages emitted:
-          Emits the 'start_turn' message with the player's number (0-4) whose turn it is to
-          everyone in the game.
-        """
-        p.turn = True
-        self.emit('start_turn', p.num)
 
-    def play_card(self, sid, card):
-        """
-        Called when a player plays a card. Checks the card for validity and then moves the game
-        along by calling either start_turn() or end_trick().
+##### socket.io #####
 
-        Arguments:
-          sid  - socket.io identifier for the user playing the card
-          card - the card to play as a string like 'c5'
+# Dictionary of all of the games (key is game name), least recently active games first
+games = collections.OrderedDict()
 
-        Returns:
-          'invalid' if the card is invali and 'played' if the card can be played
+# The hibernated games (key is game name) with the version, state, and last activity of each, see hibernate()
+Hibernated = collections.namedtuple('Hibernated', 'version state last_active snapshot')
+hibernated = {}
 
-        Messages emitted:
-          If the played card is valid this emits the 'card_played' message with the card played
-          (as a string like 'c5') and the player's number (0-4) who played the card.
+# In sharded mode, the HashRing used to assign games to worker processes
+shard_ring = None
 
-          This also indirectly causes messsages to be emitted through the start_turn() or
-          end_trick() calls.
-        """
-        p = self.player(sid)
-        if self.state != 'playing' or not p.turn or card not in p.hand: return 'invalid'
-        first_trick = len(p.hand) == 13
-        if not self.trick_cards:
-            # First card:
-            #  * first trick must be 'c2' 
-            #  * cannot start with a point card if hearts not broken and not forced
-            if first_trick and card != 'c2' or not self.hearts_broken and p.cannot_play_point_card(card):
-                return 'invalid'
-        else:
-            # Other cards:
-            #  * must follow suit if possible
-            #  * cannot play a point card on first trick if possible
-            led = self.trick_cards[0][0]
-            if card[0] != led and p.has_suit(led) or first_trick and p.cannot_play_point_card(card):
-                return 'invalid'
-
-        p.turn = False
-        p.hand.remove(card)
-        self.trick_cards.append(card)
-        if is_point_card(card): self.hearts_broken = True
-        self.emit('card_played', card, p.num)
-
-        if len(self.trick_cards) == 4:
-            self.end_trick()
-        else:
-            self.start_turn(self.players[(p.num + 1) % 4])
-        return 'played'
+# The GameStore that games are saved to (if a data directory is given)
+store = None
 
-    def end_trick(self):
-        """
-        Ends a trick and adds the appropriate amount of points to one of the teams. This ends up
-        calling either end_hand() or start_trick() based on where in the hand it is.
+# The ReplayLog that every finished hand is logged to (if a replay directory is given)
+replays = None
 
-        Messages emitted:
-          Emits the 'end_trick' message (after a short delay) with the player number (0-4) for the
-          player who took the trick.
+# The BotPlayers that make the moves of the computer players
+bots = None
 
-          This also indirectly causes messsages to be emitted through the start_trick() or
-          end_hand() calls (both of which are only called after a delay).
-        """
-        led = self.trick_cards[0][0]
-        matching = [c for c in self.trick_cards if led == c[0]]
-        self.last_trick = self.trick_cards[:]
-        high_card = max(matching, key=card_sort_key)
-        index = self.trick_cards.index(high_card)
-        p = self.players[(index + self.trick_start_player.num) % 4]
-        points = (sum(1 for c in self.trick_cards if c[0] == 'h') +
-                  (13 if 'sQ' in self.trick_cards else 0))
-        if p.num in (0, 2):
-            self.num_tricks0 += 1
-            self.hand_score0 += points
-        else:
-            self.num_tricks1 += 1
-            self.hand_score1 += points
-        IOLoop.current().call_later(2, self._end_trick_delayed, p)
-    
-    def _end_trick_delayed(self, p):
-        """
-        The last portion of end_trick() that is delayed a few seconds before running.
-        """
-        self.emit('end_trick', p.num)
-        if not p.hand:
-            self.end_hand()
-        else:
-            self.start_trick(p)
+# The NameAllocator that hands out the names of new games
+names = None
 
-    def end_hand(self):
-        """
-        Ends a hand, tallies up the scores, and starts a new hand (if the game is still going)
-        or ends the game.
+# The StallDetector that logs what blocks the event loop (if there is a threshold)
+stall_detector = None
 
-        Messages emitted:
-          Emits the 'end_hand' message (after a delay) with the total scores for the 0/2 and 1/3
-          teams.
+# If a profile is being taken (only one at a time)
+profiling = False
 
-          This also indirectly causes messsages to be emitted through the start_hand() or
-          end_game() calls (both of which are only called after a delay).
-        """
-        score0, score1 = self.hand_score0, self.hand_score1
-        if score0 == 26:
-            score0, score1 = 0, 36
-        elif score1 == 26:
-            score0, score1 = 36, 0
-        self.score0 += score0
-        self.score1 += score1
-        IOLoop.current().call_later(2, self._end_hand_delayed)
-    
-    def _end_hand_delayed(self):
-        """
-        The last portion of end_hand() that is delayed a few seconds before running.
-        """
-        self.emit('end_hand', self.score0, self.score1)
-        if (self.score0 > SCORE_TO_WIN or self.score1 > SCORE_TO_WIN) and self.score0 != self.score1:
-            self.end_game()
-        else:
-            self.start_hand()
+# If reap() is running (only one at a time, it awaits between the games it removes)
+reaping = False
 
-    def end_game(self):
-        """
-        Ends a game. Sets the state to "ended" and sends out the final messages.
+# The ConnectionRegistry with the game and player of each connection
+connections = ConnectionRegistry()
 
-        Messages emitted:
-          Emits the 'end_game' message with the total scores for the 0/2 and 1/3 teams.
-        """
-        self.state = 'ended'
-        self.emit('end_game', self.score0, self.score1)
+# The client address of each socket.io identifier
+addresses = {}
 
+# The TokenBuckets of the socket.io events of each connection and each client address
+event_limits = TokenBuckets(0, 0)
+address_limits = TokenBuckets(0, 0)
 
-##### Tornado Server #####
+# The number of games in memory created by each client address and the address that created each game
+games_created = collections.Counter()
+game_creators = {}
 
-# List of words to create games with
-WORDS = [word.strip() for word in open('words.txt').readlines()]
+# The TimerWheel with all of the timers of the games (each game owns its timers)
+timers = TimerWheel()
 
-define("address", default='', help="listen on the given address")
-define("port", default=8000, help="run on the given port", type=int)
+# Seconds to pause at the end of each trick and hand (set from the options)
+DELAYS = {'trick': 2, 'hand': 2}
 
-class RedirectToGameHandler(tornado.web.RequestHandler):
-    """Redirects to a random game (three random words)"""
-    async def get(self):
-        name = '-'.join(random.sample(WORDS, k=3))
-        self.redirect(f'/{name}')
+# The turn timeout of each game with a player that needs to move as (turn, Timer), see turn_key()
+turn_timers = {}
 
-class PlayGameHandler(tornado.web.RequestHandler):
-    """Renders the game.html file for games"""
-    async def get(self, *name_parts):
-        self.render("game.html")
+def socketio_server(async_mode):
+    """Creates the socket.io server for a backend ('tornado' or 'asgi')."""
+    return socketio.AsyncServer(
+        async_mode=async_mode,
+        cors_allowed_origins=['https://boompahearts.coderforlife.com', 'http://localhost:8000'])
 
-def make_app():
-    return tornado.web.Application([
-            (r"/", RedirectToGameHandler),
-            (r"/(\w+)-(\w+)-(\w+)", PlayGameHandler),
-            (r"/game-io/", socketio.get_tornado_handler(sio)),
-        ],
-        static_path=os.path.join(os.path.dirname(__file__), "static"),
-        cookie_secret="boombas-cookies-123456")
+# socket.io global server variable (the handlers are moved to a new one for the asgi backend, see serve())
+sio = socketio_server('tornado')
 
+class SocketIOSink(EventSink):
+    """
+    Connects games to socket.io (each game is a room), uses the TimerWheel for the delayed calls, and
+    logs finished hands to the ReplayLog (if there is one).
+
+    Messages are sent AFTER the current message (or delayed call) is done being handled and the
+    order of messages is kept. All messages for a game queued while handling a single message are
+    sent together as a single 'batch' message to each recipient. The 'batch' message has a list of
+    [event, args, seq] that the client dispatches in order, the client keeps the last seq to resume
+    from when it reconnects (see Game.rejoin()). Clients that joined with the binary protocol get the
+    batch encoded by wire.encode_batch() instead.
+
+    Spectators of a game are in their own rooms (one for each protocol) and get the public messages
+    (see EventSink.publish()) as 'watch' batches. Each batch is encoded once and emitted to the
+    whole room (so socket.io also only encodes its packet once). When a game has spectator_throttle
+    or more spectators, they are instead sent the public view of the game (see Game.refresh()) as a
+    'watch_state' message at most every spectator_interval seconds.
+    """
+    def __init__(self):
+        self.binary = set() # socket.io identifiers of the clients using the binary protocol
+        self.watchers = {} # socket.io identifiers of the spectators of each game (key is game name, value is dictionary of protocol to set)
+        self.spectators = 0 # number of spectators of all games
+        self.public = {} # public messages waiting to be sent to the spectators (key is game name, value is list of [event, args, seq])
+        self.publishing = set() # names of the games whose public messages are being sent
+        self.outboxes = {} # messages waiting to be sent (key is Game, value is dictionary of socket.io identifier to list of [event, args, seq])
+        self.flushing = set() # games whose messages are being sent (new messages wait for it to finish)
+        self.event_counters = events_sent.label_map() # counter for each event name
+
+    def send(self, game, sid, event, args, seq):
+        outbox = self.outboxes.get(game)
+        if outbox is None:
+            outbox = self.outboxes[game] = {}
+            if game not in self.flushing: eventloop.add_callback(self.flush, game)
+        outbox.setdefault(sid, []).append([event, args, seq])
+
+    async def flush(self, game):
+        """
+        Sends all queued messages of a game, one 'batch' message per recipient. Messages queued
+        while sending are sent by the same call afterwards so that batches can't overtake each other.
+        """
+        self.flushing.add(game)
+        try:
+            while game in self.outboxes:
+                outbox = self.outboxes.pop(game)
+                if games.get(game.name) is game:
+                    touch(game)
+                    if store is not None: store.save(game)
+                    check_bots(game)
+                for sid, messages in outbox.items():
+                    batches_sent.inc()
+                    for event, _, _ in messages: self.event_counters[event].inc()
+                    data = encode_batch(messages, sid in self.binary)
+                    await sio.emit('batch', data, to=sid, ignore_queue=True)
+        finally:
+            self.flushing.discard(game)
+
+    def enter(self, game, sid):
+        eventloop.add_callback(sio.enter_room, sid, game.name) # a coroutine in newer versions
+
+    def leave(self, game, sid):
+        eventloop.add_callback(sio.leave_room, sid, game.name)
+
+    def call_later(self, game, callback, pause):
+        timers.call_later(DELAYS[pause], game, callback)
+
+    def publish(self, game, event, args, seq):
+        if game.name not in self.watchers: return
+        messages = self.public.get(game.name)
+        if messages is None:
+            messages = self.public[game.name] = []
+            if game.name not in self.publishing: eventloop.add_callback(self.flush_public, game.name)
+        messages.append([event, args, seq])
+
+    def watch(self, name, sid, protocol):
+        """Adds a spectator of a game (the room has to be entered separately)."""
+        self.watchers.setdefault(name, {'json': set(), 'binary': set()})[protocol].add(sid)
+        self.spectators += 1
+
+    def unwatch(self, name, sid):
+        """Removes a spectator of a game."""
+        watchers = self.watchers.get(name)
+        if watchers is None: return
+        for sids in watchers.values():
+            if sid in sids:
+                sids.remove(sid)
+                self.spectators -= 1
+        if not any(watchers.values()):
+            del self.watchers[name]
+            self.public.pop(name, None)
+
+    async def flush_public(self, name):
+        """
+        Sends the public messages of a game to its spectators, like flush() but to the spectator
+        rooms. When throttled this waits before sending any messages queued in the meantime.
+        """
+        self.publishing.add(name)
+        try:
+            while name in self.public:
+                messages = self.public.pop(name)
+                watchers = self.watchers.get(name)
+                if watchers is None: break
+                if sum(len(sids) for sids in watchers.values()) >= options.spectator_throttle:
+                    game = games.get(name)
+                    if game is None: continue
+                    await sio.emit('watch_state', (game.version,) + game.refresh(), ignore_queue=True,
+                                   to=[watch_room(name, protocol) for protocol, sids in watchers.items() if sids])
+                    watch_states_sent.inc()
+                    await asyncio.sleep(options.spectator_interval)
+                    continue
+                for protocol, sids in watchers.items():
+                    if not sids: continue
+                    watch_batches_sent.inc()
+                    data = encode_batch(messages, protocol == 'binary')
+                    await sio.emit('watch', data, to=watch_room(name, protocol), ignore_queue=True)
+        finally:
+            self.publishing.discard(name)
+
+    def record_hand(self, game):
+        if replays is not None: replays.record(game)
+
+# The sink for all games
+sink = SocketIOSink()
+
+def watch_room(name, protocol):
+    """Gets the name of the socket.io room of the spectators of a game that use a protocol."""
+    return f'{name}/watch/{protocol}'
+
+def forget(game):
+    """Removes a game from memory and the connection registry, cancels all of its timers, and releases its name."""
+    if games.get(game.name) is game: del games[game.name]
+    connections.remove_game(game)
+    timers.cancel_all(game)
+    turn_timers.pop(game, None)
+    release(game.name)
+
+def release(name):
+    """Releases the name of a game that is gone (and takes it off the count of the address that created it)."""
+    creator = game_creators.pop(name, None)
+    if creator is not None:
+        games_created[creator] -= 1
+        if games_created[creator] <= 0: del games_created[creator]
+    if names is not None: names.release(name)
+
+def game_exists(name):
+    """Checks if a game exists, either in memory, hibernated, or saved in the data directory."""
+    return name in games or name in hibernated or store is not None and (name in store.saved or store.dirty.get(name) is not None)
+
+def touch(game):
+    """Marks a game as active (moving it to the end of games)."""
+    game.last_active = time.monotonic()
+    games.move_to_end(game.name)
+
+def get_player(sid, event):
+    """
+    Gets the (Game, Player) for a socket.io identifier of a player and marks the game as active.
+    Returns None (and counts the dropped event) if the socket.io identifier isn't a player.
+    """
+    entry = connections.lookup(sid)
+    if entry is None:
+        drop(event, 'no_game')
+        return None
+    if games.get(entry[0].name) is entry[0]: touch(entry[0])
+    return entry
+
+def client_address(environ):
+    """Gets the client address of a socket.io connection from its WSGI-like environment."""
+    forwarded = environ.get('HTTP_X_FORWARDED_FOR')
+    if forwarded and (options.forwarded or options.worker >= 0): # the router always sets it for the workers
+        return forwarded.split(',')[-1].strip()
+    if 'tornado.handler' in environ: return environ['tornado.handler'].request.remote_ip
+    client = environ['asgi.scope'].get('client') # REMOTE_ADDR is always 127.0.0.1
+    return client[0] if client else None
+
+async def load_game(name, creator=None):
+    """
+    Gets a game from memory, wakes it up if it is hibernated, loads it from the data directory, or
+    creates it. The creator is the client address that asked for the game, if a new game is created
+    it counts towards that address's games (see the max_games_per_address option).
+    """
+    if name not in games:
+        sleeping = hibernated.pop(name, None)
+        if sleeping is not None: wakeups.inc()
+        data = sleeping.snapshot if sleeping is not None else await store.load(name) if store is not None else None
+        if name not in games: # may have been created while loading
+            game = games[name] = Game(name, sink) if data is None else Game.restore(data, sink)
+            for p in game.players: connections.add(game, p)
+            if data is None and creator is not None:
+                game_creators[name] = creator
+                games_created[creator] += 1
+            if names is not None: names.claim(name)
+            game.resume()
+            if data is not None and options.bot_takeover > 0:
+                timers.call_later(options.bot_takeover, game, check_bots, game)
+            if 0 < options.max_games < len(games): eventloop.add_callback(reap)
+    return games[name]
+
+def autoplay(p):
+    """Checks if the computer makes the moves for a player (computer players and players disconnected too long)."""
+    return p.bot or (p.disconnected and options.bot_takeover > 0 and
+                     time.monotonic() - p.disconnected_time >= options.bot_takeover)
+
+def check_bots(game):
+    """Makes the moves (or starts choosing the card) for the players in a game that the computer plays for."""
+    if bots is None or game in bots.thinking or games.get(game.name) is not game: return
+    check_turn_timeout(game)
+    if game.state == 'waiting':
+        if len(game.players) == 4 and autoplay(game.players[0]):
+            game.partner_selected(random.randint(1, 3))
+    elif game.state == 'trading':
+        for p in game.players:
+            if game.state == 'trading' and p.pending_trade is None and autoplay(p):
+                game.trade(p.sid, bots.trade(game, p))
+    elif game.state == 'playing':
+        p = next((p for p in game.players if p.turn), None)
+        if p is not None and autoplay(p): eventloop.add_callback(bot_play_card, game, p)
+
+@metrics.timed(bot_seconds)
+async def bot_play_card(game, p, turn=None):
+    """
+    Has the computer choose and play a card for a player (unless things changed while choosing).
+    The turn is given when the player ran out of time instead of being played for by the computer.
+    """
+    card = await bots.play(game, p)
+    if (p.turn and (autoplay(p) or turn is not None and turn_key(game) == turn) and
+            games.get(game.name) is game):
+        game.play_card(p.sid, card)
 
-##### socket.io #####
+def turn_key(game):
+    """
+    Gets what identifies the current turn in a game for the turn timeout, or None if there isn't a
+    player playing for themselves that needs to move. All players trade at once so trading is a
+    single turn.
+    """
+    if game.state == 'trading':
+        if any(p.pending_trade is None and not autoplay(p) for p in game.players):
+            return ('trading', game.hand_num)
+    elif game.state == 'playing':
+        p = next((p for p in game.players if p.turn), None)
+        if p is not None and not autoplay(p): return ('playing', game.hand_num, p.num, p.hand.bit_count())
+    return None
+
+def check_turn_timeout(game):
+    """Starts the turn timeout of a game when a new turn starts (cancelling the previous one)."""
+    turn = turn_key(game) if options.turn_timeout > 0 else None
+    current = turn_timers.get(game)
+    if current is not None:
+        if current[0] == turn: return
+        timers.cancel(current[1])
+        del turn_timers[game]
+    if turn is not None:
+        turn_timers[game] = (turn, timers.call_later(options.turn_timeout, game, turn_timed_out, game, turn))
+
+def turn_timed_out(game, turn):
+    """Has the computer move for the players that didn't trade or play a card in time."""
+    if games.get(game.name) is not game or turn_key(game) != turn: return
+    if game.state == 'trading':
+        for p in game.players:
+            if game.state == 'trading' and p.pending_trade is None and not autoplay(p):
+                game.trade(p.sid, bots.trade(game, p))
+    else:
+        p = next(p for p in game.players if p.turn)
+        eventloop.add_callback(bot_play_card, game, p, turn)
 
-# Dictionary of all of the games (key is game name)
-games = {}
+def fill_seats(game, num_players):
+    """Gives the empty seats of a waiting game to computer players if no one has joined or left."""
+    if games.get(game.name) is game and game.state == 'waiting' and len(game.players) == num_players:
+        while len(game.players) < 4: game.add_bot()
 
-# socket.io global server variable
-sio = socketio.AsyncServer(
-    async_mode='tornado',
-    cors_allowed_origins=['https://boompahearts.coderforlife.com', 'http://localhost:8000'])
+async def evict(game):
+    """
+    Removes a game from memory. Its connected players are disconnected (they will try to rejoin if
+    they are still around). When spilling is enabled, a game in progress stays in the data
+    directory so it is reloaded when they rejoin, otherwise its saved data is deleted.
+    """
+    forget(game)
+    if store is not None:
+        if options.spill and game.state in ('trading', 'playing'): store.save(game)
+        else: store.delete(game.name)
+    for p in game.players:
+        if not p.disconnected and not p.bot:
+            await sio.disconnect(p.sid) # no longer in the registry so the disconnect doesn't go to the evicted game
+    await sio.close_room(game.name)
+
+def passive(game):
+    """Checks if nothing is going on in a game: no delayed call, timers, events waiting to be sent, or computer player choosing a card."""
+    return (game.delayed is None and game not in timers.owners and game not in sink.outboxes and
+            (bots is None or game not in bots.thinking))
+
+async def hibernate(game):
+    """
+    Hibernates an idle game: only its snapshot is kept until load_game() wakes it up. Its connected
+    players and spectators are sent 'hibernate' with the seconds between their checks for whether
+    the game woke up and the game's version to check with (see the check event) and are
+    disconnected, so nothing of the game is left in memory. The game keeps its name and its count
+    towards the address that created it.
+    """
+    hibernated[game.name] = Hibernated(game.version, game.state, game.last_active, game.snapshot())
+    del games[game.name]
+    connections.remove_game(game)
+    turn_timers.pop(game, None)
+    hibernations.inc()
+    sids = [p.sid for p in game.players if not p.disconnected and not p.bot]
+    sids += [sid for watchers in sink.watchers.get(game.name, {}).values() for sid in watchers]
+    for sid in sids:
+        await sio.emit('hibernate', (options.hibernate_check, game.version), to=sid, ignore_queue=True)
+        await sio.disconnect(sid) # no longer in the registry so the disconnect doesn't go to the game
+    await sio.close_room(game.name)
+
+def expire(name):
+    """Removes a hibernated game that has been idle longer than the time-to-live for its state (like evict())."""
+    sleeping = hibernated.pop(name)
+    if store is not None and not (options.spill and sleeping.state in ('trading', 'playing')):
+        store.delete(name) # otherwise the data directory already has its last state
+    release(name)
+
+async def reap():
+    """
+    Evicts all games that have been idle longer than the time-to-live for their state, hibernates
+    the games with nothing going on that have been idle longer than hibernate_after, and then
+    evicts the least recently active games until there are at most max_games games. Does nothing
+    if it is already running (the running one enforces max_games at the end anyway).
+    """
+    global reaping
+    if reaping: return
+    reaping = True
+    try:
+        await _reap()
+    finally:
+        reaping = False
+
+async def _reap():
+    ttls = {'waiting': options.ttl_waiting, 'trading': options.ttl_trading,
+            'playing': options.ttl_playing, 'ended': options.ttl_ended}
+    min_ttl = min(ttls.values())
+    now = time.monotonic()
+    expired = []
+    for game in games.values():
+        idle = now - game.last_active
+        if idle < min_ttl: break # all remaining games were active more recently
+        if idle >= ttls[game.state]: expired.append(game)
+    for game in expired:
+        # each game is checked again since the earlier evictions await (it may have been active or removed since)
+        if games.get(game.name) is game and time.monotonic() - game.last_active >= ttls[game.state]:
+            await evict(game)
+    for name, sleeping in list(hibernated.items()):
+        if now - sleeping.last_active >= ttls[sleeping.state]: expire(name)
+    if options.hibernate_after > 0:
+        idle = []
+        for game in games.values():
+            if now - game.last_active < options.hibernate_after: break
+            if passive(game): idle.append(game)
+        for game in idle:
+            if (games.get(game.name) is game and passive(game) and
+                    time.monotonic() - game.last_active >= options.hibernate_after):
+                await hibernate(game)
+    while 0 < options.max_games < len(games):
+        await evict(next(iter(games.values())))
 
 @sio.event
 async def connect(sid, environ):
-    pass
+    """Records the client address of the connection (for rate limiting)."""
+    addresses[sid] = client_address(environ)
 
 @sio.event
-async def disconnect(sid):
+@timed_event
+async def disconnect(sid, reason=None):
     """Upon disconnection tell the game the sid disconnected"""
-    session = await sio.get_session(sid)
-    if 'game' in session:
-        game = session['game']
-        if game.disconnected(sid):
-            del games[game.name]
+    sink.binary.discard(sid)
+    addresses.pop(sid, None)
+    event_limits.remove(sid)
+    watching = connections.watching.pop(sid, None)
+    if watching is not None: sink.unwatch(watching, sid)
+    entry = connections.disconnect(sid)
+    if entry is not None:
+        game, p = entry
+        all_disconnected = game.disconnected(sid)
+        if p not in game.players: connections.remove(game, p) # left while waiting
+        if all_disconnected and games.get(game.name) is game:
+            forget(game)
+            if store is not None: store.delete(game.name)
             await sio.close_room(game.name)
+        elif options.bot_takeover > 0 and game.state != 'waiting':
+            timers.call_later(options.bot_takeover, game, check_bots, game)
 
 
 # socket.io events mainly just call the game methods with the same names.
 @sio.event
-async def join(sid, uid, game_name, player_name):
+@limited(5)
+@timed_event
+async def join(sid, uid, game_name, player_name, last_seq=None, protocol='json'):
     """
     Joins a game that either already has been created and needs to be created.
-    This also saves the game in the session.
+    This also adds the player to the connection registry.
 
     NOTE: The uid is the user ID, not the session ID which resets every refresh. This ID
     is generated in JS and manually sent with the message. JS should persist this value.
+    When reconnecting, the client also sends the seq of the last message it received so it only
+    gets the messages it missed (see Game.rejoin()). The protocol is either 'json' or 'binary' for
+    the compact encoding of the batches (see wire.py).
     """
-    if game_name not in games:
-        games[game_name] = Game(game_name)
-    game = games[game_name]
-
-    p = next((p for p in game.players if p.uid == uid), None)
+    if not valid_text(uid, game_name, player_name): return drop('join', 'bad_input')
+    if protocol == 'binary': sink.binary.add(sid) # before joining so the first batch is binary too
+    if shard_ring is not None and shard_ring.node(game_name) != options.worker:
+        return 'full' # game is owned by another worker, the router should never send it here
+    address = addresses.get(sid)
+    if (options.max_games_per_address > 0 and address is not None and not game_exists(game_name) and
+            games_created[address] >= options.max_games_per_address):
+        return drop('join', 'games_per_address', 'limited')
+    game = await load_game(game_name, address)
+    touch(game)
+
+    p = connections.seat(game, uid)
     if p is None:
         retval = game.join(uid, sid, player_name)
+        if retval != 'full': connections.add(game, game.player(sid))
     else:
         if not p.disconnected: return 'full'
-        retval = game.rejoin(p.sid, sid)
+        old_sid = p.sid
+        retval = game.rejoin(old_sid, sid, last_seq)
+        connections.connect(game, p, old_sid)
+        rejoins[retval[0]].inc()
     if retval != 'full':
-        session = await sio.get_session(sid)
-        session['game'] = game
-        await sio.save_session(sid, session)
+        if game.state == 'waiting' and options.bot_fill > 0:
+            timers.call_later(options.bot_fill, game, fill_seats, game, len(game.players))
     return retval
 
 @sio.event
+@limited(5)
+@timed_event
+async def watch(sid, game_name, protocol='json'):
+    """
+    Starts watching a game as a spectator. Spectators are not players of the game, they are only
+    sent the public messages of the game (see SocketIOSink). Returns 'missing' if there is no such
+    game, otherwise 'watching', the version of the game, and the public view of the game (see
+    Game.refresh()).
+    """
+    if not valid_text(game_name): return drop('watch', 'bad_input', 'missing')
+    if protocol not in ('json', 'binary') or not game_exists(game_name) or (
+            shard_ring is not None and shard_ring.node(game_name) != options.worker):
+        return 'missing'
+    game = await load_game(game_name)
+    watching = connections.watching.get(sid)
+    if watching is not None:
+        sink.unwatch(watching, sid)
+        for room in (watch_room(watching, 'json'), watch_room(watching, 'binary')): await sio.leave_room(sid, room)
+    connections.watching[sid] = game_name
+    sink.watch(game_name, sid, protocol)
+    await sio.enter_room(sid, watch_room(game_name, protocol))
+    return ('watching', game.version) + game.refresh()
+
+@sio.event
+@limited()
+@timed_event
+async def check(sid, game_name, version=None):
+    """
+    Checks if a hibernated game is still hibernated without waking it up (see hibernate()). The
+    version is the one sent with 'hibernate' (not the client's last seq, since most players weren't
+    sent the last message of the game), anything sent since then wakes the game up first. Returns
+    'hibernated' if it is still hibernated at that version, 'missing' if there is no such game,
+    otherwise 'awake' (the client should join or watch the game again).
+    """
+    if not valid_text(game_name): return drop('check', 'bad_input', 'missing')
+    sleeping = hibernated.get(game_name)
+    if sleeping is not None and sleeping.version == version: return 'hibernated'
+    return 'awake' if game_exists(game_name) else 'missing'
+
+@sio.event
+@limited()
+@timed_event
+async def my_games(sid, uid):
+    """Gets the names of the games a user has a seat in (like in other tabs), only the games of this process."""
+    return [game.name for game in connections.games(uid)]
+
+# The early checks of the state of the game reject events that can never be valid without calling
+# the game (the game methods check everything again).
+@sio.event
+@limited()
+@timed_event
+async def add_bot(sid):
+    """Adds a computer player to the game."""
+    entry = get_player(sid, 'add_bot')
+    if entry is None: return 'invalid'
+    game, _ = entry
+    if game.state != 'waiting': return drop('add_bot', 'state')
+    return game.add_bot()
+
+@sio.event
+@limited()
+@timed_event
 async def rename(sid, name):
     """Causes a player to be renamed."""
-    session = await sio.get_session(sid)
-    return session['game'].rename(sid, name)
+    if not valid_text(name): return drop('rename', 'bad_input')
+    entry = get_player(sid, 'rename')
+    if entry is None: return 'invalid'
+    return entry[0].rename(sid, name)
 
 @sio.event
+@limited()
+@timed_event
 async def partner_selected(sid, partner_num):
     """Player 0 is selecting their partner (a number 1-3)."""
-    session = await sio.get_session(sid)
-    return session['game'].partner_selected(partner_num)
+    entry = get_player(sid, 'partner_selected')
+    if entry is None: return 'invalid'
+    game, p = entry
+    if game.state != 'waiting' or p.num != 0 or len(game.players) != 4 or partner_num not in (1, 2, 3):
+        return drop('partner_selected', 'state')
+    return game.partner_selected(partner_num)
 
 @sio.event
+@limited(5)
+@timed_event
 async def refresh(sid):
     """Returns the complete data for the user to refresh the state of the game."""
-    session = await sio.get_session(sid)
-    return session['game'].refresh(sid)
+    entry = get_player(sid, 'refresh')
+    if entry is None: return 'invalid'
+    return entry[0].refresh(sid)
 
 @sio.event
-async def trade(sid, cards):
+@limited()
+@timed_event
+async def trade(sid, cards=None):
     """Marks cards for trading for the current player."""
-    session = await sio.get_session(sid)
-    return session['game'].trade(sid, cards)
+    if not valid_cards(cards, 3): return drop('trade', 'bad_input')
+    entry = get_player(sid, 'trade')
+    if entry is None: return 'invalid'
+    game, p = entry
+    if game.state != 'trading' or p.pending_trade is not None: return drop('trade', 'state')
+    return game.trade(sid, cards)
 
 @sio.event
+@limited()
+@timed_event
 async def play_card(sid, card):
     """Has the player play a card."""
-    session = await sio.get_session(sid)
-    return session['game'].play_card(sid, card)
+    entry = get_player(sid, 'play_card')
+    if entry is None: return 'invalid'
+    game, p = entry
+    if game.state != 'playing' or not p.turn: return drop('play_card', 'state')
+    return game.play_card(sid, card)
+
+##### Admin #####
+
+# Longest profile that can be asked for, in seconds
+MAX_PROFILE_SECONDS = 300
+
+async def admin_profile(arguments, authorization):
+    """
+    Profiles the server for some seconds (see profiler.py), for the /admin/profile endpoint of both
+    backends. The arguments (a dictionary of the query arguments) are 'seconds' (default 10) and
+    'format' ('json', or 'collapsed' for only the collapsed stacks to give to flamegraph.pl). The
+    JSON also has the time spent in each socket.io handler and Game method during the profile.
+    Returns (HTTP status, content type, body).
+    """
+    global profiling
+    if not options.admin_token: return 404, 'text/plain', b'not found'
+    if not hmac.compare_digest(authorization.encode(), f'Bearer {options.admin_token}'.encode()):
+        return 403, 'text/plain', b'forbidden'
+    try: seconds = float(arguments.get('seconds', 10))
+    except ValueError: seconds = 0
+    if not 0 < seconds <= MAX_PROFILE_SECONDS:
+        return 400, 'text/plain', f'seconds must be more than 0 and at most {MAX_PROFILE_SECONDS}'.encode()
+    if profiling: return 409, 'text/plain', b'a profile is already being taken'
+    profiling = True
+    try:
+        result = await profiler.profile(seconds, {'handlers': handler_seconds, 'game_methods': game_seconds})
+    finally:
+        profiling = False
+    if arguments.get('format') == 'collapsed': return 200, 'text/plain; charset=utf-8', result['collapsed'].encode('utf-8')
+    return 200, 'application/json', json.dumps(result).encode('utf-8')
+
 
 ##### Main: start the server #####
+async def serve():
+    """Starts everything that runs on the event loop and serves the pages and socket.io until stopped."""
+    global sio, shard_ring, store, replays, event_limits, address_limits, names, bots, stall_detector
+    if options.backend == 'asgi':
+        handlers, sio = sio.handlers, socketio_server('asgi')
+        sio.handlers = handlers
+    if options.workers > 1:
+        shard_ring = cluster.HashRing(range(options.workers))
+    if options.hub:
+        cluster.use_hub(sio, options.hub)
+    if options.data_dir:
+        store = GameStore(options.data_dir) # shared by all workers since each game has one owner
+        store.start()
+    if options.replay_dir:
+        replays = ReplayLog(options.replay_dir)
+        replays.start()
+    eventloop.PeriodicCallback(reap, options.reap_interval).start()
+    event_limits = TokenBuckets(options.event_rate, options.event_burst)
+    address_limits = TokenBuckets(options.address_rate, options.address_burst)
+    eventloop.PeriodicCallback(address_limits.prune, options.reap_interval).start()
+    names = NameAllocator(WORDS, game_exists, None if shard_ring is None else
+                          lambda name: shard_ring.node(name) == options.worker)
+    bots = BotPlayers(options.bot_budget, options.bot_processes)
+    count_sent(sio.eio)
+    loop_lag.start()
+    if options.stall_threshold > 0:
+        stall_detector = profiler.StallDetector(options.stall_threshold)
+        stall_detector.start()
+    try:
+        if options.backend == 'asgi':
+            await asgi.serve(make_asgi_app(), options.port, options.address)
+        else:
+            make_app().listen(options.port, address=options.address)
+            await asyncio.Event().wait() # until the process is stopped
+    finally:
+        if store is not None: store.close()
+        if replays is not None: replays.close()
+        bots.close()
+
 if __name__ == "__main__":
-    app = make_app()
-    app.listen(options.port, address=options.address)
-    IOLoop.current().start()
+    parse_command_line()
+    DELAYS['trick'] = options.trick_delay * options.time_scale
+    DELAYS['hand'] = options.hand_delay * options.time_scale
+    if options.backend not in ('tornado', 'asgi'):
+        raise SystemExit(f'unknown backend {options.backend!r}, use tornado or asgi')
+    if options.workers > 1 and options.worker < 0:
+        # Router process: serves pages itself and forwards sockets to the worker owning the game
+        app = make_app(cluster.router_handler(options.workers, options.port, options.worker_port),
+                       cluster.new_game_handler(options.workers, options.port, options.worker_port))
+        cluster.run_router(app, os.path.abspath(__file__), options.workers,
+                           options.port, options.address, options.worker_port)
+    elif options.uvloop:
+        if uvloop is None: raise SystemExit('the uvloop option needs uvloop: pip3 install uvloop')
+        uvloop.run(serve())
+    else:
+        asyncio.run(serve())
@@ -0,0 +1,240 @@
+"""
+Monte Carlo simulator for tuning the rules: plays large batches of games at once with NumPy.
+
+Every game in a batch is dealt, traded, and played in lockstep as array operations, using the same
+rules as the engine in hearts.py (legal plays from cards.legal_plays(), trick winners and points
+from Game.end_trick(), and shooting the moon from Game.end_hand()). Games that have ended just stop
+scoring while the rest of the batch keeps going. Batches are spread over all cores with a process
+pool. At the end it reports the distribution of the final scores, the number of hands per game, and
+how often the moon is shot.
+
+The score to win, the points for shooting the moon, and the trading rotation can be changed to see
+how they affect the games. For example:
+
+    python3 simulate.py --games 1000000 --score_to_win 75 --moon_points 26
+
+This requires NumPy:
+
+    pip3 install numpy
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+from cards import DECK
+from hearts import TRADING, SCORE_TO_WIN
+
+# Card index i (the index in DECK) has the suit i % 4 and the rank i // 4
+_SUITS = np.arange(52) % 4
+_POINTS = np.array([1 if card[0] == 'h' else 13 if card == 'sQ' else 0 for card in DECK])
+_IS_POINT = _POINTS > 0
+
+# The trading rotations that can be used with --trading (the rows of TRADING)
+ROTATIONS = {'keep': TRADING[0], 'left': TRADING[1], 'right': TRADING[2], 'across': TRADING[3]}
+
+
+##### Policies #####
+# Trading policies get the hands (games x 4 players x 52 cards, boolean) and a random generator and
+# return the cards to trade in the same shape (3 cards for each player). Playing policies get the
+# hands of the players whose turn it is (games x 52 cards, boolean), the mask of the legal cards in
+# the same shape, and a random generator and return the index of the card to play in each game.
+
+def _top3(scores):
+    """Gets a mask of the 3 cards with the highest score along the last axis."""
+    top = np.argpartition(-scores, 3, axis=-1)[..., :3]
+    mask = np.zeros(scores.shape, bool)
+    np.put_along_axis(mask, top, True, axis=-1)
+    return mask
+
+def random_trade(hands, rng):
+    """Trades three random cards."""
+    return _top3(np.where(hands, rng.random(hands.shape), -1))
+
+def high_trade(hands, rng):
+    """Trades the three highest ranked cards."""
+    return _top3(np.where(hands, np.arange(52), -1))
+
+def random_card(hands, legal, rng):
+    """Plays a random legal card."""
+    return np.where(legal, rng.random(legal.shape), -1).argmax(1)
+
+def low_card(hands, legal, rng):
+    """Plays the lowest ranked legal card."""
+    return legal.argmax(1)
+
+def high_card(hands, legal, rng):
+    """Plays the highest ranked legal card."""
+    return 51 - legal[:, ::-1].argmax(1)
+
+TRADE_POLICIES = {'random': random_trade, 'high': high_trade}
+CARD_POLICIES = {'random': random_card, 'low': low_card, 'high': high_card}
+
+
+##### Simulation #####
+
+def deal(n, rng):
+    """Deals n shuffled decks, returning the hands (n games x 4 players x 52 cards, boolean)."""
+    order = rng.random((n, 52)).argsort(1) # a random permutation of the deck for each game
+    seats = np.empty((n, 52), np.int8)
+    np.put_along_axis(seats, order, np.arange(52, dtype=np.int8) // 13, axis=1)
+    return seats[:, None, :] == np.arange(4, dtype=np.int8)[None, :, None]
+
+def legal_plays(hand, led, hearts_broken, first_trick):
+    """
+    Vectorized version of cards.legal_plays(). The hand is games x 52 cards (boolean), led is the
+    suit index of the first card in the trick for each game (or -1 if the card is being led), and
+    hearts_broken is a boolean for each game.
+    """
+    no_points = (hand & ~_IS_POINT).any(1) # only point cards are forced when there are no others
+    if (led < 0).all():
+        playable = hand.copy()
+        if first_trick: playable[:, 1:] = False
+        avoid = no_points & ~hearts_broken
+    else:
+        following = hand & (_SUITS == led[:, None])
+        playable = np.where(following.any(1)[:, None], following, hand)
+        avoid = no_points if first_trick else np.zeros(len(hand), bool)
+    playable[avoid[:, None] & _IS_POINT] = False
+    return playable
+
+def play_hand(hands, hand_num, trade, play, rotation, rng):
+    """Trades and plays one hand of every game, returning the points taken by each team."""
+    n = len(hands)
+    games = np.arange(n)
+    trading = rotation[hand_num % len(rotation)]
+    if trading != TRADING[0]:
+        given = trade(hands, rng)
+        hands = hands & ~given | given[:, trading]
+    hands = hands.copy()
+    leader = hands[:, :, 0].argmax(1) # the player with the 2 of clubs
+    hearts_broken = np.zeros(n, bool)
+    scores = np.zeros((n, 2), np.int64)
+    trick = np.empty((n, 4), np.int64)
+    for t in range(13):
+        led = np.full(n, -1)
+        for k in range(4):
+            seat = (leader + k) % 4
+            hand = hands[games, seat]
+            card = play(hand, legal_plays(hand, led, hearts_broken, t == 0), rng)
+            hands[games, seat, card] = False
+            trick[:, k] = card
+            hearts_broken |= _IS_POINT[card]
+            if k == 0: led = _SUITS[card]
+        # the winner has the highest card in the led suit (higher index is higher rank in a suit)
+        winner = (leader + np.where(_SUITS[trick] == led[:, None], trick, -1).argmax(1)) % 4
+        scores[games, winner % 2] += _POINTS[trick].sum(1)
+        leader = winner
+    return scores
+
+def simulate(n, seed, score_to_win=SCORE_TO_WIN, moon_points=36, rotation=TRADING,
+             trade='random', play='random'):
+    """
+    Simulates n games, returning a dictionary of arrays with an entry for each game: the final
+    scores of the two teams ('score0', 'score1'), the number of hands ('hands'), and the number of
+    times each team shot the moon ('moons0', 'moons1').
+    """
+    rng = np.random.default_rng(seed)
+    trade, play = TRADE_POLICIES[trade], CARD_POLICIES[play]
+    totals = np.zeros((n, 2), np.int64)
+    moons = np.zeros((n, 2), np.int64)
+    hands = np.zeros(n, np.int64)
+    active = np.arange(n) # the games that haven't ended yet
+    hand_num = 0
+    while len(active):
+        hand_num += 1
+        scores = play_hand(deal(len(active), rng), hand_num, trade, play, rotation, rng)
+        moon = scores == 26
+        moons[active] += moon
+        # shooting the moon gives the points to the other team instead
+        scores = np.where(moon[:, ::-1], moon_points, np.where(moon, 0, scores))
+        totals[active] += scores
+        hands[active] = hand_num
+        t = totals[active]
+        ended = (t > score_to_win).any(1) & (t[:, 0] != t[:, 1])
+        active = active[~ended]
+    return {'score0': totals[:, 0], 'score1': totals[:, 1], 'hands': hands,
+            'moons0': moons[:, 0], 'moons1': moons[:, 1]}
+
+def _simulate_batch(job):
+    return simulate(*job[0], **job[1])
+
+
+##### Reporting #####
+
+def summarize(results, elapsed):
+    """Makes the report from the results of all of the games."""
+    score0, score1, hands = results['score0'], results['score1'], results['hands']
+    moons = results['moons0'] + results['moons1']
+    winner, loser = np.maximum(score0, score1), np.minimum(score0, score1)
+    def dist(values):
+        return {'mean': float(values.mean()), 'std': float(values.std()), 'min': int(values.min()),
+                **{f'p{p}': float(np.percentile(values, p)) for p in (10, 50, 90, 99)},
+                'max': int(values.max())}
+    return {
+        'games': len(hands), 'seconds': elapsed, 'games_per_sec': len(hands) / elapsed,
+        'team0_wins': float((score0 > score1).mean()),
+        'winning_score': dist(winner), 'losing_score': dist(loser), 'margin': dist(winner - loser),
+        'hands': dist(hands),
+        'hands_histogram': {int(h): int(c) for h, c in zip(*np.unique(hands, return_counts=True))},
+        'moons_per_hand': float(moons.sum() / hands.sum()),
+        'games_with_moon': float((moons > 0).mean()),
+        'won_after_moon': float(((results['moons0'] > 0) & (score0 > score1) |
+                                 (results['moons1'] > 0) & (score1 > score0)).mean()),
+    }
+
+def main(args):
+    rotation = [ROTATIONS[name] for name in args.trading.split(',')]
+    options = dict(score_to_win=args.score_to_win, moon_points=args.moon_points, rotation=rotation,
+                   trade=args.trade, play=args.play)
+    seeds = np.random.SeedSequence(args.seed).spawn((args.games + args.batch - 1) // args.batch)
+    jobs = [((min(args.batch, args.games - i * args.batch), seed), options)
+            for i, seed in enumerate(seeds)]
+    start = time.monotonic()
+    if args.processes == 1:
+        parts = list(map(_simulate_batch, jobs))
+    else:
+        with multiprocessing.Pool(args.processes or os.cpu_count()) as pool:
+            parts = pool.map(_simulate_batch, jobs)
+    results = {key: np.concatenate([part[key] for part in parts]) for key in parts[0]}
+    report = summarize(results, time.monotonic() - start)
+
+    print(f"{report['games']} games in {report['seconds']:.1f} seconds "
+          f"({report['games_per_sec']:.0f} games/sec)")
+    for name in ('winning_score', 'losing_score', 'margin', 'hands'):
+        d = report[name]
+        print(f"  {name:14} mean {d['mean']:6.1f}  std {d['std']:5.1f}  " +
+              '  '.join(f"{p} {d[p]:5.0f}" for p in ('min', 'p10', 'p50', 'p90', 'p99', 'max')))
+    print(f"  team 0/2 wins {100 * report['team0_wins']:.1f}% of games")
+    print(f"  moon shot in {100 * report['moons_per_hand']:.2f}% of hands "
+          f"({100 * report['games_with_moon']:.1f}% of games, "
+          f"{100 * report['won_after_moon']:.1f}% of games won by a team that shot it)")
+    print('  hands per game: ' + ', '.join(f'{h}: {100 * c / report["games"]:.1f}%'
+                                          for h, c in report['hands_histogram'].items()))
+    if args.json:
+        with open(args.json, 'w') as f: json.dump(report, f, indent=2)
+    return report
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--games', type=int, default=100000, help='number of games to simulate')
+    parser.add_argument('--batch', type=int, default=10000, help='number of games simulated together by each process')
+    parser.add_argument('--processes', type=int, default=0, help='number of processes (default is one per core)')
+    parser.add_argument('--seed', type=int, help='seed for reproducible results')
+    parser.add_argument('--score_to_win', type=int, default=SCORE_TO_WIN, help='game ends once a team has more than this')
+    parser.add_argument('--moon_points', type=int, default=36, help='points the other team gets when the moon is shot')
+    parser.add_argument('--trading', default='keep,left,right,across',
+                        help='trading rotation by hand number mod its length (comma-separated, '
+                             'from: ' + ', '.join(ROTATIONS) + ')')
+    parser.add_argument('--trade', choices=TRADE_POLICIES, default='random', help='trading policy')
+    parser.add_argument('--play', choices=CARD_POLICIES, default='random', help='playing policy')
+    parser.add_argument('--json', help='also write the results to this JSON file')
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    main(parse_args())
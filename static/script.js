@@ -9,15 +9,39 @@ const STATE_TRADING = 1;
 const STATE_PLAYING = 2;
 let state = STATE_WAITING;
 let joined = false;
+let last_seq = null; // sequence number of the last message received, sent when rejoining to only get the missed messages
+let rejoin = null; // function that joins or watches the game again once (re)connected
+// While the game is hibernated on the server (see the 'hibernate' message) the socket is only
+// connected every so often to check if the game woke up, until the user does something
+let hibernating = false, hibernate_timer = null, hibernate_check = 30, hibernate_version = null;
 
 const SUITS = 'cdsh';
 const CARDS = '234567891JQKA';
 
+// Batches are sent in the compact binary encoding when the browser can decode it (see wire.py)
+const PROTOCOL = window.TextDecoder ? 'binary' : 'json';
+// Cards in the order of the server's deck (by rank then suit), binary messages use the index in it
+const DECK = ['2', '3', '4', '5', '6', '7', '8', '9', '10', 'J', 'Q', 'K', 'A'].flatMap((rank) => [...'cdhs'].map((suit) => suit + rank));
+// Event name and argument layout for each code of binary messages, must match EVENTS in wire.py
+const WIRE_EVENTS = [
+    ['joined', 's'], ['renamed', 'sn'], ['rejoined', 'n'], ['disconnected', 'n'], ['disconnected', 's'],
+    ['select_partner', 'S'], ['pause', ''], ['start_game', 'nS'], ['start_hand', 'Hi'], ['traded', 'n'],
+    ['finish_trade', 'CC'], ['start_turn', 'n'], ['card_played', 'cn'], ['end_trick', 'n'],
+    ['end_hand', 'ii'], ['end_game', 'ii'], ['start_game', 'S'], ['start_hand', 'i'], ['finish_trade', ''],
+];
+const WIRE_JSON = 255;
+
+// Spectators open the game with ?watch, they only see the public view of the game (the backs of every hand)
+const WATCHING = new URLSearchParams(window.location.search).has('watch');
+
 // Messages
 const GAME_URL = location.href.replace(/^https?:\/\//i, "");
 const WELCOME_HEADER = "<h1><img src='/static/favicon.svg'> Welcome to Boompa's Hearts Table! <img src='/static/favicon.svg'></h1>";
-const MSG_WELCOME = WELCOME_HEADER + `<center>Waiting for other players to join...<br>Tell others to go to <br><b>${GAME_URL}</b><br> to join this game!<br><br></center><div>Here so far are:</div><ul id='names'></ul>`;
-const MSG_FULL_GAME = 'Game is full. <a href="/">Create a new game?</a>';
+const MSG_WELCOME = WELCOME_HEADER + `<center>Waiting for other players to join...<br>Tell others to go to <br><b>${GAME_URL}</b><br> to join this game!<br><br><input type='button' id='add-bot' value='Add a computer player'><br><br></center><div>Here so far are:</div><ul id='names'></ul>`;
+const MSG_FULL_GAME = 'Game is full. <a href="?watch">Watch it</a> or <a href="/">create a new game?</a>';
+const MSG_MISSING_GAME = 'There is no game to watch here. <a href="/">Create a new game?</a>';
+const MSG_WATCH_WAITING = WELCOME_HEADER + '<center>Watching the game, waiting for the players to join...</center><div>Here so far are:</div><ul id="names"></ul>';
+const MSG_LIMITED = 'Slow down! Too many requests (or too many games) from here. <a href="">Try again?</a>';
 const MSG_INVALID_MOVE = '<center style="font-size:1.5em"><img style="width:10em" src="/static/images/evileye.png"><br>The Evil Eye is always watching!<br>Invalid Move!</center>';
 const MSG_PROMPT_NAME = 'Player name:';
 const MSG_PROMPT_PARTNER = "Who's the Granny to your Boompa?";
@@ -130,7 +154,7 @@ function dismiss_all_overlay_messages() {
  * Displays the initial waiting message to the user.
  */
 function display_waiting_message() {
-    display_overlay_message(MSG_WELCOME, 'waiting');
+    display_overlay_message(WATCHING ? MSG_WATCH_WAITING : MSG_WELCOME, 'waiting');
 }
 
 /**
@@ -278,6 +302,55 @@ function get_winning_card(cards) {
     return cards[found];
 }
 
+/**
+ * Decodes a batch in the binary encoding into a list of [event, args, seq], see wire.py.
+ */
+function decode_batch(buffer) {
+    let view = new DataView(buffer), bytes = new Uint8Array(buffer), decoder = new TextDecoder();
+    let batch = [], pos = 0;
+    let read_str = () => {
+        let length = view.getUint16(pos);
+        pos += 2 + length;
+        return decoder.decode(bytes.subarray(pos - length, pos));
+    };
+    while (pos < bytes.length) {
+        let code = bytes[pos], seq = view.getUint32(pos + 1);
+        pos += 5;
+        if (code === WIRE_JSON) {
+            let [event, args] = JSON.parse(read_str());
+            batch.push([event, args, seq]);
+            continue;
+        }
+        let [event, layout] = WIRE_EVENTS[code];
+        let args = [];
+        for (let kind of layout) {
+            if (kind === 'n') { args.push(bytes[pos++]); }
+            else if (kind === 'i') { args.push(view.getUint16(pos)); pos += 2; }
+            else if (kind === 'c') { args.push(DECK[bytes[pos++]]); }
+            else if (kind === 'C') {
+                let count = bytes[pos++];
+                args.push(Array.from(bytes.subarray(pos, pos + count), (i) => DECK[i]));
+                pos += count;
+            } else if (kind === 'H') {
+                // 64-bit mask as two 32-bit halves, bit i is DECK[i]
+                let cards = [], high = view.getUint32(pos), low = view.getUint32(pos + 4);
+                for (let i = 0; i < 52; i++) {
+                    if ((i < 32 ? low >>> i : high >>> (i - 32)) & 1) { cards.push(DECK[i]); }
+                }
+                args.push(cards);
+                pos += 8;
+            } else if (kind === 's') { args.push(read_str()); }
+            else { // 'S'
+                let count = bytes[pos++], strings = [];
+                for (let i = 0; i < count; i++) { strings.push(read_str()); }
+                args.push(strings);
+            }
+        }
+        batch.push([event, args, seq]);
+    }
+    return batch;
+}
+
 /**
  * Card comparator function used to sort card names.
  */
@@ -347,7 +420,7 @@ function on_action_click(e) {
     //   otherwise, end the turn/trade
     function callback(msg) {
         console.log("action ack", msg);
-        if (msg === 'invalid') {
+        if (msg === 'invalid' || msg === 'limited') {
             alert_message(MSG_INVALID_MOVE);
         } else {
             action_button.disabled = true;
@@ -374,6 +447,8 @@ function join_ack(msg, ...args) {
     console.log("join ack", msg, args);
     if (msg === 'full') {
         display_error_message(MSG_FULL_GAME);
+    } else if (msg === 'limited') {
+        display_error_message(MSG_LIMITED);
     } else {
         joined = true;
         if (msg === 'joined') {
@@ -389,7 +464,11 @@ function join_ack(msg, ...args) {
                 }
             }
         } else if (msg === 'rejoined') {
-            refresh_display(args);
+            last_seq = args[0];
+            refresh_display(args.slice(1));
+        } else if (msg === 'resumed') {
+            // the missed messages are sent again so only the disconnected message needs to go away
+            dismiss_overlay_message('error', true);
         }
     }
 }
@@ -417,10 +496,10 @@ function refresh_display(args) {
     
     } else {
         let [player_num, disconnected, hand_num, score_02, score_13, hand] = args.slice(2, 8);
-        my_player_num = player_num;
+        if (!WATCHING) { my_player_num = player_num; } // spectators watch from player #0's seat
 
         // Setup status info and names
-        let tb_is_0 = player_num === 0 || player_num === 2;
+        let tb_is_0 = my_player_num === 0 || my_player_num === 2;
         let [score_tb, score_lr] = tb_is_0 ? [score_02, score_13] : [score_13, score_02];
         status_box.querySelector('.hand').textContent = hand_num;
         status_box.querySelector('.score-tb').textContent = score_tb;
@@ -435,20 +514,30 @@ function refresh_display(args) {
             if (disconnected[i]) { document.getElementById(player_position(i)).classList.add('disconnected'); }
         }
     
-        // Setup hand
-        hand.sort(card_comparator);
-        player_hand.textContent = '';
-        for (let card of hand) {
-            player_hand.appendChild(document.createElement('div')).className = `card ${card}`;
-        }
-        for (let pos of ['left', 'top', 'right']) {
-            let ph = document.querySelector(`#${pos} .hand`);
-            ph.textContent = '';
-            while (ph.childElementCount < hand.length) {
-                ph.appendChild(document.createElement('div')).className = 'card';
+        // Setup hand (spectators get the number of cards in each player's hand instead)
+        if (WATCHING) {
+            for (let i = 0; i < 4; i++) {
+                let ph = document.querySelector(`#${player_position(i)} .hand`);
+                ph.textContent = '';
+                while (ph.childElementCount < hand[i]) {
+                    ph.appendChild(document.createElement('div')).className = 'card';
+                }
             }
+        } else {
+            hand.sort(card_comparator);
+            player_hand.textContent = '';
+            for (let card of hand) {
+                player_hand.appendChild(document.createElement('div')).className = `card ${card}`;
+            }
+            for (let pos of ['left', 'top', 'right']) {
+                let ph = document.querySelector(`#${pos} .hand`);
+                ph.textContent = '';
+                while (ph.childElementCount < hand.length) {
+                    ph.appendChild(document.createElement('div')).className = 'card';
+                }
+            }
+            for (let card of player_hand.children) { card.addEventListener('click', on_card_click); }
         }
-        for (let card of player_hand.children) { card.addEventListener('click', on_card_click); }
 
         // Clear/reset lots of things
         current_hand.textContent = '';
@@ -472,7 +561,9 @@ function refresh_display(args) {
                     document.getElementById(player_position(i)).classList.add('traded');
                 }
             }
-            if (pending_trade === null) {
+            if (WATCHING) {
+                // nothing to trade
+            } else if (pending_trade === null) {
                 let trade_dir = hand_num % 4;
                 action_button.value = 'Trade '+('·︎↖︎↗︎↑︎'.substring(2*trade_dir, 2*trade_dir+2));
                 action_button.style.display = 'block';
@@ -488,7 +579,8 @@ function refresh_display(args) {
             let [nt_tb, nt_lr] = tb_is_0 ? [nt0, nt1] : [nt1, nt0];
             let cur_player_num = (trick_start_player + trick_cards.length) % 4;
             let turns = player_num - trick_start_player;
-            let played = 0 <= turns && turns < trick_cards.length || turns + 4 < trick_cards.length;
+            // the hand sizes spectators get already have the cards in the trick removed
+            let played = WATCHING || 0 <= turns && turns < trick_cards.length || turns + 4 < trick_cards.length;
 
             status_box.querySelector('.tricks-tb').textContent = nt_tb;
             status_box.querySelector('.tricks-lr').textContent = nt_lr;
@@ -510,29 +602,35 @@ function refresh_display(args) {
                 get_winning_card(last_hand.querySelectorAll('.card')).classList.add('selected');
             }
 
-            if (played) {
+            if (played && !WATCHING) {
                 for (let i = trick_cards.length; i < 4; i++) {
                     let player = player_position((trick_start_player + i) % 4);
                     document.querySelector(`#${player} .hand`).appendChild(document.createElement('div')).className = 'card';
                 }
-            } else if (cur_player_num === player_num) {
+            } else if (cur_player_num === player_num && !WATCHING) {
                 action_button.value = 'Play';
                 action_button.style.display = 'block';
                 state = STATE_PLAYING;
             }
 
         } else if (refresh_state === 'ended') {
-            let msg = (score_tb < score_lr) ? MSG_WON : MSG_LOST;
-            msg += `<br><center>Final score: ${score_tb} to ${score_lr}<br><a href="/">Create a new game?</a></center>`;
-            display_overlay_message(msg, 'ended');
+            display_overlay_message(end_game_message(score_tb, score_lr), 'ended');
         }
     }
 }
 
+/**
+ * Gets the message shown at the end of the game from the scores of the top/bottom and left/right
+ * teams.
+ */
+function end_game_message(score_tb, score_lr) {
+    let msg = WATCHING ? `<center style="font-size:1.5em"><b>Game over!</b></center>` : (score_tb < score_lr) ? MSG_WON : MSG_LOST;
+    return msg + `<br><center>Final score: ${score_tb} to ${score_lr}<br><a href="/">Create a new game?</a></center>`;
+}
+
 window.addEventListener('pageshow', function load() {
-    // Preload common images
-    new Image().src = 'static/images/deck.svg';
-    for (let img of ['back', 'evileye']) { new Image().src = `static/images/${img}.png`; } // no: won, loss, shot_we, or shot_they
+    // Preload common images (no: won, loss, shot_we, or shot_they), full paths so they are fingerprinted by the server
+    for (let src of ['/static/images/cards.svg', '/static/images/back.png', '/static/images/evileye.png']) { new Image().src = src; }
 
     // Setup global variables
     action_button = document.getElementById('action');
@@ -544,6 +642,18 @@ window.addEventListener('pageshow', function load() {
     action_button.addEventListener('click', on_action_click);
     document.getElementById('help').addEventListener('click', display_help_message);
 
+    // The waiting message (with the add computer player button) is recreated each time it is shown
+    document.addEventListener('click', function(e) {
+        if (e.target.id === 'add-bot') { socket.emit('add_bot'); }
+    });
+
+    // Spectators watch from player #0's seat and don't need a name
+    if (WATCHING) {
+        my_player_num = 0;
+        watch();
+        return;
+    }
+
     // Clicking the name allows the user to rename
     player.querySelector('.name').addEventListener('click', function() {
         text_prompt(MSG_PROMPT_NAME, function(name) {
@@ -586,18 +696,149 @@ function setup(name) {
         localStorage.setItem('uid', uid);
     }
 
-    // Setup socket
-    socket = io(window.location.origin, {path: '/game-io/'});
-    socket.on('connect', () => {
-        console.log('connect', socket.id);
+    // Setup socket (the game name lets the server route it to the process that owns the game)
+    socket = io(window.location.origin, {path: '/game-io/', query: {game: GAME}});
+    rejoin = () => {
         if (joined) {
             // We were previously joined but got reconnected, need to send the join event again
-            socket.emit('join', uid, GAME, name, join_ack);
+            socket.emit('join', uid, GAME, name, last_seq, PROTOCOL, join_ack);
+        }
+    };
+    socket.on('connect', on_connect);
+    add_handlers();
+
+    // Join the game!
+    socket.emit('join', uid, GAME, name, null, PROTOCOL, join_ack);
+}
+
+/**
+ * Setup watching the game as a spectator. Spectators get 'watch' batches with the public messages
+ * of the game which go to the same handlers as the players' messages except for the few that are
+ * only for spectators (see WATCH_HANDLERS). When a game has lots of spectators the server instead
+ * sends the public view of the whole game every so often ('watch_state').
+ */
+function watch() {
+    setTimeout(display_waiting_message, 0);
+    socket = io(window.location.origin, {path: '/game-io/', query: {game: GAME}});
+    rejoin = () => {
+        socket.emit('watch', GAME, PROTOCOL, (msg, ...args) => {
+            console.log("watch ack", msg, args);
+            if (msg === 'missing') {
+                display_error_message(MSG_MISSING_GAME);
+            } else {
+                last_seq = args[0];
+                refresh_display(args.slice(1));
+            }
+        });
+    };
+    socket.on('connect', on_connect);
+    socket.on('watch', (batch) => {
+        if (batch instanceof ArrayBuffer) { batch = decode_batch(batch); }
+        for (let [event, args, seq] of batch) {
+            if (seq <= last_seq) { continue; } // already in the public view from watching
+            last_seq = seq;
+            let handlers = WATCH_HANDLERS[event] ? [WATCH_HANDLERS[event]] : socket.listeners(event);
+            for (let handler of handlers) { handler(...args); }
         }
     });
+    socket.on('watch_state', (seq, ...args) => {
+        last_seq = seq;
+        refresh_display(args);
+    });
+    add_handlers();
+}
+
+// Handlers of the messages that are different for spectators (see Game.publish() in hearts.py)
+const WATCH_HANDLERS = {
+    start_game(names) {
+        console.log('start_game', names);
+        dismiss_overlay_message('waiting', true);
+        for (let i = 0; i < names.length; i++) {
+            document.querySelector(`#${player_position(i)} .name`).textContent = names[i];
+        }
+        status_box.querySelector('.names-tb').textContent = get_top_and_bottom_names();
+        status_box.querySelector('.names-lr').textContent = get_left_and_right_names();
+    },
+    start_hand(hand_num) {
+        console.log('start_hand', hand_num);
+        for (let pos of ['bottom', 'left', 'top', 'right']) {
+            let hand = document.querySelector(`#${pos} .hand`);
+            while (hand.childElementCount < 13) {
+                hand.appendChild(document.createElement('div')).className = 'card';
+            }
+        }
+        last_hand.textContent = '';
+        for (let player of document.querySelectorAll('.player.current')) { player.classList.remove('current'); }
+        status_box.querySelector('.hand').textContent = hand_num;
+        status_box.querySelector('.tricks-tb').textContent = 0;
+        status_box.querySelector('.tricks-lr').textContent = 0;
+        status_box.querySelector('.tricks-tb').classList.remove('has-point');
+        status_box.querySelector('.tricks-lr').classList.remove('has-point');
+        document.body.className = hand_num % 4 !== 0 ? 'trading' : 'playing';
+    },
+    finish_trade() {
+        console.log('finish_trade');
+        document.body.className = 'playing';
+        for (let player of document.querySelectorAll('.traded')) { player.classList.remove('traded'); }
+    },
+};
+
+/**
+ * Called whenever the socket connects. While the game is hibernated this only checks if it woke up
+ * (and disconnects again if it didn't), otherwise this joins or watches the game again.
+ */
+function on_connect() {
+    console.log('connect', socket.id);
+    if (!hibernating) {
+        rejoin();
+        return;
+    }
+    socket.emit('check', GAME, hibernate_version, (msg) => {
+        console.log("check ack", msg);
+        if (!hibernating) { return; } // woken up by the user while checking
+        if (msg === 'hibernated') {
+            socket.disconnect();
+            hibernate_timer = setTimeout(() => socket.connect(), hibernate_check * 1000);
+        } else {
+            hibernating = false;
+            rejoin();
+        }
+    });
+}
+
+/**
+ * Stops hibernating when the user does something, reconnecting right away (which wakes up the game).
+ */
+function wake_up() {
+    if (!hibernating || document.visibilityState === 'hidden') { return; }
+    hibernating = false;
+    clearTimeout(hibernate_timer);
+    if (socket.connected) { rejoin(); } else { socket.connect(); }
+}
+
+for (let event of ['click', 'keydown', 'focus', 'visibilitychange']) {
+    window.addEventListener(event, wake_up);
+}
+
+/**
+ * Registers the handlers of all of the messages of the game (for both players and spectators).
+ */
+function add_handlers() {
+    // The server hibernates games that are idle and closes their connections, this lets it go
+    // quietly and checks back every check_seconds with the game's version when it was hibernated
+    socket.on('hibernate', (check_seconds, version) => {
+        console.log('hibernate', check_seconds, version);
+        hibernating = true;
+        hibernate_check = check_seconds;
+        hibernate_version = version;
+        socket.disconnect();
+        hibernate_timer = setTimeout(() => socket.connect(), hibernate_check * 1000);
+    });
+
     socket.on('disconnect', (reason) => {
         // See https://socket.io/docs/v3/client-api/index.html#Event-%E2%80%98disconnect%E2%80%99
         console.log('disconnect', reason);
+        if (hibernating) { return; }
         display_overlay_message(
             `<p>Disconnected from server: ${reason}.</p><p>Wait to be automatically reconnected to the server or you may try <a href="javascript:window.location.reload(true)">refreshing</a>.</p>`,
             'error'
@@ -611,6 +852,16 @@ function setup(name) {
     //      );
     // });
 
+    // The server sends all of the messages caused by a single event together as one batch of
+    // [event, args, seq], dispatch them to the handlers below in order
+    socket.on('batch', (batch) => {
+        if (batch instanceof ArrayBuffer) { batch = decode_batch(batch); }
+        for (let [event, args, seq] of batch) {
+            last_seq = seq;
+            for (let handler of socket.listeners(event)) { handler(...args); }
+        }
+    });
+
     socket.on('joined', (name) => {
         console.log('joined', name);
         let names_box = document.getElementById('names');
@@ -743,7 +994,7 @@ function setup(name) {
         console.log('start_turn', player_num);
         for (let player of document.querySelectorAll('.player.current')) { player.classList.remove('current'); }
         document.getElementById(player_position(player_num)).classList.add('current');
-        if (player_num === my_player_num) {
+        if (player_num === my_player_num && !WATCHING) {
             action_button.value = 'Play';
             action_button.disabled = true;
             action_button.style.display = 'block';
@@ -755,7 +1006,7 @@ function setup(name) {
         console.log('card_played', card, player_num);
         let player = player_position(player_num);
         let selector = `#${player} .hand .card`
-        if (player_num === my_player_num) { selector += `.${card}` }
+        if (player_num === my_player_num && !WATCHING) { selector += `.${card}` }
         document.querySelector(selector).remove();
         document.getElementById(player).classList.remove('disconnected');
         current_hand.appendChild(document.createElement('div')).className = `${player} card ${card}`;
@@ -799,7 +1050,9 @@ function setup(name) {
         status_box.querySelector('.score-tb').textContent = score_tb;
         status_box.querySelector('.score-lr').textContent = score_lr;
         hearts_broken = false;
-        if (score_tb-old_tb_score === 0) {
+        if (WATCHING) {
+            // spectators aren't on either team
+        } else if (score_tb-old_tb_score === 0) {
             alert_message(MSG_WE_SHOT_THE_MOON);
         } else if (score_lr-old_lr_score === 0) {
             alert_message(MSG_THEY_SHOT_THE_MOON);
@@ -810,13 +1063,7 @@ function setup(name) {
         console.log('end_game', score_02, score_13);
         let tb_is_0 = my_player_num === 0 || my_player_num === 2;
         let [score_tb, score_lr] = tb_is_0 ? [score_02, score_13] : [score_13, score_02];
-        let msg = (score_tb < score_lr) ? MSG_WON : MSG_LOST;
-        msg += `<br><center>Final score: ${score_tb} to ${score_lr}<br><a href="/">Create a new game?</a></center>`;
-        display_overlay_message(msg, 'ended');
+        display_overlay_message(end_game_message(score_tb, score_lr), 'ended');
         document.body.className = 'ended';
     });
-
-    
-    // Join the game!
-    socket.emit('join', uid, GAME, name, join_ack);
 }
@@ -0,0 +1,142 @@
+"""
+Persistence of games to local disk so that games in progress survive a restart or deploy.
+
+Each game has its own append-only log file in the data directory. Every record in the log is a
+complete snapshot of the game (see Game.snapshot(), they are only a few hundred bytes) so a game is
+restored from just the last valid record. Once a log has enough records it is compacted down to a
+single record. Snapshots are taken on the event loop (which is cheap) but all disk access happens
+in batches on a single background thread so that it never blocks the event loop.
+
+Log file format (version 1):
+  header: the 4 bytes b'BHGL' and the version as a single byte
+  records: 4-byte big-endian length of the snapshot, 4-byte big-endian CRC32 of the snapshot, and
+    the snapshot itself; a truncated or corrupt record at the end (from a crash) is ignored
+"""
+
+import logging
+import os
+import re
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import eventloop
+
+LOG_MAGIC = b'BHGL'
+LOG_VERSION = 1
+_HEADER = LOG_MAGIC + bytes((LOG_VERSION,))
+_RECORD = struct.Struct('>II')
+
+# Only games with names like the ones generated by the server are stored (also keeps the names safe
+# to use as file names)
+_NAME_RE = re.compile(r'\w+-\w+-\w+')
+
+log = logging.getLogger('storage')
+
+
+class GameStore:
+    """Saves snapshots of games to a data directory and loads them back."""
+    def __init__(self, path, interval=1.0, compact_after=64):
+        self.path = path # directory that the game logs are saved in
+        self.interval = interval # seconds between writing batches of snapshots
+        self.compact_after = compact_after # number of records in a log that causes it to be compacted
+        self.dirty = {} # games that need to be written (key is game name, value is Game or None to delete)
+        self.saved = set() # names of all games with logs on disk
+        self.records = {} # number of records in each log, only used by the writer thread
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix='storage')
+        self.callback = None
+        os.makedirs(path, exist_ok=True)
+        for filename in os.listdir(path):
+            name, ext = os.path.splitext(filename)
+            if ext == '.log' and _NAME_RE.fullmatch(name): self.saved.add(name)
+
+    def start(self):
+        """Starts writing batches of snapshots periodically."""
+        self.callback = eventloop.PeriodicCallback(self.write, self.interval)
+        self.callback.start()
+
+    def _filename(self, name):
+        return os.path.join(self.path, name + '.log')
+
+    def save(self, game):
+        """Marks a game as changed so it is saved in the next batch."""
+        if _NAME_RE.fullmatch(game.name):
+            self.dirty[game.name] = game
+
+    def delete(self, name):
+        """Marks a game as no longer existing so its log is deleted in the next batch."""
+        if name in self.saved or name in self.dirty:
+            self.dirty[name] = None
+
+    def write(self):
+        """
+        Snapshots all changed games and writes them in the background. Returns a future that
+        completes once written (or None if there was nothing to write).
+        """
+        if not self.dirty: return None
+        batch = []
+        for name, game in self.dirty.items():
+            try:
+                data = game.snapshot() if game is not None and game.state != 'waiting' else None
+            except Exception: # one bad game doesn't stop the others from being saved
+                log.exception('error taking the snapshot of game %s', name)
+                continue
+            if data is None and name not in self.saved: continue
+            batch.append((name, data))
+            if data is None: self.saved.discard(name)
+            else: self.saved.add(name)
+        self.dirty.clear()
+        return eventloop.run_in_executor(self.executor, self._write_batch, batch)
+
+    def _write_batch(self, batch):
+        """Writes a batch of (name, snapshot) pairs, run on the writer thread."""
+        for name, data in batch:
+            filename = self._filename(name)
+            if data is None:
+                self.records.pop(name, None)
+                try: os.remove(filename)
+                except FileNotFoundError: pass
+                continue
+            record = _RECORD.pack(len(data), zlib.crc32(data)) + data
+            count = self.records.get(name, 0)
+            if count == 0 or count >= self.compact_after:
+                # new log or compacting the log: atomically replace it with a single record
+                with open(filename + '.tmp', 'wb') as f:
+                    f.write(_HEADER + record)
+                os.replace(filename + '.tmp', filename)
+                count = 0
+            else:
+                with open(filename, 'ab') as f:
+                    f.write(record)
+            self.records[name] = count + 1
+
+    async def load(self, name):
+        """
+        Loads the last snapshot of a game from its log (after any pending writes are done). Returns
+        None if there is no saved game with the name.
+        """
+        if name not in self.saved: return None
+        if name in self.dirty: await self.write()
+        return await eventloop.run_in_executor(self.executor, self._read, name)
+
+    def _read(self, name):
+        """Reads the last valid snapshot from a log, run on the writer thread."""
+        try:
+            with open(self._filename(name), 'rb') as f: data = f.read()
+        except FileNotFoundError:
+            return None
+        if data[:len(_HEADER)] != _HEADER: return None
+        pos, last = len(_HEADER), None
+        while pos + _RECORD.size <= len(data):
+            length, crc = _RECORD.unpack_from(data, pos)
+            snapshot = data[pos + _RECORD.size:pos + _RECORD.size + length]
+            if len(snapshot) != length or zlib.crc32(snapshot) != crc: break
+            last = snapshot
+            pos += _RECORD.size + length
+        return last
+
+    def close(self):
+        """Writes all remaining snapshots and waits for them to be on disk."""
+        if self.callback is not None: self.callback.stop()
+        self.write()
+        self.executor.shutdown(wait=True)
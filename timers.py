@@ -0,0 +1,117 @@
+"""
+Hashed timer wheel that owns all of the timers of the games (the pauses after tricks and hands,
+turn timeouts, computer player takeovers, ...).
+
+Each timer goes in the slot of the wheel for the tick it is due in, along with the number of full
+turns of the wheel it still has to wait for when its delay is longer than the wheel. Scheduling and
+cancelling are O(1) and the event loop only ever has the single callback that advances the wheel instead
+of a timer in its heap for each table. Every timer has an owner (its game) and all of the timers of
+an owner can be cancelled at once when it is removed. Timers can fire up to one tick late, timers
+with no delay run on the next iteration of the event loop. A callback that raises is logged and
+doesn't stop the other timers.
+"""
+
+import logging
+import math
+
+import eventloop
+
+log = logging.getLogger('timers')
+
+class Timer:
+    """A callback waiting in a TimerWheel, can be given to TimerWheel.cancel()."""
+    __slots__ = ('callback', 'args', 'owner', 'slot', 'rounds')
+
+    def __init__(self, callback, args, owner, rounds):
+        self.callback = callback
+        self.args = args
+        self.owner = owner
+        self.slot = None # the dictionary the timer is waiting in, None once it has run or been cancelled
+        self.rounds = rounds # number of times the wheel still has to go around before it is due
+
+
+class TimerWheel:
+    """Runs callbacks after delays, see the module documentation."""
+    def __init__(self, tick=0.05, size=512):
+        self.tick = tick # seconds per slot
+        self.slots = [{} for _ in range(size)] # Timers in each slot (dictionaries for O(1) removal)
+        self.ready = {} # Timers with no delay waiting for the next iteration of the event loop
+        self.owners = {} # the Timers of each owner (as dictionaries)
+        self.count = 0 # number of Timers waiting
+        self.origin = None # event loop time of tick 0
+        self.current = 0 # last tick that has been run
+        self.running = False # if the callback that advances the wheel is scheduled
+
+    def __len__(self):
+        return self.count
+
+    def call_later(self, delay, owner, callback, *args):
+        """Calls the callback with the arguments after the delay (in seconds), returning the Timer."""
+        now = eventloop.time()
+        if self.origin is None: self.origin = now
+        if delay <= 0:
+            timer = Timer(callback, args, owner, 0)
+            if not self.ready: eventloop.add_callback(self._run_ready)
+            self._add(timer, self.ready)
+            return timer
+        if not self.running: # nothing to catch up on, move the wheel to now
+            self.current = max(self.current, int((now - self.origin) / self.tick))
+        due = max(self.current + 1, math.ceil((now + delay - self.origin) / self.tick))
+        offset = due - self.current - 1
+        timer = Timer(callback, args, owner, offset // len(self.slots))
+        self._add(timer, self.slots[due % len(self.slots)])
+        if not self.running:
+            self.running = True
+            eventloop.call_at(self.origin + (self.current + 1) * self.tick, self._advance)
+        return timer
+
+    def cancel(self, timer):
+        """Cancels a timer (does nothing if it has already run or been cancelled)."""
+        if timer.slot is None: return
+        del timer.slot[timer]
+        timer.slot = None
+        timers = self.owners[timer.owner]
+        del timers[timer]
+        if not timers: del self.owners[timer.owner]
+        self.count -= 1
+
+    def cancel_all(self, owner):
+        """Cancels all of the timers of an owner."""
+        for timer in list(self.owners.get(owner, ())): self.cancel(timer)
+
+    def _add(self, timer, slot):
+        timer.slot = slot
+        slot[timer] = None
+        self.owners.setdefault(timer.owner, {})[timer] = None
+        self.count += 1
+
+    def _run(self, timers, slot):
+        # timers are checked again before running since an earlier callback may have cancelled them
+        for timer in timers:
+            if timer.slot is slot:
+                self.cancel(timer)
+                try:
+                    timer.callback(*timer.args)
+                except Exception:
+                    log.exception('error in timer callback %r', timer.callback)
+
+    def _run_ready(self):
+        ready, self.ready = self.ready, {}
+        self._run(list(ready), ready)
+
+    def _advance(self):
+        try:
+            now_tick = int((eventloop.time() - self.origin) / self.tick)
+            while self.current < now_tick and self.count > len(self.ready):
+                self.current += 1
+                slot = self.slots[self.current % len(self.slots)]
+                due = []
+                for timer in slot:
+                    if timer.rounds: timer.rounds -= 1
+                    else: due.append(timer)
+                self._run(due, slot)
+        finally: # the wheel keeps going no matter what
+            if self.count > len(self.ready):
+                eventloop.call_at(self.origin + (self.current + 1) * self.tick, self._advance)
+            else:
+                self.running = False
@@ -0,0 +1,128 @@
+"""
+Compact binary encoding of the batches of game messages, an alternative to JSON that a client can
+ask for when it joins (see join() in server.py). The batch is then sent as a single socket.io binary
+attachment and decoded by decode_batch() in static/script.js.
+
+A batch is just the messages one after another. Each message is a byte with the code of the event,
+the 4-byte sequence number, and then the arguments of the event in the fixed layout for that code
+(see EVENTS). The layout is a string with a character for each argument:
+  n - player number (1 byte)
+  i - unsigned number like a score or hand number (2 bytes)
+  c - card as its index in DECK (1 byte)
+  C - list of cards, the number of cards (1 byte) followed by each card (1 byte each)
+  H - hand as the mask of the cards (8 bytes), decoded as a list of the cards in the same order as DECK
+  s - string, the length (2 bytes) followed by the UTF-8
+  S - list of strings, the number of strings (1 byte) followed by each string
+Everything is big-endian. A message that doesn't fit any of the layouts for its event is sent with
+the code JSON_CODE and a string of the JSON [event, args] instead.
+"""
+
+import json
+import struct
+
+from cards import DECK, CARD_INDICES, cards_mask, mask_cards
+
+# The event name and argument layout for each code (the index), an event can have several layouts
+EVENTS = (
+    ('joined', 's'),
+    ('renamed', 'sn'),
+    ('rejoined', 'n'),
+    ('disconnected', 'n'),
+    ('disconnected', 's'), # while waiting players are identified by name
+    ('select_partner', 'S'),
+    ('pause', ''),
+    ('start_game', 'nS'),
+    ('start_hand', 'Hi'),
+    ('traded', 'n'),
+    ('finish_trade', 'CC'),
+    ('start_turn', 'n'),
+    ('card_played', 'cn'),
+    ('end_trick', 'n'),
+    ('end_hand', 'ii'),
+    ('end_game', 'ii'),
+    ('start_game', 'S'), # the messages that are only for spectators (see Game.publish())
+    ('start_hand', 'i'),
+    ('finish_trade', ''),
+)
+JSON_CODE = 255
+
+_HEADER = struct.Struct('>BI')
+_UINT16 = struct.Struct('>H')
+_UINT64 = struct.Struct('>Q')
+
+# The possible codes and layouts for each event name
+_LAYOUTS = {}
+for code, (event, layout) in enumerate(EVENTS): _LAYOUTS.setdefault(event, []).append((code, layout))
+
+# The type of argument that each layout character takes
+_TYPES = {'n': int, 'i': int, 'c': str, 'C': list, 'H': list, 's': str, 'S': list}
+
+
+def _pack_str(string):
+    data = string.encode()
+    return _UINT16.pack(len(data)) + data
+
+def _pack_arg(kind, arg):
+    if kind == 'n': return bytes((arg,))
+    if kind == 'i': return _UINT16.pack(arg)
+    if kind == 'c': return bytes((CARD_INDICES[arg],))
+    if kind == 'C': return bytes([len(arg)] + [CARD_INDICES[card] for card in arg])
+    if kind == 'H': return _UINT64.pack(cards_mask(arg))
+    if kind == 's': return _pack_str(arg)
+    return bytes((len(arg),)) + b''.join(_pack_str(s) for s in arg) # 'S'
+
+def encode_message(event, args, seq):
+    """Encodes a single message."""
+    for code, layout in _LAYOUTS.get(event, ()):
+        if len(layout) == len(args) and all(type(a) is _TYPES[k] for k, a in zip(layout, args)):
+            try:
+                return _HEADER.pack(code, seq) + b''.join(_pack_arg(k, a) for k, a in zip(layout, args))
+            except (KeyError, ValueError, OverflowError, struct.error):
+                break # an unexpected value (like a score above 65535), use JSON
+    return _HEADER.pack(JSON_CODE, seq) + _pack_str(json.dumps([event, list(args)]))
+
+def encode_batch(messages):
+    """Encodes a batch of messages, a list of [event, args, seq]."""
+    return b''.join(encode_message(event, args, seq) for event, args, seq in messages)
+
+
+def _unpack_str(data, pos):
+    length, = _UINT16.unpack_from(data, pos)
+    return data[pos+2:pos+2+length].decode(), pos + 2 + length
+
+def decode_batch(data):
+    """Decodes a batch into a list of [event, args, seq] (the same as the JSON protocol)."""
+    batch, pos = [], 0
+    while pos < len(data):
+        code, seq = _HEADER.unpack_from(data, pos)
+        pos += _HEADER.size
+        if code == JSON_CODE:
+            string, pos = _unpack_str(data, pos)
+            event, args = json.loads(string)
+            batch.append([event, args, seq])
+            continue
+        event, layout = EVENTS[code]
+        args = []
+        for kind in layout:
+            if kind == 'n':
+                args.append(data[pos]); pos += 1
+            elif kind == 'i':
+                args.append(_UINT16.unpack_from(data, pos)[0]); pos += 2
+            elif kind == 'c':
+                args.append(DECK[data[pos]]); pos += 1
+            elif kind == 'C':
+                args.append([DECK[i] for i in data[pos+1:pos+1+data[pos]]]); pos += 1 + data[pos]
+            elif kind == 'H':
+                args.append(mask_cards(_UINT64.unpack_from(data, pos)[0])); pos += 8
+            elif kind == 's':
+                string, pos = _unpack_str(data, pos)
+                args.append(string)
+            else: # 'S'
+                count, strings = data[pos], []
+                pos += 1
+                for _ in range(count):
+                    string, pos = _unpack_str(data, pos)
+                    strings.append(string)
+                args.append(strings)
+        batch.append([event, args, seq])
+    return batch